@@ -0,0 +1,170 @@
+import asyncio
+import time
+import openai
+from config import CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_COOLDOWN, CIRCUIT_HALF_OPEN_MAX_CALLS
+from pipeline import is_stage_timeout
+
+
+class CircuitOpenError(Exception):
+    """斷路器開啟中，請求未送出就直接失敗"""
+
+    def __init__(self, retry_in):
+        super().__init__(f"LLM circuit is open, retry in {retry_in:.0f}s")
+        self.retry_in = retry_in
+
+
+def is_outage_error(error):
+    """超時、5xx 與連線錯誤代表供應商可能故障；429 與請求內容錯誤不計入"""
+    if isinstance(error, (asyncio.TimeoutError, openai.error.Timeout, openai.error.ServiceUnavailableError,
+                          openai.error.APIConnectionError)):
+        return True
+    if isinstance(error, openai.error.RateLimitError):
+        return False
+    if isinstance(error, openai.error.APIError):
+        status = getattr(error, "http_status", None)
+        return status is None or status >= 500
+    return False
+
+
+class CircuitBreaker:
+    """
+    LLM 供應商的斷路器
+
+    - closed：正常放行，連續 failure_threshold 次故障後轉為 open
+    - open：直接拋出 CircuitOpenError，cooldown 秒後轉為 half-open
+    - half-open：最多放行 half_open_max_calls 個探測請求，成功就回到 closed，失敗再次 open
+    狀態改變時呼叫已註冊的 listener(old_state, new_state, reason)
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, cooldown=CIRCUIT_COOLDOWN,
+                 half_open_max_calls=CIRCUIT_HALF_OPEN_MAX_CALLS):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.half_open_max_calls = half_open_max_calls
+
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._consecutive_failures = 0
+        self._half_open_in_flight = 0
+        self._listeners = []
+
+        self.trips = 0
+        self.rejected = 0
+        self.last_error = None
+
+    # ---------- 狀態 ----------
+    @property
+    def state(self):
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+            self._transition(self.HALF_OPEN, "冷卻時間結束，開始探測")
+        return self._state
+
+    def retry_in(self):
+        """距離可以探測還有幾秒（非 open 狀態為 0）"""
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self.cooldown - (time.monotonic() - self._opened_at))
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def _transition(self, new_state, reason):
+        old_state = self._state
+        if old_state == new_state:
+            return
+        self._state = new_state
+        if new_state == self.OPEN:
+            self._opened_at = time.monotonic()
+            self.trips += 1
+        if new_state != self.HALF_OPEN:
+            self._half_open_in_flight = 0
+        if new_state == self.CLOSED:
+            self._consecutive_failures = 0
+        print(f"🔌 LLM 斷路器 {old_state} → {new_state}：{reason}")
+
+        for callback in self._listeners:
+            try:
+                callback(old_state, new_state, reason)
+            except Exception as e:
+                print(f"⚠️ 斷路器狀態通知失敗: {e}")
+
+    # ---------- 請求 ----------
+    def before_call(self):
+        """
+        請求前檢查是否放行
+
+        Raises:
+            CircuitOpenError: 斷路器開啟，或半開時探測名額已滿
+        """
+        state = self.state
+        if state == self.OPEN:
+            self.rejected += 1
+            raise CircuitOpenError(self.retry_in())
+        if state == self.HALF_OPEN:
+            if self._half_open_in_flight >= self.half_open_max_calls:
+                self.rejected += 1
+                raise CircuitOpenError(self.cooldown)
+            self._half_open_in_flight += 1
+
+    def record_success(self):
+        self._consecutive_failures = 0
+        if self._state == self.HALF_OPEN:
+            self._transition(self.CLOSED, "探測請求成功")
+
+    def record_failure(self, error):
+        self.last_error = f"{type(error).__name__}: {error}"
+        if self._state == self.HALF_OPEN:
+            self._transition(self.OPEN, f"探測請求失敗（{type(error).__name__}）")
+            return
+        self._consecutive_failures += 1
+        if self._state == self.CLOSED and self._consecutive_failures >= self.failure_threshold:
+            self._transition(self.OPEN, f"連續 {self._consecutive_failures} 次失敗（最後一次：{type(error).__name__}）")
+
+    async def call(self, make_call):
+        """
+        經過斷路器執行請求
+
+        Args:
+            make_call (callable): 回傳 coroutine 的函式
+        """
+        self.before_call()
+        was_half_open = self._state == self.HALF_OPEN
+        try:
+            result = await make_call()
+        except asyncio.CancelledError as e:
+            # 階段超時取消了請求：視同超時故障，半開時的探測也因此重新 open；
+            # 其他取消（程序關閉、其他階段失敗）無法判斷供應商狀態，不計入
+            if is_stage_timeout(e):
+                self.record_failure(asyncio.TimeoutError("grading stage timed out"))
+            raise
+        except Exception as e:
+            if is_outage_error(e):
+                self.record_failure(e)
+            else:
+                # 供應商有回應（例如請求內容錯誤），不算故障
+                self.record_success()
+            raise
+        finally:
+            if was_half_open and self._half_open_in_flight > 0:
+                self._half_open_in_flight -= 1
+        self.record_success()
+        return result
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self._consecutive_failures,
+            "failure_threshold": self.failure_threshold,
+            "retry_in": self.retry_in(),
+            "trips": self.trips,
+            "rejected": self.rejected,
+            "last_error": self.last_error,
+        }
+
+
+# 全程式共用的斷路器
+circuit_breaker = CircuitBreaker()
@@ -9,6 +9,52 @@ DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 MODEL = "gpt-5-mini"
 
+# 模型路由（可在 prompts/manifest.json 的 model_settings 針對題目與面向覆寫）
+ENGLISH_MODEL = os.getenv("ENGLISH_MODEL", MODEL)  # 英語評分（通用的 Eng_prompt.txt）使用的模型
+STATISTICS_MODEL = os.getenv("STATISTICS_MODEL", MODEL)  # 統計評分使用的模型
+LLM_FALLBACK_MODEL = os.getenv("LLM_FALLBACK_MODEL", "")  # 主要模型超時或過載時改用的模型（空白代表不切換）
+LLM_MAX_OUTPUT_TOKENS = int(os.getenv("LLM_MAX_OUTPUT_TOKENS", 0))  # 每次評分的輸出 token 上限（0 代表不限制）
+LLM_TEMPERATURE = float(os.getenv("LLM_TEMPERATURE", 1.0))  # 評分溫度
+
+# OpenAI 連線設定（非同步客戶端）
+OPENAI_API_BASE = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1")  # 可指向相容的本地伺服器
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 200))  # 同時送出的 LLM 請求上限
+LLM_POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", 100))  # keep-alive 連線池大小
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", 290))  # 單一請求超時秒數
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", 10))  # 建立連線超時秒數
+LLM_STREAMING_ENABLED = os.getenv("LLM_STREAMING_ENABLED", "1") == "1"  # 以串流方式接收評分內容
+LLM_PROMPT_CACHE_KEY_ENABLED = os.getenv("LLM_PROMPT_CACHE_KEY_ENABLED", "1") == "1"  # 送出 prompt_cache_key，讓相同 system prompt 的請求命中供應商的 prompt 快取
+LLM_STREAM_STALL_TIMEOUT = float(os.getenv("LLM_STREAM_STALL_TIMEOUT", 180))  # 串流超過此秒數沒有資料即視為停滯
+LLM_STREAM_PROGRESS_INTERVAL = float(os.getenv("LLM_STREAM_PROGRESS_INTERVAL", 5))  # 更新 Discord 進度訊息的最短間隔
+
+# LLM 重試與對沖設定
+LLM_RETRY_MAX_ATTEMPTS = int(os.getenv("LLM_RETRY_MAX_ATTEMPTS", 3))  # 含第一次在內的最多嘗試次數
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", 2))  # 指數退避的基準秒數
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", 30))  # 單次退避上限秒數
+LLM_RETRY_DEADLINE = float(os.getenv("LLM_RETRY_DEADLINE", 290))  # 所有嘗試共用的期限秒數
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "0") == "1"  # 超過 p95 延遲時是否送出對沖請求
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", 30))  # 對沖前至少等待的秒數
+
+# LLM 斷路器設定（供應商故障時快速失敗或延後評分）
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5))  # 連續幾次故障後開啟斷路器
+CIRCUIT_COOLDOWN = float(os.getenv("CIRCUIT_COOLDOWN", 60))  # 開啟後等待幾秒再探測
+CIRCUIT_HALF_OPEN_MAX_CALLS = int(os.getenv("CIRCUIT_HALF_OPEN_MAX_CALLS", 2))  # 半開時同時放行的探測請求數
+CIRCUIT_OPEN_POLICY = os.getenv("CIRCUIT_OPEN_POLICY", "defer")  # 開啟時新提交的處理方式：defer（排隊延後）/ reject（直接拒絕）
+
+# LLM 限流設定（依供應商帳號的配額調整）
+LLM_RPM_LIMIT = int(os.getenv("LLM_RPM_LIMIT", 500))  # 每分鐘請求數上限
+LLM_TPM_LIMIT = int(os.getenv("LLM_TPM_LIMIT", 200000))  # 每分鐘 token 數上限
+LLM_MIN_CONCURRENCY = int(os.getenv("LLM_MIN_CONCURRENCY", 2))  # 收到 429 後並行數最低降到此值
+LLM_EXPECTED_COMPLETION_TOKENS = int(os.getenv("LLM_EXPECTED_COMPLETION_TOKENS", 4000))  # 未指定 max_tokens 時的回應 token 預估
+
+# 評分前檢查（作答長度上限，可在 prompts/manifest.json 針對題目覆寫）
+ANSWER_MAX_TOKENS = int(os.getenv("ANSWER_MAX_TOKENS", 12000))  # 單份作答的 token 上限
+ANSWER_OVERSIZE_POLICY = os.getenv("ANSWER_OVERSIZE_POLICY", "reject")  # 超過上限時：reject / trim / route
+ANSWER_OVERSIZE_MODEL = os.getenv("ANSWER_OVERSIZE_MODEL", "gpt-5")  # route 策略改用的長上下文模型
+LLM_PRICE_INPUT_PER_1M = float(os.getenv("LLM_PRICE_INPUT_PER_1M", 0.25))  # 每百萬輸入 token 價格（美元）
+LLM_PRICE_CACHED_INPUT_PER_1M = float(os.getenv("LLM_PRICE_CACHED_INPUT_PER_1M", 0.025))  # 命中 prompt 快取的輸入 token 價格（美元）
+LLM_PRICE_OUTPUT_PER_1M = float(os.getenv("LLM_PRICE_OUTPUT_PER_1M", 2.0))  # 每百萬輸出 token 價格（美元）
+
 # Google Drive 設定（OAuth2）
 UPLOADS_FOLDER_ID = os.getenv("UPLOADS_FOLDER_ID")
 REPORTS_FOLDER_ID = os.getenv("REPORTS_FOLDER_ID")
@@ -48,9 +94,51 @@ HWIS_ROLE_ID = int(os.getenv("HWIS_ROLE_ID", 0))  # 可選：HWIS 身分組 ID
 # 資料庫設定
 DB_PATH = "homework.db"
 
+# LLM 回應快取設定（相同 prompt + 相同作答內容直接沿用先前的評分）
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") == "1"
+LLM_CACHE_DB_PATH = os.path.join(BASE_DIR, "llm_cache.db")
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", 14 * 24 * 3600))  # 快取有效秒數（預設 14 天）
+LLM_CACHE_MEMORY_BYTES = int(os.getenv("LLM_CACHE_MEMORY_BYTES", 32 * 1024 * 1024))  # 記憶體層容量
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", 512 * 1024 * 1024))  # SQLite 層容量
+
 # 目錄設定
 PROMPTS_DIR = os.path.join(BASE_DIR, "prompts")
 
+# 評分佇列設定
+GRADING_WORKERS = int(os.getenv("GRADING_WORKERS", 10))  # 同時評分的提交數
+GRADING_QUEUE_MAX_DEPTH = int(os.getenv("GRADING_QUEUE_MAX_DEPTH", 300))  # 排隊上限，超過則拒絕新提交
+GRADING_ETA_DEFAULT_SECONDS = float(os.getenv("GRADING_ETA_DEFAULT_SECONDS", 120))  # 尚無紀錄時每份作業的預估用時
+GRADING_JOB_LEASE_SECONDS = float(os.getenv("GRADING_JOB_LEASE_SECONDS", 90))  # 評分工作租約秒數（程序停止後多久由新程序接手）
+GRADING_JOB_MAX_RECOVERIES = int(os.getenv("GRADING_JOB_MAX_RECOVERIES", 3))  # 同一工作最多被接手幾次（避免反覆讓程序當機的工作）
+SUBMISSION_MERGE_QUEUED = os.getenv("SUBMISSION_MERGE_QUEUED", "1") == "1"  # 同一學生同一題還在排隊時，新的上傳取代排隊中的工作而不重複評分
+SUBMISSION_FAST_PARSE = os.getenv("SUBMISSION_FAST_PARSE", "1") == "1"  # 先以正規表達式解析 StatsAnswerFormatter 版面，不符合時才建立 DOM
+
+# 上傳檔案的接收限制（下載前依 attachment.size 檢查；題目上限可在 prompts/manifest.json 覆寫）
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 10 * 1024 * 1024))  # 附件大小的硬上限，超過則不下載
+UPLOAD_STREAM_THRESHOLD = int(os.getenv("UPLOAD_STREAM_THRESHOLD", 512 * 1024))  # 超過此大小時串流下載，並在解析前移除 script/style 與 data URI
+UPLOAD_DOWNLOAD_TIMEOUT = float(os.getenv("UPLOAD_DOWNLOAD_TIMEOUT", 60))  # 串流下載的逾時秒數
+UPLOAD_MAX_HTML_BYTES = int(os.getenv("UPLOAD_MAX_HTML_BYTES", 2 * 1024 * 1024))  # 清理後 HTML 的大小上限（題目 max_upload_bytes）
+ANSWER_MAX_CHARS = int(os.getenv("ANSWER_MAX_CHARS", 50000))  # 作答字元數的硬上限（題目 max_answer_chars，0 代表不限制）
+
+# 每份提交的時間預算（下載、解析、評分、報告與 Drive 上傳共用，不含排隊時間）
+SUBMISSION_TIME_BUDGET = float(os.getenv("SUBMISSION_TIME_BUDGET", 480))  # 總秒數
+BUDGET_REPORT_RESERVE = float(os.getenv("BUDGET_REPORT_RESERVE", 30))  # 評分時保留給報告生成、寫入資料庫與私訊的秒數
+BUDGET_DRIVE_MIN_SECONDS = float(os.getenv("BUDGET_DRIVE_MIN_SECONDS", 15))  # 剩餘時間低於此值時 Drive 上傳改在背景完成
+SUBMISSION_PARTIAL_FEEDBACK = os.getenv("SUBMISSION_PARTIAL_FEEDBACK", "1") == "1"  # 時間用完時先送出已完成面向的回饋
+
+# 評分優先順序（第一次提交優先；等待越久的工作順位越前面，不會餓死）
+PRIORITY_EARLY_MAX_ATTEMPT = int(os.getenv("PRIORITY_EARLY_MAX_ATTEMPT", 3))  # 第幾次提交以內屬於 early（之後為 resubmit）
+PRIORITY_CLASS_GAP = float(os.getenv("PRIORITY_CLASS_GAP", 120))  # 每降一個優先等級，視同晚到的秒數
+PRIORITY_DEADLINE_WINDOW_HOURS = float(os.getenv("PRIORITY_DEADLINE_WINDOW_HOURS", 24))  # 距離期限多少小時內加重優先順序差距
+PRIORITY_DEADLINE_BOOST = float(os.getenv("PRIORITY_DEADLINE_BOOST", 3))  # 期限前差距放大的倍數
+
+# Prompt 快取設定
+PROMPT_MANIFEST_PATH = os.path.join(PROMPTS_DIR, "manifest.json")  # 額外的題目 -> prompt 對應（免改程式碼）
+STRUCTURED_SCORES_ENABLED = os.getenv("STRUCTURED_SCORES_ENABLED", "1") == "1"  # 題目設定 score_schema 時，要求模型另外回傳 JSON 成績（不再從報告解析）
+PROMPT_AUTO_DISCOVER = os.getenv("PROMPT_AUTO_DISCOVER", "0") == "1"  # 將 prompts/ 內每個 .txt 檔名視為可評分的題目（預設關閉，只評分 SPECIFIC_PROMPTS 與 manifest 列出的題目）
+DEFAULT_ENGLISH_PROMPT = os.path.join(PROMPTS_DIR, "Eng_prompt.txt")  # 未指定時使用的英語評分 prompt
+PROMPT_REFRESH_INTERVAL = int(os.getenv("PROMPT_REFRESH_INTERVAL", 30))  # 檢查 prompt 檔案變動的間隔（秒）
+
 # 特定題目的 Prompt 檔案路徑配置（必須是字典格式，包含 english 和 statistics）
 SPECIFIC_PROMPTS = {
     "Age and Viewing Habits 考卷": {
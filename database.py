@@ -4,9 +4,20 @@ from datetime import datetime
 from config import DB_PATH
 import os
 import json
+import time
 
 
 class DatabaseManager:
+    # GradingMetrics 中記錄用時（秒）的階段欄位
+    GRADING_METRIC_STAGES = [
+        "queue_wait", "download", "parse", "prompt_lookup", "llm_english", "llm_statistics",
+        "report_render", "drive_upload", "db_write", "total",
+    ]
+    GRADING_METRIC_COLUMNS = [
+        "file_id", "user_id", "class_name", "question_title", "attempt_number", "model",
+        *GRADING_METRIC_STAGES, "prompt_tokens", "completion_tokens", "cached_prompt_tokens", "cache_hits",
+    ]
+
     def __init__(self):
         # 當初始化 DatabaseManager 時，會自動連接/創建資料庫
         self.conn = sqlite3.connect(DB_PATH, check_same_thread=False)
@@ -69,12 +80,70 @@ class DatabaseManager:
         self.cur.execute("CREATE INDEX IF NOT EXISTS idx_assignment_files_student_id ON AssignmentFiles(student_id)")
         self.cur.execute("CREATE INDEX IF NOT EXISTS idx_assignment_files_question ON AssignmentFiles(question_title)")
 
+        # 建立評分效能紀錄資料表（每份提交各階段用時、token 數與模型）
+        self.cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS GradingMetrics (
+                metric_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                file_id INTEGER,
+                user_id VARCHAR(20),
+                class_name VARCHAR(50),
+                question_title VARCHAR(200),
+                attempt_number INTEGER,
+                model VARCHAR(100),
+                queue_wait REAL,
+                download REAL,
+                parse REAL,
+                prompt_lookup REAL,
+                llm_english REAL,
+                llm_statistics REAL,
+                report_render REAL,
+                drive_upload REAL,
+                db_write REAL,
+                total REAL,
+                prompt_tokens INTEGER,
+                completion_tokens INTEGER,
+                cached_prompt_tokens INTEGER DEFAULT 0,
+                cache_hits INTEGER DEFAULT 0,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (file_id) REFERENCES AssignmentFiles(file_id) ON DELETE SET NULL
+            )
+        """
+        )
+        self.cur.execute("CREATE INDEX IF NOT EXISTS idx_grading_metrics_question ON GradingMetrics(question_title, created_at)")
+
+        # 建立評分工作資料表（重新啟動後可繼續未完成的評分）
+        self.cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS GradingJobs (
+                job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id VARCHAR(20) NOT NULL,
+                question_title VARCHAR(200),
+                attempt_number INTEGER,
+                payload TEXT NOT NULL,
+                state VARCHAR(20) NOT NULL DEFAULT 'queued',
+                lease_owner VARCHAR(64),
+                lease_expires_at REAL,
+                recoveries INTEGER DEFAULT 0,
+                error TEXT,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        """
+        )
+        self.cur.execute("CREATE INDEX IF NOT EXISTS idx_grading_jobs_state ON GradingJobs(state, lease_expires_at)")
+
         try:
             self.cur.execute("ALTER TABLE AssignmentFiles ADD COLUMN parsed_scores TEXT")
             self.cur.execute("ALTER TABLE AssignmentFiles ADD COLUMN score_keys TEXT")
         except sqlite3.OperationalError:
             pass # 如果欄位已存在會觸發此錯誤，直接忽略即可，確保程式不會崩潰
 
+        try:
+            self.cur.execute("ALTER TABLE GradingMetrics ADD COLUMN cached_prompt_tokens INTEGER DEFAULT 0")
+        except sqlite3.OperationalError:
+            pass # 舊資料庫補上命中 prompt 快取的 token 欄位
+
         self.conn.commit()
         print("✅ 資料庫表格建立完成 / Database tables created")
 
@@ -287,7 +356,7 @@ class DatabaseManager:
 
             self.conn.commit()
             print(f"✅ 已記錄提交：Discord ID={discord_id}, 學號={db_student_number or student_number}, 題目={question_title}, 嘗試={attempt_number}")
-            return True
+            return self.cur.lastrowid  # 回傳 file_id（非 0，可當作成功判斷）
 
         except Exception as e:
             print(f"❌ 插入提交記錄失敗: {e}")
@@ -296,6 +365,185 @@ class DatabaseManager:
             self.conn.rollback()
             return False
 
+    def insert_grading_metrics(self, metrics):
+        """
+        記錄一份提交的評分效能資料
+
+        Args:
+            metrics (dict): 欄位名稱對應 GradingMetrics 的欄位（未提供的欄位為 NULL）
+        """
+        columns = [column for column in self.GRADING_METRIC_COLUMNS if column in metrics]
+        try:
+            self.cur.execute(
+                f"INSERT INTO GradingMetrics ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+                [metrics[column] for column in columns],
+            )
+            self.conn.commit()
+            return True
+        except Exception as e:
+            print(f"❌ 寫入評分效能紀錄失敗: {e}")
+            self.conn.rollback()
+            return False
+
+    def get_grading_metric_percentiles(self, days=7, question_title=None, stages=None):
+        """
+        依題目與日期統計各階段用時的 p50 / p95 / p99
+
+        Args:
+            days (int): 統計最近幾天
+            question_title (str, optional): 只統計特定題目
+            stages (list, optional): 要統計的階段欄位（預設 GRADING_METRIC_STAGES）
+
+        Returns:
+            list: [{"question_title", "day", "count", "stages": {stage: (p50, p95, p99)}, "tokens"}]
+        """
+        stages = stages or self.GRADING_METRIC_STAGES
+        query = f"""
+            SELECT question_title, DATE(created_at, 'localtime'), {', '.join(stages)},
+                   COALESCE(prompt_tokens, 0) + COALESCE(completion_tokens, 0)
+            FROM GradingMetrics
+            WHERE created_at >= DATETIME('now', ?)
+        """
+        params = [f"-{int(days)} days"]
+        if question_title:
+            query += " AND question_title = ?"
+            params.append(question_title)
+        query += " ORDER BY question_title, 2"
+        self.cur.execute(query, params)
+
+        groups = {}
+        for row in self.cur.fetchall():
+            groups.setdefault((row[0], row[1]), []).append(row)
+
+        def percentile(values, p):
+            ordered = sorted(values)
+            index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+            return ordered[index]
+
+        summary = []
+        for (title, day), rows in groups.items():
+            stage_stats = {}
+            for index, stage in enumerate(stages, start=2):
+                values = [row[index] for row in rows if row[index] is not None]
+                if values:
+                    stage_stats[stage] = tuple(percentile(values, p) for p in (50, 95, 99))
+            summary.append({
+                "question_title": title,
+                "day": day,
+                "count": len(rows),
+                "stages": stage_stats,
+                "tokens": sum(row[-1] for row in rows),
+            })
+        return summary
+
+    # ---------- 評分工作（GradingJobs） ----------
+    def create_grading_job(self, user_id, question_title, attempt_number, payload, owner, lease_seconds):
+        """新增一筆排隊中的評分工作，回傳 job_id"""
+        self.cur.execute(
+            """
+            INSERT INTO GradingJobs
+            (user_id, question_title, attempt_number, payload, state, lease_owner, lease_expires_at)
+            VALUES (?, ?, ?, ?, 'queued', ?, ?)
+            """,
+            (
+                str(user_id),
+                question_title,
+                attempt_number,
+                json.dumps(payload, ensure_ascii=False),
+                owner,
+                time.time() + lease_seconds,
+            ),
+        )
+        self.conn.commit()
+        return self.cur.lastrowid
+
+    def get_max_job_attempt(self, discord_id, question_title):
+        """評分工作中已使用的最大提交次數（包含尚未寫入 AssignmentFiles 的排隊工作），沒有則返回 0"""
+        self.cur.execute(
+            "SELECT MAX(attempt_number) FROM GradingJobs WHERE user_id = ? AND question_title = ?",
+            (str(discord_id), question_title),
+        )
+        result = self.cur.fetchone()[0]
+        return result if result is not None else 0
+
+    def update_grading_job_state(self, job_id, state, error=None, payload=None):
+        """更新評分工作狀態（queued / running / done / failed），可同時更新 payload"""
+        if payload is not None:
+            self.cur.execute(
+                "UPDATE GradingJobs SET state = ?, error = ?, payload = ?, updated_at = CURRENT_TIMESTAMP WHERE job_id = ?",
+                (state, error, json.dumps(payload, ensure_ascii=False), job_id),
+            )
+        else:
+            self.cur.execute(
+                "UPDATE GradingJobs SET state = ?, error = ?, updated_at = CURRENT_TIMESTAMP WHERE job_id = ?",
+                (state, error, job_id),
+            )
+        self.conn.commit()
+
+    def renew_grading_job_leases(self, owner, lease_seconds):
+        """延長此程序持有的所有未完成工作的租約，回傳更新筆數"""
+        self.cur.execute(
+            """
+            UPDATE GradingJobs SET lease_expires_at = ?
+            WHERE lease_owner = ? AND state IN ('queued', 'running')
+            """,
+            (time.time() + lease_seconds, owner),
+        )
+        self.conn.commit()
+        return self.cur.rowcount
+
+    def release_grading_job_leases(self, owner):
+        """正常關閉時釋放租約，讓下一個程序啟動後立即接手未完成的工作"""
+        self.cur.execute(
+            "UPDATE GradingJobs SET lease_expires_at = 0 WHERE lease_owner = ? AND state IN ('queued', 'running')",
+            (owner,),
+        )
+        self.conn.commit()
+        return self.cur.rowcount
+
+    def claim_expired_grading_jobs(self, owner, lease_seconds):
+        """
+        接手租約已過期的未完成工作（原程序已停止），並改回排隊狀態
+
+        Returns:
+            list: [(job_id, user_id, payload, recoveries), ...]
+        """
+        now = time.time()
+        self.cur.execute(
+            """
+            SELECT job_id FROM GradingJobs
+            WHERE state IN ('queued', 'running') AND (lease_expires_at IS NULL OR lease_expires_at < ?)
+            ORDER BY job_id ASC
+            """,
+            (now,),
+        )
+        candidates = [row[0] for row in self.cur.fetchall()]
+
+        claimed = []
+        for job_id in candidates:
+            # 以條件式更新確保同一筆工作只會被一個程序接手
+            self.cur.execute(
+                """
+                UPDATE GradingJobs
+                SET lease_owner = ?, lease_expires_at = ?, state = 'queued',
+                    recoveries = recoveries + 1, updated_at = CURRENT_TIMESTAMP
+                WHERE job_id = ? AND state IN ('queued', 'running')
+                  AND (lease_expires_at IS NULL OR lease_expires_at < ?)
+                """,
+                (owner, now + lease_seconds, job_id, now),
+            )
+            if self.cur.rowcount == 1:
+                claimed.append(job_id)
+        self.conn.commit()
+
+        if not claimed:
+            return []
+        self.cur.execute(
+            f"SELECT job_id, user_id, payload, recoveries FROM GradingJobs WHERE job_id IN ({', '.join('?' for _ in claimed)}) ORDER BY job_id",
+            claimed,
+        )
+        return [(job_id, user_id, json.loads(payload), recoveries) for job_id, user_id, payload, recoveries in self.cur.fetchall()]
+
     # 新增給 TA 查詢成績用的方法
     def get_all_scores_for_class(self, class_name, question_title):
         """
@@ -319,6 +567,71 @@ class DatabaseManager:
         
         return self.cur.fetchall()
 
+    def get_submissions_for_question(self, question_title, class_name, latest_only=False):
+        """
+        列出某班級、特定題目已保存的所有提交（供批次重新評分使用）
+
+        Args:
+            question_title (str): 題目標題
+            class_name (str): 班級名稱
+            latest_only (bool): 是否只取每位學生最後一次提交
+
+        Returns:
+            list: (file_id, user_id, student_number, student_name, file_path, attempt_number)
+        """
+        self.cur.execute("""
+            SELECT
+                a.file_id,
+                a.user_id,
+                a.student_id,
+                COALESCE(s.student_name, a.student_id),
+                a.file_path,
+                a.attempt_number
+            FROM AssignmentFiles a
+            JOIN Classes c ON a.class_id = c.class_id
+            LEFT JOIN Students s ON s.student_number = a.student_id AND s.class_id = a.class_id
+            WHERE a.question_title = ? AND c.class_name = ? AND a.file_type = 'grading'
+            ORDER BY a.student_id ASC, a.attempt_number ASC
+        """, (question_title, class_name))
+        rows = self.cur.fetchall()
+
+        if latest_only:
+            latest = {}
+            for row in rows:
+                latest[row[2]] = row  # 已依嘗試次數排序，後者覆蓋前者
+            rows = list(latest.values())
+        return rows
+
+    def update_parsed_scores_bulk(self, updates):
+        """
+        批次更新多筆提交的解析成績（單一交易）
+
+        Args:
+            updates (list): [(file_id, parsed_scores, score_keys), ...]
+
+        Returns:
+            int: 更新的筆數
+        """
+        rows = [
+            (
+                json.dumps(parsed_scores, ensure_ascii=False) if parsed_scores else None,
+                json.dumps(score_keys, ensure_ascii=False) if score_keys else None,
+                file_id,
+            )
+            for file_id, parsed_scores, score_keys in updates
+        ]
+        try:
+            self.cur.executemany(
+                "UPDATE AssignmentFiles SET parsed_scores = ?, score_keys = ? WHERE file_id = ?",
+                rows,
+            )
+            self.conn.commit()
+            return len(rows)
+        except Exception as e:
+            print(f"❌ 批次更新成績失敗: {e}")
+            self.conn.rollback()
+            raise
+
     def get_student_submissions(self, discord_id, question_title=None):
         """
         獲取學生的作業提交記錄
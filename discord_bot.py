@@ -11,16 +11,36 @@ from config import (
     REPORTS_FOLDER_ID,
     WELCOME_CHANNEL_ID, NCUFN_CHANNEL_ID, NCUEC_CHANNEL_ID, CYCUIUBM_CHANNEL_ID, HWIS_CHANNEL_ID, ADMIN_CHANNEL_ID, 
     NCUFN_ROLE_NAME, NCUEC_ROLE_NAME, CYCUIUBM_ROLE_NAME, HWIS_ROLE_NAME,
-    NCUFN_ROLE_ID, NCUEC_ROLE_ID, CYCUIUBM_ROLE_ID, HWIS_ROLE_ID, ADMIN_ROLE_ID
+    NCUFN_ROLE_ID, NCUEC_ROLE_ID, CYCUIUBM_ROLE_ID, HWIS_ROLE_ID, ADMIN_ROLE_ID,
+    PROMPT_REFRESH_INTERVAL, LLM_STREAM_PROGRESS_INTERVAL, CIRCUIT_OPEN_POLICY, GRADING_JOB_MAX_RECOVERIES,
+    SUBMISSION_MERGE_QUEUED, SUBMISSION_TIME_BUDGET, BUDGET_REPORT_RESERVE, SUBMISSION_PARTIAL_FEEDBACK,
 )
 from database import DatabaseManager
-from html_parser import extract_html_content, extract_html_title
+from html_parser import parse_submission, parser_stats
 from grading import GradingService
-from file_handler import FileHandler
+from llm_client import get_chat_client
+from prompt_registry import prompt_registry
+from prompt_cache import prompt_cache_stats
+from report_generator import report_fragment_cache
+from response_cache import close_response_cache, get_response_cache
+from rate_limiter import rate_limiter
+from llm_retry import retry_policy
+from pipeline import GradingPipeline
+from preflight import AnswerTooLargeError, UploadLimitError, check_submission, check_upload_limits
+from model_router import fit_to_budget, get_model_settings, stage_timeout
+from time_budget import TimeBudget
+from structured_scores import (
+    ScoreValidationError, get_score_schemas, parse_structured_scores, split_score_block, to_parsed_scores,
+    with_score_instruction,
+)
+from job_queue import GradingJob, GradingQueue, QueueFullError
+from circuit_breaker import CircuitBreaker, CircuitOpenError, circuit_breaker
+from single_flight import KeyedLock
+from file_handler import FileHandler, UploadTooLargeError
 import io
 import pandas as pd
 import json
-from html_parser import extract_html_content, extract_html_title, extract_scores_from_html_string
+from html_parser import extract_scores_from_html_string
 
 
 class HomeworkBot:
@@ -34,6 +54,22 @@ class HomeworkBot:
         self.session = None
         self.force_welcome = force_welcome
         self.is_open = True  # 機器人開關狀態，預設為開啟
+        self.prompt_refresh_task = None
+
+        # 全域評分佇列：固定數量的 worker 處理所有上傳
+        self.grading_queue = GradingQueue(
+            self.grade_submission,
+            circuit_breaker=circuit_breaker,
+            store=self.db,
+            on_recover=self.resume_grading_job,
+        )
+        circuit_breaker.add_listener(self.on_circuit_state_change)
+        # 同一學生同一題的上傳依序處理（避免重複的提交次數與重複評分）
+        self.submission_locks = KeyedLock()
+        FileHandler.on_background_upload_failed = self.notify_background_upload_failed
+
+        # 啟動時預載入所有 prompt，評分時不再讀取磁碟
+        prompt_registry.load()
 
         # 身分組對應班級名稱 - 改為英文
         self.role_to_class = {
@@ -58,7 +94,6 @@ class HomeworkBot:
         # 設定事件處理器
         self.client.event(self.on_ready)
         self.client.event(self.on_message)
-        self.client.event(self.on_close)
 
     def is_class_channel(self, channel_id, user_class=None):
         """檢查是否為班級頻道"""
@@ -225,6 +260,43 @@ class HomeworkBot:
         except Exception as e:
             print(f"❌ 廣播狀態訊息時發生錯誤: {e}")
     
+    async def notify_background_upload_failed(self, filename, question_title, class_name, student_id, error):
+        """FileHandler 背景 Drive 上傳失敗時的回呼"""
+        await self.notify_administrators(
+            "Google Drive 背景上傳失敗",
+            f"檔案: {filename}\n題目: {question_title}\n班級: {class_name}\n學號: {student_id}",
+            error_details=error,
+            severity="warning"
+        )
+
+    def next_attempt_number(self, user_id, question_title, html_title):
+        """下一次提交的次數：同時參考已評分的提交、評分工作紀錄與佇列中的工作"""
+        return max(
+            self.db.get_max_attempt(user_id, question_title),
+            self.db.get_max_job_attempt(user_id, question_title),
+            self.grading_queue.max_attempt(user_id, html_title),
+        ) + 1
+
+    async def discard_upload(self, save_path, drive_id):
+        """刪除不再使用的上傳檔案（本地與 Drive）；Drive 仍在背景上傳時無法刪除，通知管理員處理"""
+        if save_path:
+            try:
+                if os.path.exists(save_path):
+                    os.remove(save_path)
+                    print(f"🗑️ 已刪除不再使用的上傳檔案: {save_path}")
+            except OSError as e:
+                print(f"⚠️ 無法刪除不再使用的上傳檔案 {save_path}: {e}")
+
+        if drive_id == FileHandler.DRIVE_DEFERRED:
+            await self.notify_administrators(
+                "不再使用的上傳檔案仍在 Drive 上",
+                f"檔案: {os.path.basename(save_path or '')}\n"
+                "此檔案當時改在背景上傳 Drive，沒有檔案 ID 可自動刪除，請手動移除這份已被取代或未排入佇列的檔案",
+                severity="warning"
+            )
+        elif drive_id:
+            await FileHandler().delete_from_drive(drive_id)
+
     async def notify_administrators(self, title, description, error_details=None, severity="warning"):
         """發送通知給管理員"""
         try:
@@ -263,17 +335,75 @@ class HomeworkBot:
         except Exception as e:
             print(f"❌ 發送管理員通知失敗: {e}")
 
+    def on_circuit_state_change(self, old_state, new_state, reason):
+        """LLM 斷路器狀態改變時通知管理員（只在狀態改變時通知，不逐筆通知失敗）"""
+        if new_state == CircuitBreaker.HALF_OPEN:
+            return
+        if new_state == CircuitBreaker.OPEN:
+            title = "AI 評分服務中斷 / LLM Circuit Open"
+            description = (
+                f"{reason}\n"
+                f"新提交將{'排入佇列延後評分' if CIRCUIT_OPEN_POLICY == 'defer' else '直接拒絕'}，"
+                f"{circuit_breaker.cooldown:.0f} 秒後開始探測。\n"
+                f"排隊中：{self.grading_queue.depth} 份"
+            )
+            severity = "error"
+        else:
+            title = "AI 評分服務恢復 / LLM Circuit Closed"
+            description = f"{reason}\n排隊中的 {self.grading_queue.depth} 份作業將繼續評分。"
+            severity = "warning"
+        try:
+            asyncio.get_running_loop().create_task(self.notify_administrators(
+                title, description, error_details=circuit_breaker.last_error, severity=severity
+            ))
+        except RuntimeError:
+            pass
+
     async def on_ready(self):
         """機器人啟動時執行的事件處理器"""
         self.session = aiohttp.ClientSession()
         print(f"✅ HTML作業處理機器人已啟動: {self.client.user}")
 
+        # 預先轉換各題的完整題目與解答（報告生成時直接使用快取的 HTML 片段）
+        await self.warm_report_fragments()
+
+        # 啟動評分 worker
+        self.grading_queue.start()
+
+        # 定期檢查 prompt 檔案是否被修改（on_ready 可能因重新連線被多次呼叫）
+        if self.prompt_refresh_task is None or self.prompt_refresh_task.done():
+            self.prompt_refresh_task = asyncio.create_task(self.refresh_prompts_periodically())
+
         # 初始化班級資料
         await self.initialize_classes()
 
         # 發送歡迎訊息
         await self.send_welcome_message()
 
+    async def refresh_prompts_periodically(self):
+        """背景工作：只重新載入 mtime 改變的 prompt 檔案"""
+        while True:
+            await asyncio.sleep(PROMPT_REFRESH_INTERVAL)
+            try:
+                reloaded = prompt_registry.refresh()
+                if reloaded:
+                    print(f"🔄 已重新載入 {reloaded} 個 prompt 檔案")
+            except Exception as e:
+                print(f"❌ 更新 prompt 快取失敗: {e}")
+            await self.warm_report_fragments()
+
+    async def warm_report_fragments(self):
+        """在執行緒池中轉換尚未快取或檔案已變動的題目/解答（Question/、Answer/ 的 Word 檔）"""
+        try:
+            start = time.time()
+            rendered = await asyncio.get_running_loop().run_in_executor(
+                None, report_fragment_cache.warm, prompt_registry.titles()
+            )
+            if rendered:
+                print(f"📄 已轉換 {rendered} 題的題目與解答 (用時: {time.time() - start:.2f}秒)")
+        except Exception as e:
+            print(f"❌ 更新題目/解答快取失敗: {e}")
+
     async def initialize_classes(self):
         """初始化班級資料"""
         for class_name in self.role_to_class.values():
@@ -467,6 +597,8 @@ class HomeworkBot:
                     "• `!open` - 開啟作業批改功能 / Enable homework grading\n"
                     "• `!close` - 關閉作業批改功能（僅刪除訊息）/ Disable homework grading (delete messages only)\n"
                     "• `!remove-role-members 身份組名稱` - 移除指定身份組的所有成員 / Remove all members from a role\n"
+                    "• `!grading-status` - 查看評分系統狀態 / View grading system status\n"
+                    "• `!grading-metrics [天數] [題目]` - 各題每日評分用時 p50/p95/p99 / Grading latency percentiles\n"
                 )
 
             help_text += (
@@ -561,6 +693,26 @@ class HomeworkBot:
                 await self.remove_role_members(message)
                 should_delete = True
 
+        # 處理管理員查看評分系統狀態指令
+        elif message.content.lower() == "!grading-status":
+            is_admin = any(role.id == ADMIN_ROLE_ID for role in message.author.roles) or message.author.guild_permissions.administrator
+            
+            if not is_admin:
+                await message.author.send("⛔ **權限不足 / Access Denied**\n此指令僅限管理員使用。")
+            else:
+                await self.show_grading_status(message)
+            should_delete = True
+
+        # 處理管理員查看評分效能指令 (!grading-metrics [天數] [題目])
+        elif message.content.lower().startswith("!grading-metrics"):
+            is_admin = any(role.id == ADMIN_ROLE_ID for role in message.author.roles) or message.author.guild_permissions.administrator
+            
+            if not is_admin:
+                await message.author.send("⛔ **權限不足 / Access Denied**\n此指令僅限管理員使用。")
+            else:
+                await self.show_grading_metrics(message)
+            should_delete = True
+
         # 擋下歡迎頻道的閒聊與無效訊息 (引導使用 !login)
         elif message.channel.id == WELCOME_CHANNEL_ID:
             await message.author.send(
@@ -709,6 +861,267 @@ class HomeworkBot:
             except (discord.Forbidden, discord.NotFound):
                 pass
 
+    async def show_grading_status(self, message):
+        """管理員專用：顯示評分系統的即時狀態"""
+        try:
+            lines = ["📈 **評分系統狀態 / Grading System Status**\n"]
+
+            queue_stats = self.grading_queue.stats()
+            lines.append(
+                f"🧾 **評分佇列 / Grading Queue**\n"
+                f"• 排隊中 / Queued：{queue_stats['depth']} / {queue_stats['max_depth']}\n"
+                f"• 評分中 / Running：{queue_stats['running']} / {queue_stats['workers']} workers\n"
+                f"• 最久等待 / Oldest wait：{queue_stats['oldest_wait']:.0f} 秒\n"
+                f"• 平均評分用時 / Avg duration：{queue_stats['average_duration']:.1f} 秒\n"
+                f"• 已完成 / Completed：{queue_stats['completed']}，已拒絕 / Rejected：{queue_stats['rejected']}，"
+                f"延後 / Deferred：{queue_stats['deferred']}，合併 / Merged：{queue_stats['merged']}\n"
+            )
+
+            class_labels = {"first": "首次提交 / First", "early": "前幾次 / Early", "resubmit": "多次重交 / Resubmit"}
+            class_lines = ["🎯 **優先等級排隊時間 / Queue Wait by Priority**（p50 / p95）"]
+            for name, label in class_labels.items():
+                wait = queue_stats["wait_by_class"][name]
+                class_lines.append(
+                    f"• {label}：排隊中 {queue_stats['pending_by_class'][name]}，"
+                    f"{wait['p50']:.0f} / {wait['p95']:.0f} 秒（{wait['count']} 筆）"
+                )
+            lines.append("\n".join(class_lines) + "\n")
+
+            circuit_stats = circuit_breaker.stats()
+            circuit_labels = {
+                CircuitBreaker.CLOSED: "🟢 正常 / Closed",
+                CircuitBreaker.OPEN: "🔴 中斷 / Open",
+                CircuitBreaker.HALF_OPEN: "🟡 探測中 / Half-open",
+            }
+            circuit_lines = [
+                f"🔌 **LLM 斷路器 / Circuit Breaker**",
+                f"• 狀態 / State：{circuit_labels[circuit_stats['state']]}",
+                f"• 連續失敗 / Consecutive failures：{circuit_stats['consecutive_failures']} / {circuit_stats['failure_threshold']}",
+                f"• 跳脫次數 / Trips：{circuit_stats['trips']}，快速失敗 / Fast-failed：{circuit_stats['rejected']}",
+            ]
+            if circuit_stats["state"] == CircuitBreaker.OPEN:
+                circuit_lines.append(f"• 距離探測 / Probe in：{circuit_stats['retry_in']:.0f} 秒")
+            if circuit_stats["last_error"]:
+                circuit_lines.append(f"• 最後錯誤 / Last error：{circuit_stats['last_error'][:200]}")
+            lines.append("\n".join(circuit_lines) + "\n")
+
+            limiter_stats = rate_limiter.stats()
+            lines.append(
+                f"🚦 **LLM 限流 / Rate Limiter**\n"
+                f"• RPM 可用 / available：{limiter_stats['rpm_available']:.0f} / {limiter_stats['rpm_capacity']:.0f}\n"
+                f"• TPM 可用 / available：{limiter_stats['tpm_available']:.0f} / {limiter_stats['tpm_capacity']:.0f}\n"
+                f"• 並行 / In flight：{limiter_stats['in_flight']} / {limiter_stats['concurrency_limit']}（等待 {limiter_stats['waiting']}）\n"
+                f"• 429 次數 / Rate limited：{limiter_stats['rate_limited']}，平均等待 {limiter_stats['average_wait']:.1f} 秒\n"
+            )
+
+            retry_stats = retry_policy.stats()
+            p95_text = f"{retry_stats['p95']:.1f} 秒" if retry_stats['p95'] is not None else "樣本不足 / n/a"
+            lines.append(
+                f"🔁 **重試與對沖 / Retries & Hedging**\n"
+                f"• 請求 / Calls：{retry_stats['calls']}，重試 / Retries：{retry_stats['retries']}，放棄 / Gave up：{retry_stats['giveups']}\n"
+                f"• 對沖 / Hedges：{retry_stats['hedges']}（對沖勝出 / won：{retry_stats['hedge_wins']}）\n"
+                f"• 延遲 p95 / Latency p95：{p95_text}\n"
+            )
+
+            prompt_cache_totals = prompt_cache_stats.totals()
+            prompt_cache_lines = [
+                f"🧠 **Prompt 快取 / Provider Prompt Cache**",
+                f"• 命中 token / Cached tokens：{prompt_cache_totals['cached_tokens']} / {prompt_cache_totals['prompt_tokens']}"
+                f"（{prompt_cache_totals['cached_ratio'] * 100:.1f}%），約節省 / Saved ≈ ${prompt_cache_totals['saved_cost']:.4f}",
+            ]
+            for item in prompt_cache_stats.stats(limit=3):
+                hit_text = f"{item['average_hit_duration']:.1f}" if item["average_hit_duration"] is not None else "-"
+                miss_text = f"{item['average_miss_duration']:.1f}" if item["average_miss_duration"] is not None else "-"
+                prompt_cache_lines.append(
+                    f"• {item['label'][:60]}：命中率 {item['hit_rate'] * 100:.0f}%（{item['requests']} 次），"
+                    f"平均延遲 命中 {hit_text} 秒 / 未命中 {miss_text} 秒"
+                )
+            lines.append("\n".join(prompt_cache_lines) + "\n")
+
+            parse_stats = parser_stats()
+            lines.append(
+                f"🧩 **HTML 解析 / Submission Parser**\n"
+                f"• 快速路徑 / Fast path：{parse_stats['fast']}，完整解析 / Full parse：{parse_stats['full']}"
+                f"（快速路徑 {parse_stats['fast_ratio'] * 100:.0f}%）\n"
+            )
+
+            response_cache = get_response_cache()
+            if response_cache is not None:
+                cache_stats = response_cache.stats()
+                lines.append(
+                    f"⚡ **LLM 快取 / Response Cache**\n"
+                    f"• 命中 / Hits：{cache_stats['memory_hits']} (記憶體) + {cache_stats['disk_hits']} (SQLite)\n"
+                    f"• 未命中 / Misses：{cache_stats['misses']}\n"
+                    f"• 命中率 / Hit rate：{cache_stats['hit_rate'] * 100:.1f}%\n"
+                    f"• 項目數 / Entries：{cache_stats['memory_entries']} (記憶體) / {cache_stats['disk_entries']} (SQLite, "
+                    f"{cache_stats['disk_bytes'] / 1024 / 1024:.1f} MB)"
+                )
+            else:
+                lines.append("⚡ **LLM 快取 / Response Cache**：已停用 / Disabled")
+
+            await message.author.send("\n".join(lines))
+        except Exception as e:
+            await message.author.send(f"❌ 查詢評分系統狀態時發生錯誤：{e}")
+            print(f"❌ show_grading_status 錯誤: {e}")
+            traceback.print_exc()
+
+    async def resume_grading_job(self, job_id, user_id, payload, recoveries):
+        """
+        接手上一個程序未完成的評分工作：使用已保存的上傳檔案重新排隊（不需重新下載附件），
+        並通知學生
+        """
+        html_title = payload.get("html_title", "")
+        attempt_number = payload.get("attempt_number", "?")
+
+        try:
+            user = await self.client.fetch_user(int(user_id))
+        except Exception as e:
+            print(f"❌ 無法取得工作 #{job_id} 的使用者 {user_id}: {e}")
+            self.db.update_grading_job_state(job_id, "failed", f"fetch_user failed: {e}")
+            return
+
+        save_path = payload.get("save_path")
+        if recoveries > GRADING_JOB_MAX_RECOVERIES or not save_path or not os.path.exists(save_path):
+            reason = "too many recoveries" if recoveries > GRADING_JOB_MAX_RECOVERIES else "upload file missing"
+            self.db.update_grading_job_state(job_id, "failed", reason)
+            print(f"🛑 放棄恢復評分工作 #{job_id}：{reason}")
+            try:
+                await user.send(
+                    "⚠️ **評分未完成 / Grading Not Completed**\n\n"
+                    f"📝 題目 / Question：{html_title}\n"
+                    f"🔢 第 {attempt_number} 次提交 / Submission #{attempt_number}\n\n"
+                    "系統重新啟動後無法繼續評分這份作業，請重新上傳。\n"
+                    "The system restarted and could not resume grading this submission. Please upload it again."
+                )
+            except Exception as e:
+                print(f"⚠️ 無法通知使用者 {user_id}: {e}")
+            return
+
+        try:
+            await user.send(
+                "🔁 **評分繼續進行 / Grading Resumed**\n\n"
+                f"📝 題目 / Question：{html_title}\n"
+                f"🔢 第 {attempt_number} 次提交 / Submission #{attempt_number}\n\n"
+                "系統剛重新啟動，您的作業已重新排入評分佇列，不需要重新上傳。\n"
+                "The system restarted. Your submission has been re-queued automatically; no need to upload again."
+            )
+        except Exception as e:
+            print(f"⚠️ 無法通知使用者 {user_id}: {e}")
+
+        job = GradingJob(user, payload, job_id=job_id)
+        await self.grading_queue.submit(job, force=True)
+
+    def record_grading_metrics(self, job, results, timings, file_id=None):
+        """將一份提交的各階段用時、token 數與模型寫入 GradingMetrics"""
+        submission = job.payload
+        usages = [result.get("usage") or {} for result in results.values()]
+        models = sorted({result.get("model") for result in results.values() if result.get("model")})
+        metrics = {
+            "file_id": file_id,
+            "user_id": str(submission["user_id"]),
+            "class_name": submission["class_name"],
+            "question_title": submission["html_title"],
+            "attempt_number": submission["attempt_number"],
+            "model": ",".join(models),
+            "total": time.time() - submission.get("received_at", job.enqueued_at),
+            "prompt_tokens": sum(usage.get("prompt_tokens") or 0 for usage in usages),
+            "completion_tokens": sum(usage.get("completion_tokens") or 0 for usage in usages),
+            "cached_prompt_tokens": sum(result.get("cached_tokens") or 0 for result in results.values()),
+            "cache_hits": sum(1 for result in results.values() if result.get("cached")),
+        }
+        metrics.update({stage: value for stage, value in timings.items() if stage in DatabaseManager.GRADING_METRIC_STAGES})
+        self.db.insert_grading_metrics(metrics)
+
+    async def show_grading_metrics(self, message):
+        """管理員專用：依題目與日期顯示各階段用時的 p50 / p95 / p99（!grading-metrics [天數] [題目]）"""
+        try:
+            parts = message.content.split(maxsplit=2)
+            days = 7
+            question_title = None
+            if len(parts) >= 2:
+                if parts[1].isdigit():
+                    days = int(parts[1])
+                    question_title = parts[2].strip() if len(parts) == 3 else None
+                else:
+                    question_title = message.content.split(maxsplit=1)[1].strip()
+
+            stages = ["queue_wait", "llm_english", "llm_statistics", "report_render", "drive_upload", "total"]
+            summary = self.db.get_grading_metric_percentiles(days, question_title, stages)
+            if not summary:
+                await message.author.send(f"📭 最近 {days} 天沒有評分效能紀錄 / No grading metrics in the last {days} days.")
+                return
+
+            stage_labels = {
+                "queue_wait": "排隊", "llm_english": "英語LLM", "llm_statistics": "統計LLM",
+                "report_render": "報告", "drive_upload": "Drive", "total": "總計",
+            }
+            chunks = []
+            current = f"⏱️ **評分效能 / Grading Metrics**（最近 {days} 天，p50 / p95 / p99 秒）\n"
+            for item in summary:
+                lines = [f"\n📝 **{item['question_title']}** — {item['day']}（{item['count']} 份，{item['tokens']} tokens）"]
+                for stage in stages:
+                    if stage in item["stages"]:
+                        p50, p95, p99 = item["stages"][stage]
+                        lines.append(f"• {stage_labels[stage]}：{p50:.1f} / {p95:.1f} / {p99:.1f}")
+                block = "\n".join(lines)
+                if len(current) + len(block) > 1900:
+                    chunks.append(current)
+                    current = ""
+                current += block
+            chunks.append(current)
+
+            for chunk in chunks:
+                await message.author.send(chunk)
+        except Exception as e:
+            await message.author.send(f"❌ 查詢評分效能時發生錯誤：{e}")
+            print(f"❌ show_grading_metrics 錯誤: {e}")
+            traceback.print_exc()
+
+    @staticmethod
+    def build_timed_out_feedback():
+        """時間預算用完、未完成評分的面向在報告中顯示的內容"""
+        return (
+            "### ⏱️ 評分未完成 / Grading Incomplete\n\n"
+            "此部分的 AI 評分超過時間上限，未能完成。請重新上傳以取得完整評分。\n\n"
+            "This part of the AI grading ran out of time. Please upload again for complete feedback.\n"
+        )
+
+    def build_queue_full_message(self):
+        """評分佇列已滿時給學生的訊息"""
+        return (
+            "🚦 **評分佇列已滿 / Grading Queue Full**\n\n"
+            f"目前有 {self.grading_queue.depth} 份作業正在排隊，系統暫時無法接收新的提交。\n"
+            "請稍後幾分鐘再重新上傳。\n"
+            "Too many submissions are waiting. Please upload again in a few minutes."
+        )
+
+    def build_grading_progress(self, html_title, attempt_number, stage_durations, stage_progress=None):
+        """根據各評分階段的狀態（與串流進度）組出進度訊息內容"""
+        stage_progress = stage_progress or {}
+        stage_labels = {
+            "english": ("📖", "英語評分", "English grading"),
+            "statistics": ("📊", "統計評分", "Statistics grading"),
+        }
+
+        lines = [
+            "🔄 **正在處理您的作業 / Processing Your Homework**\n",
+            f"📝 題目 / Question：{html_title}",
+            f"🔢 第 {attempt_number} 次提交 / Submission #{attempt_number}",
+        ]
+        for stage_name, duration in stage_durations.items():
+            icon, zh_label, en_label = stage_labels.get(stage_name, ("⏳", stage_name, stage_name))
+            if duration is None:
+                lines.append(f"{icon} 正在進行{zh_label}... / {en_label} in progress...")
+                progress = stage_progress.get(stage_name)
+                if progress:
+                    detail = f"    ✍️ 已產生約 {progress['tokens']} tokens"
+                    if progress["sections"]:
+                        detail += f"｜目前段落：{progress['sections'][-1][:60]}"
+                    lines.append(detail)
+            else:
+                lines.append(f"✅ {zh_label}完成 ({duration:.1f}秒)")
+        return "\n".join(lines)
+
     async def process_html_file(self, message, file, user_id):
         """處理 HTML 檔案上傳"""
         try:
@@ -754,15 +1167,63 @@ class HomeworkBot:
                     pass
                 return
 
+            # AI 評分服務中斷且設定為直接拒絕時，不下載也不保存檔案
+            if CIRCUIT_OPEN_POLICY == "reject" and circuit_breaker.state == CircuitBreaker.OPEN:
+                await message.author.send(
+                    "🔌 **AI 評分服務暫時無法使用 / Grading Temporarily Unavailable**\n\n"
+                    f"請約 {max(1, round(circuit_breaker.retry_in() / 60))} 分鐘後再重新上傳。\n"
+                    f"Please upload again in about {max(1, round(circuit_breaker.retry_in() / 60))} minute(s)."
+                )
+                try:
+                    await message.delete()
+                except (discord.Forbidden, discord.NotFound):
+                    pass
+                return
+
+            # 佇列已滿時直接拒絕，不下載也不保存檔案
+            if self.grading_queue.is_full():
+                await message.author.send(self.build_queue_full_message())
+                try:
+                    await message.delete()
+                except (discord.Forbidden, discord.NotFound):
+                    pass
+                return
+
             # 確保目錄存在
             os.makedirs(UPLOADS_DIR, exist_ok=True)
             
-            # 解析 HTML 內容（先保存到臨時檔案）
-            temp_path = os.path.join(UPLOADS_DIR, f"temp_{user_id}_{file.filename}")
-            await file.save(temp_path)
+            # 各階段用時（寫入 GradingMetrics）
+            received_at = time.time()
+            timings = {}
+            budget = TimeBudget(SUBMISSION_TIME_BUDGET)
 
-            html_title = extract_html_title(temp_path)
-            student_name, student_id_from_html, answer_text = extract_html_content(temp_path)
+            # 下載附件到記憶體（只下載一次，解析、本地保存與 Drive 上傳共用）
+            stage_start = time.time()
+            try:
+                # data 為原始檔案（保存與 Drive 上傳），parse_data 為解析用（大型檔案已移除 script/style 與 data URI）
+                data, parse_data = await FileHandler.download_attachment(file, session=self.session)
+            except UploadTooLargeError as e:
+                await message.author.send(
+                    "📦 **檔案過大 / File Too Large**\n\n"
+                    f"上傳的檔案約 {e.size / 1024:.0f} KB，超過上限 {e.max_bytes / 1024:.0f} KB。\n"
+                    f"Your file is about {e.size / 1024:.0f} KB, above the {e.max_bytes / 1024:.0f} KB limit.\n\n"
+                    "請確認上傳的是作答網站匯出的 HTML 檔案。\n"
+                    "Please make sure you uploaded the HTML file exported from the answer website."
+                )
+                try:
+                    await message.delete()
+                except (discord.Forbidden, discord.NotFound):
+                    pass
+                return
+            timings["download"] = time.time() - stage_start
+
+            stage_start = time.time()
+            submission = parse_submission(parse_data)
+            html_title = submission["title"]
+            student_name = submission["student_name"]
+            student_id_from_html = submission["student_id"]
+            answer_text = submission["answer_text"]
+            timings["parse"] = time.time() - stage_start
 
             print(f"📝 HTML 標題: {html_title}")
             print(f"👤 學生姓名: {student_name}")
@@ -774,7 +1235,9 @@ class HomeworkBot:
             print(f"📝 題目標題: {question_title}")
             
             # ✅ 新增：檢查是否有對應的 Prompt
+            stage_start = time.time()
             eng_prompt, stat_prompt = GradingService.get_grading_prompts(html_title)
+            timings["prompt_lookup"] = time.time() - stage_start
             
             # 如果沒有找到 Prompt (回傳 None)，發送尚未更新的訊息
             if eng_prompt is None or stat_prompt is None:
@@ -787,157 +1250,393 @@ class HomeworkBot:
                     f"Please make sure you uploaded the correct homework file, or try again later."
                 )
                 print(f"🛑 題目 '{html_title}' 未設定 Prompt，停止處理")
-                os.remove(temp_path)
                 try: await message.delete()
                 except: pass
                 return
 
-            # 取得嘗試次數
-            max_attempt = self.db.get_max_attempt(user_id, question_title)
-            attempt_number = max_attempt + 1
-            print(f"🔄 嘗試次數: {attempt_number} (Discord ID: {user_id}, 題目: {question_title})")
-
-            # 檢查是否有答案內容
-            if not answer_text or answer_text.strip() == "":
-                await message.author.send(
-                    "📝 **作業內容檢查 / Homework Content Check**\n\n"
-                    "系統在您的 HTML 檔案中沒有找到作答內容。\n"
-                    "System did not find any answer content in your HTML file.\n\n"
-                    "請確認檔案包含完整的作答區域。\n"
-                    "Please ensure the file contains complete answer area."
-                )
-                os.remove(temp_path)
-                try: await message.delete()
-                except: pass
+            # 題目的硬上限：清理後的檔案大小與作答字元數（不論 oversize_policy 都拒絕）
+            try:
+                check_upload_limits(html_title, len(parse_data), answer_text)
+            except UploadLimitError as e:
+                if e.kind == "bytes":
+                    detail = (
+                        f"檔案約 {e.actual / 1024:.0f} KB，超過此題上限 {e.limit / 1024:.0f} KB。\n"
+                        f"Your file is about {e.actual / 1024:.0f} KB, above this question's limit of {e.limit / 1024:.0f} KB.\n\n"
+                        "請移除貼上的圖片或大量格式後重新匯出上傳。\n"
+                        "Please remove pasted images or heavy formatting, export again and re-upload."
+                    )
+                else:
+                    detail = (
+                        f"作答共 {e.actual} 字元，超過此題上限 {e.limit} 字元。\n"
+                        f"Your answer has {e.actual} characters, above this question's limit of {e.limit}.\n\n"
+                        "請精簡作答內容後重新上傳。\n"
+                        "Please shorten your answer and upload again."
+                    )
+                await message.author.send(f"📏 **超過上傳限制 / Upload Limit Exceeded**\n\n{detail}")
+                print(f"🛑 {file.filename} 超過題目 '{html_title}' 的上限（{e}）")
+                try:
+                    await message.delete()
+                except (discord.Forbidden, discord.NotFound):
+                    pass
                 return
 
-            # 建立安全的檔名與路徑
-            safe_class_name = self.get_safe_filename(class_name)
-            folder_name = student_number if student_number else str(db_student_id)
-            safe_folder_name = self.get_safe_filename(folder_name)
-
-            uploads_class_dir = os.path.join(UPLOADS_DIR, safe_class_name)
-            uploads_student_dir = os.path.join(uploads_class_dir, safe_folder_name)
-            reports_class_dir = os.path.join(REPORTS_DIR, safe_class_name)
-            reports_student_dir = os.path.join(reports_class_dir, safe_folder_name)
-
-            os.makedirs(uploads_student_dir, exist_ok=True)
-            os.makedirs(reports_student_dir, exist_ok=True)
-
-            # 保存上傳檔案
-            save_path, drive_id = await FileHandler.save_upload_file(
-                file, 
-                user_id, 
-                uploads_student_dir, 
-                file.filename,
-                html_title,
-                class_name, 
-                student_number or student_id_from_html,
-                db_student_name, 
-                attempt_number,
-            )
+            # 同一學生同一題的上傳依序處理，分配提交次數到放入佇列之間不會與另一份上傳交錯
+            async with self.submission_locks.hold((str(user_id), question_title)):
+                # 還在排隊的同題工作在保存完成後以這次上傳取代（合併），沿用原本的提交次數與排隊位置；
+                # 保存與 Drive 上傳期間工作仍留在佇列中，worker 可照常開始評分
+                merged_job = None
+                if SUBMISSION_MERGE_QUEUED:
+                    merged_job = self.grading_queue.find_pending(user_id, html_title)
+
+                if merged_job is not None:
+                    attempt_number = merged_job.payload.get("attempt_number")
+                    print(f"🔀 準備合併到排隊中的工作 #{merged_job.job_id} (Discord ID: {user_id}, 題目: {question_title})")
+                else:
+                    attempt_number = self.next_attempt_number(user_id, question_title, html_title)
+                print(f"🔄 嘗試次數: {attempt_number} (Discord ID: {user_id}, 題目: {question_title})")
 
-            if save_path is None:
-                # 本地保存失敗
-                await message.author.send("❌ **檔案保存失敗 / File Save Failed**\n\n系統無法保存您的上傳檔案，請稍後再試。\nSystem cannot save your uploaded file, please try again later.")
-                await self.notify_administrators(
-                    "本地保存失敗",
-                    f"用戶: {db_student_name}\n檔案: {file.filename}\n班級: {class_name}\n本地路徑: {save_path}",
-                    severity="warning"
-                )
-                return
+                # 檢查是否有答案內容
+                if not answer_text or answer_text.strip() == "":
+                    await message.author.send(
+                        "📝 **作業內容檢查 / Homework Content Check**\n\n"
+                        "系統在您的 HTML 檔案中沒有找到作答內容。\n"
+                        "System did not find any answer content in your HTML file.\n\n"
+                        "請確認檔案包含完整的作答區域。\n"
+                        "Please ensure the file contains complete answer area."
+                    )
+                    try: await message.delete()
+                    except: pass
+                    return
 
-            if drive_id is None:
-                # Google Drive 上傳失敗
-                await self.notify_administrators(
-                    "Google Drive 上傳失敗",
-                    f"用戶: {db_student_name}\n檔案: {file.filename}\n班級: {class_name}\n本地路徑: {save_path}",
-                    severity="warning"
+                # 評分前檢查：作答長度（依題目設定拒絕、截斷或改用長上下文模型）與預估費用
+                try:
+                    preflight = check_submission(
+                        html_title, [eng_prompt, stat_prompt], db_student_name, answer_text
+                    )
+                except AnswerTooLargeError as e:
+                    await message.author.send(
+                        "📏 **作答內容過長 / Answer Too Long**\n\n"
+                        f"您的作答約 {e.answer_tokens} tokens，超過此題上限 {e.max_tokens} tokens，無法進行評分。\n"
+                        f"Your answer is about {e.answer_tokens} tokens, above this question's limit of {e.max_tokens}.\n\n"
+                        "請精簡作答內容後重新上傳。\n"
+                        "Please shorten your answer and upload again."
+                    )
+                    try: await message.delete()
+                    except: pass
+                    return
+                answer_text = preflight["answer_text"]
+                if preflight["trimmed"]:
+                    await message.author.send(
+                        "✂️ **作答內容過長 / Answer Trimmed**\n\n"
+                        "您的作答超過此題的長度上限，只有前段內容會被評分。\n"
+                        "Your answer exceeds this question's length limit; only the first part will be graded."
+                    )
+
+                # 建立安全的檔名與路徑
+                safe_class_name = self.get_safe_filename(class_name)
+                folder_name = student_number if student_number else str(db_student_id)
+                safe_folder_name = self.get_safe_filename(folder_name)
+
+                uploads_class_dir = os.path.join(UPLOADS_DIR, safe_class_name)
+                uploads_student_dir = os.path.join(uploads_class_dir, safe_folder_name)
+                reports_class_dir = os.path.join(REPORTS_DIR, safe_class_name)
+                reports_student_dir = os.path.join(reports_class_dir, safe_folder_name)
+
+                os.makedirs(uploads_student_dir, exist_ok=True)
+                os.makedirs(reports_student_dir, exist_ok=True)
+
+                # 保存上傳檔案
+                async def save_upload(attempt, filename_suffix=""):
+                    return await FileHandler.save_upload_file(
+                        data,
+                        user_id,
+                        uploads_student_dir,
+                        file.filename,
+                        html_title,
+                        class_name,
+                        student_number or student_id_from_html,
+                        db_student_name,
+                        attempt,
+                        timings=timings,
+                        budget=budget,
+                        # 保留評分（近期 p95 延遲）與報告所需的時間，Drive 上傳只使用其餘部分
+                        budget_reserve=(retry_policy.latency.percentile(95) or SUBMISSION_TIME_BUDGET / 2) + BUDGET_REPORT_RESERVE,
+                        filename_suffix=filename_suffix,
+                    )
+
+                # 準備合併時另存新檔（檔名加上訊息 ID），合併成功前不覆蓋排隊中那份提交的檔案
+                save_path, drive_id = await save_upload(
+                    attempt_number, f"_{message.id}" if merged_job is not None else ""
                 )
 
-            # 檔案成功保存後才刪除上傳訊息
-            try:
-                await message.delete()
-                print("✅ 已刪除上傳訊息")
-            except (discord.Forbidden, discord.NotFound):
-                print("⚠️ 無法刪除上傳訊息（可能權限不足或訊息已被刪除）")
+                if save_path is None:
+                    # 本地保存失敗
+                    await message.author.send("❌ **檔案保存失敗 / File Save Failed**\n\n系統無法保存您的上傳檔案，請稍後再試。\nSystem cannot save your uploaded file, please try again later.")
+                    await self.notify_administrators(
+                        "本地保存失敗",
+                        f"用戶: {db_student_name}\n檔案: {file.filename}\n班級: {class_name}\n本地路徑: {save_path}",
+                        severity="warning"
+                    )
+                    return
+
+                if drive_id is None:
+                    # Google Drive 上傳失敗
+                    await self.notify_administrators(
+                        "Google Drive 上傳失敗",
+                        f"用戶: {db_student_name}\n檔案: {file.filename}\n班級: {class_name}\n本地路徑: {save_path}",
+                        severity="warning"
+                    )
+                elif drive_id == FileHandler.DRIVE_DEFERRED:
+                    # 尚未完成，不視為成功；背景上傳失敗時由 notify_background_upload_failed 通知
+                    print(f"⏳ {file.filename} 的 Drive 上傳仍在背景進行")
+
+                # 檔案成功保存後才刪除上傳訊息
+                try:
+                    await message.delete()
+                    print("✅ 已刪除上傳訊息")
+                except (discord.Forbidden, discord.NotFound):
+                    print("⚠️ 無法刪除上傳訊息（可能權限不足或訊息已被刪除）")
+
+                payload = {
+                    "user_id": user_id,
+                    "db_student_name": db_student_name,
+                    "student_number": student_number,
+                    "student_id_from_html": student_id_from_html,
+                    "class_name": class_name,
+                    "html_title": html_title,
+                    "attempt_number": attempt_number,
+                    "answer_text": answer_text,
+                    "model": preflight["model"],
+                    "answer_trimmed": preflight["trimmed"],
+                    "save_path": save_path,
+                    "drive_id": drive_id,
+                    "reports_student_dir": reports_student_dir,
+                    "timings": timings,
+                    "received_at": received_at,
+                    "deadline": prompt_registry.get_deadline(html_title),
+                    "time_budget": budget.remaining(),
+                }
+                if merged_job is not None:
+                    # 保存完成後才取代排隊中的工作，不重複評分；被取代的檔案（本地與 Drive）一併刪除
+                    superseded = merged_job.payload
+                    if await self.grading_queue.replace_pending(merged_job, payload):
+                        await self.discard_upload(superseded.get("save_path"), superseded.get("drive_id"))
+                        await message.author.send(
+                            "🔀 **已更新排隊中的作業 / Queued Submission Updated**\n\n"
+                            f"您第 {attempt_number} 次提交的作業尚未開始評分，已改用這次上傳的檔案評分，排隊位置不變。\n"
+                            f"Your submission #{attempt_number} had not started grading yet, so it will be graded "
+                            f"using this upload instead. Your queue position is unchanged."
+                        )
+                        return
+
+                    # 保存期間原本的工作已開始評分，無法合併：以新的提交次數重新保存並排入佇列
+                    stale_path, stale_drive_id = save_path, drive_id
+                    attempt_number = self.next_attempt_number(user_id, question_title, html_title)
+                    print(f"🔄 工作 #{merged_job.job_id} 已開始評分，改為第 {attempt_number} 次提交")
+                    save_path, drive_id = await save_upload(attempt_number)
+                    await self.discard_upload(stale_path, stale_drive_id)
+                    if save_path is None:
+                        await message.author.send("❌ **檔案保存失敗 / File Save Failed**\n\n系統無法保存您的上傳檔案，請稍後再試。\nSystem cannot save your uploaded file, please try again later.")
+                        return
+                    payload.update(attempt_number=attempt_number, save_path=save_path, drive_id=drive_id)
+
+                # 放入評分佇列，由固定數量的評分 worker 依序處理
+                job = GradingJob(message.author, payload)
+                try:
+                    await self.grading_queue.submit(job)
+                except QueueFullError:
+                    await message.author.send(self.build_queue_full_message())
+                    # 沒有排入佇列的提交不保留檔案（本地與 Drive）
+                    await self.discard_upload(save_path, drive_id)
+                    print(f"🚫 評分佇列已滿，拒絕 {db_student_name} 的提交")
+
+        except Exception as e:
+            await message.author.send(f"❌ 處理檔案時發生錯誤 / Error processing file：{e}")
+            print(f"❌ _process_html_file 錯誤: {e}")
+            traceback.print_exc()
+
+    async def grade_submission(self, job):
+        """
+        評分佇列 worker 呼叫：執行 AI 評分、生成報告並寫入資料庫
+
+        Returns:
+            bool: 是否完成評分（False 代表已通知學生評分失敗）
+        """
+        user = job.user
+        submission = job.payload
+        user_id = submission["user_id"]
+        db_student_name = submission["db_student_name"]
+        student_number = submission["student_number"]
+        student_id_from_html = submission["student_id_from_html"]
+        class_name = submission["class_name"]
+        html_title = submission["html_title"]
+        attempt_number = submission["attempt_number"]
+        answer_text = submission["answer_text"]
+        model = submission.get("model")
+        save_path = submission["save_path"]
+        reports_student_dir = submission["reports_student_dir"]
+        timings = dict(submission.get("timings") or {})
+        if job.started_at:
+            timings["queue_wait"] = job.started_at - job.enqueued_at
+
+        try:
+            eng_prompt, stat_prompt = GradingService.get_grading_prompts(html_title)
+            if eng_prompt is None or stat_prompt is None:
+                await user.send(f"⚠️ 題目 `{html_title}` 的評分標準已被移除，無法評分。\nGrading criteria for this topic are no longer available.")
+                return False
 
-            # 刪除臨時檔案
-            os.remove(temp_path)
+            # 題目設定 score_schema 時，要求模型在回饋最後附上 JSON 成績
+            score_schemas = get_score_schemas(html_title)
+            if score_schemas:
+                eng_prompt = with_score_instruction(eng_prompt, score_schemas["english"])
+                stat_prompt = with_score_instruction(stat_prompt, score_schemas["statistics"])
 
-            # 發送處理中訊息
-            processing_msg = await message.author.send(
+            # 發送處理中訊息（沿用排隊時的狀態訊息）
+            processing_content = (
                 f"🔄 **正在處理您的作業 / Processing Your Homework**\n\n"
                 f"📝 題目 / Question：{html_title}\n"
                 f"🔢 第 {attempt_number} 次提交 / Submission #{attempt_number}\n"
                 f"⏳ 請稍候，系統正在進行AI評分...\n"
                 f"⏳ Please wait, AI grading in progress..."
             )
+            processing_msg = job.status_msg
+            if processing_msg:
+                await processing_msg.edit(content=processing_content)
+            else:
+                processing_msg = await user.send(processing_content)
 
             # ✅ 記錄開始時間
             start_time = time.time()
+            # 時間預算：沿用收件時剩下的秒數（不含排隊時間），評分、報告與 Drive 上傳共用
+            budget = TimeBudget.resume(submission.get("time_budget"), SUBMISSION_TIME_BUDGET)
+
+            # 各評分階段的完成用時（None 代表仍在進行中）
+            stage_durations = {"english": None, "statistics": None}
+            stage_progress = {}
+            progress_lock = asyncio.Lock()
+            progress_tasks = set()
+            last_progress_edit = [0.0]
+
+            async def update_grading_progress(stage_name=None, duration=None):
+                """依目前各階段狀態更新進度訊息（以鎖避免舊內容覆蓋新內容）"""
+                async with progress_lock:
+                    if stage_name:
+                        stage_durations[stage_name] = duration
+                    last_progress_edit[0] = time.monotonic()
+                    await processing_msg.edit(content=self.build_grading_progress(
+                        html_title, attempt_number, stage_durations, stage_progress
+                    ))
+
+            async def refresh_stream_progress():
+                try:
+                    await update_grading_progress()
+                except Exception as e:
+                    print(f"⚠️ 更新串流進度失敗: {e}")
+
+            def stream_progress_callback(stage_name):
+                """串流回呼：記錄進度，並以 LLM_STREAM_PROGRESS_INTERVAL 節流編輯訊息（不阻塞串流讀取）"""
+                def on_progress(progress):
+                    stage_progress[stage_name] = progress
+                    if progress_lock.locked():
+                        return
+                    if time.monotonic() - last_progress_edit[0] < LLM_STREAM_PROGRESS_INTERVAL:
+                        return
+                    last_progress_edit[0] = time.monotonic()
+                    task = asyncio.create_task(refresh_stream_progress())
+                    progress_tasks.add(task)
+                    task.add_done_callback(progress_tasks.discard)
+                return on_progress
 
             try:
                 # 更新進度
-                await processing_msg.edit(content=
-                    f"🔄 **正在處理您的作業 / Processing Your Homework**\n\n"
-                    f"📝 題目 / Question：{html_title}\n"
-                    f"🔢 第 {attempt_number} 次提交 / Submission #{attempt_number}\n"
-                    f"📖 正在進行英語評分...\n"
-                    f"📖 English grading in progress..."
-                )
+                await update_grading_progress()
                 
-                # 評分開始
+                # 評分開始：英語與統計評分互不相依，同時進行
                 print("評分開始")
-                eng_start = time.time()
-                
-                # 執行英語評分
-                messages_eng = GradingService.create_messages(eng_prompt, db_student_name, answer_text)
-                eng_feedback = await asyncio.wait_for(
-                    GradingService.generate_feedback(messages_eng),
-                    timeout=300.0
-                )
-                
-                # ✅ 計算英語評分用時
-                eng_duration = time.time() - eng_start
-                print(f"✅ 英語評分完成 (用時: {eng_duration:.2f}秒)")
-                
-                # 更新進度
-                await processing_msg.edit(content=
-                    f"🔄 **正在處理您的作業 / Processing Your Homework**\n\n"
-                    f"📝 題目 / Question：{html_title}\n"
-                    f"🔢 第 {attempt_number} 次提交 / Submission #{attempt_number}\n"
-                    f"✅ 英語評分完成 ({eng_duration:.1f}秒)\n"
-                    f"📊 正在進行統計評分...\n"
-                    f"📊 Statistics grading in progress..."
+                # 各面向依題目設定選擇模型、輸出上限、期限與備援模型，期限不超過剩餘的時間預算
+                available = budget.timeout(reserve=BUDGET_REPORT_RESERVE)
+                eng_settings = fit_to_budget(get_model_settings(html_title, "english", model), available)
+                stat_settings = fit_to_budget(get_model_settings(html_title, "statistics", model), available)
+                pipeline = GradingPipeline()
+                pipeline.add_stage(
+                    "english",
+                    lambda: GradingService.grade(
+                        eng_prompt, db_student_name, answer_text,
+                        model=eng_settings["model"],
+                        temperature=eng_settings["temperature"],
+                        timeout=eng_settings["timeout"],
+                        max_output_tokens=eng_settings["max_output_tokens"],
+                        fallback_model=eng_settings["fallback_model"],
+                        on_progress=stream_progress_callback("english"),
+                        prompt_label=f"{html_title} / english",
+                    ),
+                    timeout=min(stage_timeout(eng_settings), available),
                 )
-
-                # ✅ 統計評分開始時間
-                stat_start = time.time()
-                
-                # 執行統計評分
-                messages_stat = GradingService.create_messages(stat_prompt, db_student_name, answer_text)
-                stats_feedback = await asyncio.wait_for(
-                    GradingService.generate_feedback(messages_stat),
-                    timeout=300.0
+                pipeline.add_stage(
+                    "statistics",
+                    lambda: GradingService.grade(
+                        stat_prompt, db_student_name, answer_text,
+                        model=stat_settings["model"],
+                        temperature=stat_settings["temperature"],
+                        timeout=stat_settings["timeout"],
+                        max_output_tokens=stat_settings["max_output_tokens"],
+                        fallback_model=stat_settings["fallback_model"],
+                        on_progress=stream_progress_callback("statistics"),
+                        prompt_label=f"{html_title} / statistics",
+                    ),
+                    timeout=min(stage_timeout(stat_settings), available),
                 )
-                
-                # ✅ 計算統計評分用時
-                stat_duration = time.time() - stat_start
-                print(f"✅ 統計評分完成 (用時: {stat_duration:.2f}秒)")
+                try:
+                    # 時間用完時保留已完成面向的回饋（部分評分），不整份失敗
+                    results = await pipeline.run(
+                        on_stage_done=update_grading_progress,
+                        allow_partial=SUBMISSION_PARTIAL_FEEDBACK,
+                        timeout_errors=(asyncio.TimeoutError, openai.error.Timeout),
+                    )
+                finally:
+                    # 等待尚未送出的串流進度更新，避免舊進度覆蓋後續訊息
+                    if progress_tasks:
+                        await asyncio.gather(*progress_tasks, return_exceptions=True)
+
+                partial = bool(pipeline.timed_out)
+                eng_feedback = results["english"]["feedback"] if "english" in results else self.build_timed_out_feedback()
+                stats_feedback = results["statistics"]["feedback"] if "statistics" in results else self.build_timed_out_feedback()
+
+                # 取出並驗證 JSON 成績；無效時改從生成的報告解析（JSON 區塊不會出現在報告中）
+                structured_scores = None
+                if score_schemas and partial:
+                    eng_feedback = split_score_block(eng_feedback)[0]
+                    stats_feedback = split_score_block(stats_feedback)[0]
+                elif score_schemas:
+                    try:
+                        eng_feedback, eng_scores = parse_structured_scores("english", eng_feedback, score_schemas["english"])
+                        stats_feedback, stat_scores = parse_structured_scores("statistics", stats_feedback, score_schemas["statistics"])
+                        structured_scores = {"english": eng_scores, "statistics": stat_scores}
+                    except ScoreValidationError as e:
+                        print(f"⚠️ 結構化成績無效，改從報告解析: {e}")
+                        eng_feedback = split_score_block(eng_feedback)[0]
+                        stats_feedback = split_score_block(stats_feedback)[0]
+                stage_lines = ""
+                for stage_name, label in (("english", "英語"), ("statistics", "統計")):
+                    if stage_name in results:
+                        timings[f"llm_{stage_name}"] = pipeline.durations[stage_name]
+                        stage_lines += f"✅ {label}評分完成 ({pipeline.durations[stage_name]:.1f}秒)\n"
+                    else:
+                        stage_lines += f"⏱️ {label}評分超過時間上限 / {stage_name.title()} grading ran out of time\n"
+                print(f"✅ 評分完成 (完成: {', '.join(results)}，超時: {', '.join(pipeline.timed_out) or '無'}，合計: {pipeline.total_duration:.2f}秒)")
                 
                 # 更新進度
                 await processing_msg.edit(content=
                     f"🔄 **正在處理您的作業 / Processing Your Homework**\n\n"
                     f"📝 題目 / Question：{html_title}\n"
                     f"🔢 第 {attempt_number} 次提交 / Submission #{attempt_number}\n"
-                    f"✅ 英語評分完成 ({eng_duration:.1f}秒)\n"
-                    f"✅ 統計評分完成 ({stat_duration:.1f}秒)\n"
+                    f"{stage_lines}"
                     f"📄 正在生成報告...\n"
                     f"📄 Generating report..."
                 )
                 
                 # ✅ 修正：使用 FileHandler.generate_and_save_report
+                rendered_report = {}
                 report_path, report_filename, report_drive_id = await FileHandler.generate_and_save_report(
                     db_student_name=db_student_name,
                     student_number=student_number,
@@ -950,35 +1649,52 @@ class HomeworkBot:
                     reports_student_dir=reports_student_dir,
                     class_name=class_name,
                     student_id=student_number or student_id_from_html,
+                    timings=timings,
+                    rendered=rendered_report,
+                    budget=budget,
                 )
 
                 if not report_path:
                     await processing_msg.edit(content="❌ 報告生成失敗 / Report generation failed")
-                    return
+                    return False
+                if report_drive_id is None:
+                    await self.notify_administrators(
+                        "Google Drive 報告上傳失敗",
+                        f"用戶: {db_student_name}\n題目: {html_title}\n班級: {class_name}\n本地路徑: {report_path}",
+                        severity="warning"
+                    )
                 
                 # ✅ 計算總用時
                 total_duration = time.time() - start_time
+                partial_note = (
+                    "⚠️ 部分面向未能在時間內完成評分，報告中已標示；可重新上傳以取得完整評分。\n"
+                    "⚠️ Part of the grading ran out of time and is marked in the report; upload again for full feedback.\n\n"
+                ) if partial else ""
                 
                 # 發送完成訊息（包含用時資訊）
                 await processing_msg.edit(content=
                     f"✅ **作業處理完成 / Homework Processing Complete**\n\n"
                     f"📝 題目 / Question：{html_title}\n"
                     f"🔢 第 {attempt_number} 次提交 / Submission #{attempt_number}\n"
-                    f"✅ 英語評分完成 ({eng_duration:.1f}秒)\n"
-                    f"✅ 統計評分完成 ({stat_duration:.1f}秒)\n"
+                    f"{stage_lines}"
                     f"✅ 報告已生成\n"
                     f"⏱️ 總處理時間 / Total time：{total_duration:.1f} 秒\n\n"
+                    f"{partial_note}"
                     f"📊 評分報告已保存，您可以使用 `!my-submissions` 查看所有提交記錄\n"
                     f"📊 Grading report saved, use `!my-submissions` to view all submissions"
                 )
                 
                 # 發送報告文件
                 with open(report_path, 'rb') as f:
-                    await message.author.send(
+                    await user.send(
                         f"📄 **評分報告 / Grading Report**",
                         file=discord.File(f, filename=report_filename)
                     )
 
+            except CircuitOpenError:
+                # 斷路器開啟：交給評分佇列延後重新評分，不個別通知管理員
+                raise
+
             except (asyncio.TimeoutError, openai.error.Timeout) as e:
                 # ✅ 超時錯誤也顯示已用時間
                 elapsed_time = time.time() - start_time
@@ -1002,7 +1718,7 @@ class HomeworkBot:
                         os.remove(save_path)
                 except:
                     pass
-                return
+                return False
 
             except openai.error.InvalidRequestError as e:
                 # 處理無效請求錯誤
@@ -1014,7 +1730,7 @@ class HomeworkBot:
                     f"用戶: {db_student_name}\n題目: {html_title}\n錯誤: {e}",
                     severity="error"
                 )
-                return
+                return False
 
             except Exception as e:
                 await processing_msg.edit(content=f"❌ 評分過程發生錯誤 / Error during grading：{e}")
@@ -1027,17 +1743,20 @@ class HomeworkBot:
                     error_details=str(e),
                     severity="error"
                 )
-                return
+                return False
 
             # ========== 即時解析成績與寫入資料庫 ==========
             print(f"💾 正在解析成績並寫入資料庫...")
             try:
-                # 讀取剛剛生成的 HTML 報告檔案進行成績解析
-                with open(report_path, "r", encoding="utf-8") as f:
-                    html_content = f.read()
-                
-                parsed_data, ordered_keys = extract_scores_from_html_string(html_content)
+                if structured_scores is not None:
+                    # 模型回傳並通過驗證的 JSON 成績，直接寫入
+                    parsed_data, ordered_keys = to_parsed_scores(structured_scores)
+                    print(f"🧮 使用結構化成績（{len(ordered_keys)} 個欄位）")
+                else:
+                    # 解析記憶體中剛生成的 HTML 報告（不再從磁碟讀回）
+                    parsed_data, ordered_keys = extract_scores_from_html_string(rendered_report.get("html", ""))
                 
+                db_write_start = time.time()
                 db_insert_success = self.db.insert_submission(
                     discord_id=user_id,
                     student_name=db_student_name,
@@ -1048,6 +1767,10 @@ class HomeworkBot:
                     parsed_scores=parsed_data,  # 傳入成績字典
                     score_keys=ordered_keys     # 傳入欄位順序
                 )
+                timings["db_write"] = time.time() - db_write_start
+                self.record_grading_metrics(
+                    job, results, timings, file_id=db_insert_success or None
+                )
                 
                 if db_insert_success:
                     print(f"✅ 提交記錄已成功寫入資料庫")
@@ -1081,21 +1804,46 @@ class HomeworkBot:
                 )
             
             # ========== 結束資料庫寫入 ==========
+            return True
 
+        except CircuitOpenError:
+            raise
         except Exception as e:
-            await message.author.send(f"❌ 處理檔案時發生錯誤 / Error processing file：{e}")
-            print(f"❌ _process_html_file 錯誤: {e}")
+            await user.send(f"❌ 處理檔案時發生錯誤 / Error processing file：{e}")
+            print(f"❌ grade_submission 錯誤: {e}")
             traceback.print_exc()
+            return False
+
+    async def shutdown(self):
+        """
+        機器人關閉時的清理工作：停止評分佇列並釋放租約，再關閉連線與資料庫
 
-    async def on_close(self):
-        """機器人關閉時的清理工作"""
+        discord.py 沒有 on_close 事件，由 start() 在 client.start() 結束後（含中斷）呼叫
+        """
+        if self.prompt_refresh_task:
+            self.prompt_refresh_task.cancel()
+        await self.grading_queue.stop()
         if self.session:
             await self.session.close()
+        await get_chat_client().close()
+        close_response_cache()
         self.db.close()
 
+    async def start(self):
+        """連線 Discord 直到斷線或中斷，結束時一定執行 shutdown()"""
+        discord.utils.setup_logging()
+        try:
+            async with self.client:
+                await self.client.start(DISCORD_TOKEN)
+        finally:
+            await self.shutdown()
+
     def run(self):
         """啟動機器人"""
-        self.client.run(DISCORD_TOKEN)
+        try:
+            asyncio.run(self.start())
+        except KeyboardInterrupt:
+            print("👋 機器人已停止")
 
     async def assign_role_after_login(self, user, class_name):
         """登入成功後自動分配身分組"""
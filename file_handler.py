@@ -1,14 +1,22 @@
 import os
 import re
+import time
 import asyncio
+import codecs
+import io
 import unicodedata
 from concurrent.futures import ThreadPoolExecutor
+import aiohttp
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
-from config import UPLOADS_FOLDER_ID, REPORTS_FOLDER_ID, UPLOADS_DIR, REPORTS_DIR
+from config import (
+    UPLOADS_FOLDER_ID, REPORTS_FOLDER_ID, UPLOADS_DIR, REPORTS_DIR, BUDGET_DRIVE_MIN_SECONDS, MAX_UPLOAD_BYTES,
+    UPLOAD_STREAM_THRESHOLD, UPLOAD_DOWNLOAD_TIMEOUT,
+)
+from html_parser import HtmlSanitizer
 from report_generator import generate_html_report
 
 SCOPES = ["https://www.googleapis.com/auth/drive.file"]
@@ -41,9 +49,23 @@ def get_oauth_creds():
     return creds
 
 
+class UploadTooLargeError(Exception):
+    """上傳的附件超過 MAX_UPLOAD_BYTES"""
+
+    def __init__(self, size, max_bytes):
+        super().__init__(f"attachment is {size} bytes, above the {max_bytes} byte limit")
+        self.size = size
+        self.max_bytes = max_bytes
+
+
 class FileHandler:
     # 類別層級的執行緒池（用於 Google Drive 操作）
     _executor = ThreadPoolExecutor(max_workers=3)
+    # 時間預算不足、改在背景完成的 Drive 上傳
+    DRIVE_DEFERRED = "deferred"
+    _background_uploads = set()
+    # async 回呼 (filename, question_title, class_name, student_id, error)：背景上傳失敗時呼叫（由機器人設定為通知管理員）
+    on_background_upload_failed = None
     
     def __init__(self):
         self.drive_service = None
@@ -165,7 +187,11 @@ class FileHandler:
             # 4. 上傳檔案到學號資料夾
             file_metadata = {"name": filename, "parents": [student_folder_id]}
 
-            media = MediaFileUpload(file_path, mimetype="text/html", resumable=True)
+            # 已在記憶體中的內容直接上傳，不必先寫入再讀回檔案
+            if isinstance(file_path, bytes):
+                media = MediaIoBaseUpload(io.BytesIO(file_path), mimetype="text/html", resumable=True)
+            else:
+                media = MediaFileUpload(file_path, mimetype="text/html", resumable=True)
             file = self.drive_service.files().create(
                 body=file_metadata,
                 media_body=media,
@@ -181,6 +207,25 @@ class FileHandler:
             traceback.print_exc()
             return None
 
+    def _delete_from_drive_sync(self, file_id):
+        """同步版本：刪除 Google Drive 上的檔案（在執行緒池中執行）"""
+        if not self.drive_service:
+            print("❌ Google Drive 服務未初始化")
+            return False
+
+        try:
+            self.drive_service.files().delete(fileId=file_id).execute()
+            print(f"🗑️ 已刪除 Google Drive 檔案: {file_id}")
+            return True
+        except Exception as e:
+            print(f"❌ 刪除 Google Drive 檔案失敗: {e}")
+            return False
+
+    async def delete_from_drive(self, file_id):
+        """刪除 Google Drive 上的檔案（例如被新上傳取代的作業檔案）"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, self._delete_from_drive_sync, file_id)
+
     # 新增方法：徹底清理資料夾名稱
     def _clean_folder_name(self, name):
         """徹底清理名稱，移除所有隱藏字元和不一致性"""
@@ -201,7 +246,7 @@ class FileHandler:
         上傳檔案到 Google Drive
         
         Args:
-            file_path: 本地檔案路徑
+            file_path: 本地檔案路徑，或檔案內容（bytes，直接從記憶體上傳）
             filename: 檔案名稱
             question_title: 題目標題
             class_name: 班級名稱
@@ -238,6 +283,56 @@ class FileHandler:
             print(f"❌ 上傳{file_type}到 Google Drive 失敗: {e}")
             raise
 
+    async def upload_within_budget(self, budget, file_path, filename, question_title, class_name, student_id,
+                                   is_report=False, reserve=0.0):
+        """
+        在時間預算內上傳到 Google Drive
+
+        剩餘時間（扣除 reserve）不足 BUDGET_DRIVE_MIN_SECONDS，或上傳超過剩餘時間時，
+        不再等待、改在背景完成上傳，回傳 DRIVE_DEFERRED
+
+        Returns:
+            str: 檔案 ID、DRIVE_DEFERRED（仍在背景上傳，不代表成功；失敗時由 on_background_upload_failed 通知）
+                 或 None（上傳失敗）
+        """
+        upload = asyncio.ensure_future(
+            self.upload_to_drive(file_path, filename, question_title, class_name, student_id, is_report)
+        )
+        if budget is None:
+            return await upload
+
+        wait = budget.timeout(reserve=reserve)
+        if wait >= BUDGET_DRIVE_MIN_SECONDS:
+            try:
+                return await asyncio.wait_for(asyncio.shield(upload), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+        print(f"⏳ 時間預算不足，{filename} 的 Drive 上傳改在背景完成")
+        FileHandler._background_uploads.add(upload)
+        upload.add_done_callback(
+            lambda task: FileHandler._on_background_upload_done(task, filename, question_title, class_name, student_id)
+        )
+        return FileHandler.DRIVE_DEFERRED
+
+    @staticmethod
+    def _on_background_upload_done(task, filename, question_title, class_name, student_id):
+        """背景上傳結束：失敗（例外或回傳 None）時交給 on_background_upload_failed 通知管理員"""
+        FileHandler._background_uploads.discard(task)
+        if task.cancelled():
+            error = "cancelled"
+        elif task.exception() is not None:
+            error = str(task.exception())
+        elif task.result() is None:
+            error = "upload returned no file id"
+        else:
+            return
+
+        print(f"❌ 背景 Drive 上傳失敗: {filename} ({error})")
+        callback = FileHandler.on_background_upload_failed
+        if callback is not None:
+            task.get_loop().create_task(callback(filename, question_title, class_name, student_id, error))
+
     @staticmethod
     def get_safe_filename(text):
         """生成安全的檔案名稱"""
@@ -249,8 +344,14 @@ class FileHandler:
         return safe_text
 
     @staticmethod
-    async def save_upload_file(file, user_id, uploads_student_dir, filename, question_title, class_name, student_id, db_student_name, attempt_number):
-        """保存上傳檔案到本地，然後上傳到 Google Drive"""
+    async def save_upload_file(data, user_id, uploads_student_dir, filename, question_title, class_name, student_id, db_student_name, attempt_number, timings=None,
+                               budget=None, budget_reserve=0.0, filename_suffix=""):
+        """
+        保存上傳檔案到本地，然後上傳到 Google Drive（提供 timings 時記錄 Drive 上傳用時）
+        data 是已下載的檔案內容（bytes），本地寫入與 Drive 上傳共用同一份，不再重新下載
+        提供 budget（TimeBudget）時，Drive 上傳只等待到剩餘時間扣除 budget_reserve，其餘在背景完成
+        filename_suffix 會加在檔名最後，避免覆蓋同一次提交已保存的檔案（例如合併前的上傳）
+        """
         try:
             # 對從 HTML 抓取或傳入的名稱進行 strip
             filename = filename.strip() if filename else filename
@@ -270,23 +371,32 @@ class FileHandler:
             os.makedirs(uploads_student_dir, exist_ok=True)
 
             # 生成新的檔案名稱：學號_班級_姓名_標題_次數
-            new_filename = f"{student_id}_{class_name}_{db_student_name}_{safe_question}_第{attempt_number}次.html"
+            new_filename = f"{student_id}_{class_name}_{db_student_name}_{safe_question}_第{attempt_number}次{filename_suffix}.html"
             local_path = os.path.join(uploads_student_dir, new_filename)
 
-            # 保存到本地
-            await file.save(local_path)
+            # 保存到本地（在執行緒池中寫入）
+            def write_file():
+                with open(local_path, "wb") as f:
+                    f.write(data)
+
+            await asyncio.get_event_loop().run_in_executor(FileHandler._executor, write_file)
             print(f"✅ 檔案已保存到本地: {local_path}")
 
             # 上傳到 Google Drive（非同步）
+            drive_start = time.time()
             handler = FileHandler()
-            drive_id = await handler.upload_to_drive(
-                local_path,
+            drive_id = await handler.upload_within_budget(
+                budget,
+                data,
                 new_filename,
                 question_title,
                 class_name,
                 student_id,
-                is_report=False  # 明確指定為作業檔案
+                is_report=False,  # 明確指定為作業檔案
+                reserve=budget_reserve,
             )
+            if timings is not None:
+                timings["drive_upload"] = timings.get("drive_upload", 0.0) + time.time() - drive_start
             
             return local_path, drive_id
         except Exception as e:
@@ -308,8 +418,19 @@ class FileHandler:
         reports_student_dir,
         class_name,
         student_id,
+        upload=True,
+        timings=None,
+        rendered=None,
+        budget=None,
+        report_suffix="",
     ):
-        """生成並保存 HTML 報告到本地和 Google Drive"""
+        """
+        生成並保存 HTML 報告到本地和 Google Drive（upload=False 時只保存本地）
+        report_suffix 會加在檔名最後（例如重新評分的報告），避免覆蓋原本的報告
+        提供 timings 時記錄報告生成（report_render）與 Drive 上傳（drive_upload）用時
+        提供 rendered（dict）時放入生成的 HTML（rendered["html"]），呼叫端不必再讀回檔案
+        提供 budget（TimeBudget）時，剩餘時間不足的 Drive 上傳改在背景完成
+        """
         try:
             # ✅ 修改：建立與雲端相同的目錄結構
             # REPORTS_DIR / question_title / class_name / student_id
@@ -322,6 +443,7 @@ class FileHandler:
             os.makedirs(reports_student_dir, exist_ok=True)
 
             # 生成 HTML 報告（在執行緒池中執行，避免阻塞）
+            render_start = time.time()
             loop = asyncio.get_event_loop()
             html_report = await loop.run_in_executor(
                 FileHandler._executor,
@@ -337,7 +459,7 @@ class FileHandler:
 
             # 保存報告檔案到本地
             safe_question = FileHandler.get_safe_filename(question_title)
-            report_filename = f"{student_number or student_id_from_html}_{db_student_name}_{safe_question}_第{attempt_number}次.html"
+            report_filename = f"{student_number or student_id_from_html}_{db_student_name}_{safe_question}_第{attempt_number}次{report_suffix}.html"
             local_path = os.path.join(reports_student_dir, report_filename)
 
             # 寫入檔案（非同步）
@@ -347,18 +469,29 @@ class FileHandler:
                 return local_path
 
             local_path = await loop.run_in_executor(FileHandler._executor, write_file)
+            if rendered is not None:
+                rendered["html"] = html_report
             print(f"✅ 報告已保存到本地: {local_path}")
+            if timings is not None:
+                timings["report_render"] = time.time() - render_start
+
+            if not upload:
+                return local_path, report_filename, None
 
             # 上傳到 Google Drive（非同步）
+            drive_start = time.time()
             handler = FileHandler()
-            drive_id = await handler.upload_to_drive(
-                local_path,
+            drive_id = await handler.upload_within_budget(
+                budget,
+                html_report.encode("utf-8"),
                 report_filename,
                 question_title,
                 class_name,
                 student_id,
                 is_report=True
             )
+            if timings is not None:
+                timings["drive_upload"] = timings.get("drive_upload", 0.0) + time.time() - drive_start
 
             return local_path, report_filename, drive_id
         except Exception as e:
@@ -368,12 +501,53 @@ class FileHandler:
             return None, None, None
 
     @staticmethod
-    async def download_attachment(attachment):
-        """下載 Discord 附件到臨時檔案"""
-        try:
-            temp_path = os.path.join(UPLOADS_DIR, f"temp_{attachment.filename}")
-            await attachment.save(temp_path)
-            return temp_path
-        except Exception as e:
-            print(f"❌ 下載附件失敗: {e}")
-            return None
+    async def download_attachment(attachment, max_bytes=MAX_UPLOAD_BYTES, session=None,
+                                  stream_threshold=UPLOAD_STREAM_THRESHOLD):
+        """
+        將 Discord 附件讀入記憶體（只下載一次，本地保存與 Drive 上傳使用原始內容）
+
+        超過 stream_threshold 且提供 session 時改為串流下載，邊下載邊產生移除 <script>、<style>
+        與 data URI 的清理版本，只交給解析器使用
+
+        Returns:
+            (bytes, bytes): 原始內容（保存與上傳用）、解析用內容（未串流時與原始內容相同）
+
+        Raises:
+            UploadTooLargeError: 附件（依 attachment.size 或實際下載量）超過 max_bytes
+        """
+        if attachment.size and attachment.size > max_bytes:
+            raise UploadTooLargeError(attachment.size, max_bytes)
+        if session is not None and attachment.size and attachment.size > stream_threshold:
+            return await FileHandler._stream_attachment(attachment, max_bytes, session)
+        data = await attachment.read()
+        if len(data) > max_bytes:
+            raise UploadTooLargeError(len(data), max_bytes)
+        return data, data
+
+    @staticmethod
+    async def _stream_attachment(attachment, max_bytes, session):
+        """串流下載附件並產生清理後的解析用版本，實際下載量超過 max_bytes 時立即中止"""
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        sanitizer = HtmlSanitizer()
+        raw_parts = []
+        parts = []
+        received = 0
+        timeout = aiohttp.ClientTimeout(total=UPLOAD_DOWNLOAD_TIMEOUT)
+        async with session.get(attachment.url, timeout=timeout) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                received += len(chunk)
+                if received > max_bytes:
+                    raise UploadTooLargeError(received, max_bytes)
+                raw_parts.append(chunk)
+                parts.append(sanitizer.feed(decoder.decode(chunk)))
+        parts.append(sanitizer.feed(decoder.decode(b"", final=True)))
+        parts.append(sanitizer.close())
+
+        raw = b"".join(raw_parts)
+        parse_data = "".join(parts).encode("utf-8")
+        print(
+            f"🧹 已串流清理 {attachment.filename}：{received / 1024:.0f} KB → 解析 {len(parse_data) / 1024:.0f} KB"
+            f"（移除 {sanitizer.removed_blocks} 個 script/style、{sanitizer.removed_uris} 個 data URI）"
+        )
+        return raw, parse_data
@@ -1,72 +1,40 @@
-import json
-import re
-import openai
-import os
-import datetime
+import time
 import docx
 import markdown
-import asyncio
-from concurrent.futures import ThreadPoolExecutor
-from config import OPENAI_API_KEY, MODEL, SPECIFIC_PROMPTS
+from config import MODEL, LLM_STREAMING_ENABLED, LLM_PROMPT_CACHE_KEY_ENABLED
+from llm_client import get_chat_client
+from circuit_breaker import CircuitOpenError, circuit_breaker
+from llm_retry import is_retryable, retry_policy
+from prompt_cache import cached_tokens_from_usage, make_prompt_cache_key, prompt_cache_stats
+from prompt_registry import prompt_registry
+from response_cache import ResponseCache, get_response_cache
 
 
 class GradingService:
-    # ✅ 修改 1: 增加執行緒數量，避免一兩個卡住就全掛
-    _executor = ThreadPoolExecutor(max_workers=5)
-    
     @staticmethod
     def get_grading_prompts(question_title=None):
         """
-        Get grading prompts from config.py based on question title
+        Get grading prompts from the in-memory prompt registry based on question title
         Returns: 
             (eng_prompt, stat_prompt) or (None, None) if not found
         """
         # 如果沒有提供題目標題，直接返回 None
         if not question_title:
             return None, None
-        
+
+        # 尚未預載入（例如獨立腳本）時才讀取磁碟
+        if not prompt_registry.loaded:
+            prompt_registry.load()
+
         # 檢查是否有該題目的特定 prompt
-        if question_title in SPECIFIC_PROMPTS:
-            prompt_config = SPECIFIC_PROMPTS[question_title]
-            
-            # 確保 prompt_config 是字典
-            if isinstance(prompt_config, dict):
-                eng_prompt_file = prompt_config.get("english")
-                stat_prompt_file = prompt_config.get("statistics")
-                print(f"🎯 題目 '{question_title}' 找到專屬 Prompt")
-            else:
-                print(f"⚠️ 警告：題目 '{question_title}' 的 prompt 配置格式錯誤")
-                return None, None
-        else:
+        if prompt_registry.get_entry(question_title) is None:
             print(f"ℹ️ 題目 '{question_title}' 尚未設定 Prompt，停止評分")
             return None, None
-        
-        # 讀取 prompt 檔案內容
-        eng_prompt = GradingService._read_prompt_file(eng_prompt_file)
-        stat_prompt = GradingService._read_prompt_file(stat_prompt_file)
-        
-        if not eng_prompt or not stat_prompt:
-            print(f"❌ 無法讀取 prompt 檔案: eng={eng_prompt_file}, stat={stat_prompt_file}")
-            return None, None
-        
-        return eng_prompt, stat_prompt
 
-    @staticmethod
-    def _read_prompt_file(file_path):
-        """
-        Read prompt content from file
-        """
-        if not file_path or not os.path.exists(file_path):
-            print(f"❌ Prompt 檔案不存在: {file_path}")
-            return None
-        
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-                return content
-        except Exception as e:
-            print(f"❌ 讀取 prompt 檔案失敗: {file_path}, 錯誤: {e}")
-            return None
+        eng_prompt, stat_prompt = prompt_registry.get_prompts(question_title)
+        if eng_prompt and stat_prompt:
+            print(f"🎯 題目 '{question_title}' 找到專屬 Prompt")
+        return eng_prompt, stat_prompt
 
     # ---------- Student Data Extraction ----------
     @staticmethod
@@ -84,15 +52,21 @@ class GradingService:
         return name, answer
 
     # ---------- OpenAI Interaction ----------
+    # 每份作業都相同的指示放在學生資料之前，讓共用前綴盡量長
+    USER_INSTRUCTION = "Please evaluate the student's performance according to the system instructions."
+
     @staticmethod
     def create_messages(prompt, student_name, student_answer):
         """
         Construct messages for ChatGPT: system prompt + student data.
+
+        system prompt 原樣放在第一則、固定指示緊接在後，每份作業不同的姓名與作答只出現在最後，
+        同一題的請求因此擁有相同的前綴，能命中供應商端的 prompt 快取
         """
         user_msg = (
+            f"{GradingService.USER_INSTRUCTION}\n\n"
             f"Student Name: {student_name}\n"
-            f"Student Answer:\n{student_answer}\n"
-            "Please evaluate the student's performance according to the system instructions."
+            f"Student Answer:\n{student_answer}"
         )
         return [
             {"role": "system", "content": prompt},
@@ -100,46 +74,109 @@ class GradingService:
         ]
 
     @staticmethod
-    def _generate_feedback_sync(messages, model=None, temperature=1.0):
-        """同步呼叫 OpenAI API（在執行緒池中執行）"""
-        import openai
-        
+    async def generate_feedback(messages, model=None, temperature=1.0, timeout=None, on_progress=None):
+        """
+        非同步生成評分反饋（透過共用連線池的 aiohttp 客戶端，不佔用執行緒）
+        暫時性錯誤會依 retry_policy 退避重試，timeout 為所有嘗試共用的期限
+        斷路器開啟時直接拋出 CircuitOpenError，不送出請求
+        提供 on_progress 且啟用串流時，會在收到內容的同時回報進度
+        """
+        response = await GradingService.request_completion(messages, model, temperature, timeout, on_progress)
+        return response["choices"][0]["message"]["content"]
+
+    @staticmethod
+    async def request_completion(messages, model=None, temperature=1.0, timeout=None, on_progress=None, **extra_params):
+        """與 generate_feedback 相同，但回傳完整的 API 回應（包含 usage）；extra_params 直接放入請求 body"""
+        if not LLM_STREAMING_ENABLED:
+            on_progress = None
+
         if model is None:
             model = MODEL
-        
-        openai.api_key = OPENAI_API_KEY
-        
-        try:
-            response = openai.ChatCompletion.create(
-                model=model,
-                messages=messages,
-                temperature=temperature,
-                request_timeout=290  # 設定超時
+
+        client = get_chat_client()
+        response = await circuit_breaker.call(
+            lambda: retry_policy.run(
+                lambda attempt_timeout: client.chat_completion(
+                    messages,
+                    model=model,
+                    temperature=temperature,
+                    timeout=attempt_timeout,
+                    on_progress=on_progress,
+                    **extra_params,
+                ),
+                deadline=timeout,
             )
-            return response.choices[0].message.content
-        except openai.error.Timeout as e:
-            print(f"❌ OpenAI API 超時: {e}")
-            raise  # 重新拋出，讓上層處理
-        except Exception as e:
-            print(f"❌ OpenAI API 呼叫失敗: {e}")
-            raise
+        )
+        return response
 
     @staticmethod
-    async def generate_feedback(messages, model=None, temperature=1.0):
+    async def grade(prompt, student_name, answer_text, model=None, temperature=1.0, timeout=None, on_progress=None,
+                    prompt_label=None, max_output_tokens=None, fallback_model=None, use_cache=True):
         """
-        非同步生成評分反饋
+        評分單一面向（英語或統計）：先查回應快取，未命中才呼叫 API
+        快取不含學生姓名：相同（正規化後）作答的其他學生可命中，回饋中的姓名換成本次學生
+
+        API 回應中命中供應商 prompt 快取的 token 數會依 prompt 累計到 prompt_cache_stats
+        （prompt_label 為顯示用名稱，例如「題目 / english」）
+        use_cache=False 時不讀取也不寫入回應快取（例如 rubric 變更後的重新評分）
+        主要模型在 timeout 內重試後仍超時、過載（429 / 5xx）時，改用 fallback_model 再評分一次；
+        斷路器開啟（CircuitOpenError）代表整個供應商故障，不切換模型
+
+        Returns:
+            dict: {"feedback": str, "model": str, "cached": bool, "usage": dict or None, "duration": float,
+                   "cached_tokens": int, "fallback": bool}
         """
-        loop = asyncio.get_event_loop()
-        
-        feedback = await loop.run_in_executor(
-            GradingService._executor,
-            GradingService._generate_feedback_sync,
-            messages,
-            model,
-            temperature
-        )
-        
-        return feedback
+        if model is None:
+            model = MODEL
+        start = time.time()
+
+        messages = GradingService.create_messages(prompt, student_name, answer_text)
+        prompt_cache_key = make_prompt_cache_key(prompt)
+        extra_params = {"prompt_cache_key": prompt_cache_key} if LLM_PROMPT_CACHE_KEY_ENABLED else {}
+        if max_output_tokens:
+            extra_params["max_completion_tokens"] = max_output_tokens
+        request_params = dict(extra_params, temperature=temperature)
+
+        cache = get_response_cache() if use_cache else None
+        cache_key = None
+        if cache is not None:
+            # key 不含學生姓名、作答先正規化：不同學生交出相同作答時共用快取，命中時換回本人姓名
+            cache_messages = GradingService.create_messages(
+                prompt, ResponseCache.NAME_PLACEHOLDER, ResponseCache.normalize_answer(answer_text)
+            )
+            cache_key = ResponseCache.make_key(model, cache_messages, request_params)
+            cached_feedback = await cache.aget(cache_key)
+            if cached_feedback is not None:
+                print(f"⚡ LLM 快取命中 ({cache_key[:12]})，略過 API 呼叫")
+                feedback = ResponseCache.personalize(cached_feedback, student_name)
+                return {"feedback": feedback, "model": model, "cached": True,
+                        "usage": None, "duration": time.time() - start, "cached_tokens": 0, "fallback": False}
+
+        answered_model = model
+        try:
+            response = await GradingService.request_completion(
+                messages, model, temperature, timeout, on_progress, **extra_params
+            )
+        except Exception as e:
+            if not fallback_model or isinstance(e, CircuitOpenError) or not is_retryable(e):
+                raise
+            print(f"🔀 {model} 評分失敗（{type(e).__name__}），改用備援模型 {fallback_model}")
+            answered_model = fallback_model
+            response = await GradingService.request_completion(
+                messages, fallback_model, temperature, timeout, on_progress, **extra_params
+            )
+        feedback = response["choices"][0]["message"]["content"]
+        duration = time.time() - start
+        usage = response.get("usage")
+        prompt_cache_stats.record(prompt_cache_key, usage, duration, label=prompt_label)
+
+        if cache is not None:
+            if answered_model != model:
+                cache_key = ResponseCache.make_key(answered_model, cache_messages, request_params)
+            await cache.aput(cache_key, answered_model, ResponseCache.anonymize(feedback, student_name))
+        return {"feedback": feedback, "model": response.get("model") or answered_model, "cached": False,
+                "usage": usage, "duration": duration, "cached_tokens": cached_tokens_from_usage(usage),
+                "fallback": answered_model != model}
 
     # ---------- Report Generation ----------
     @staticmethod
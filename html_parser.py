@@ -1,14 +1,239 @@
+import html
 import re  # ✅ 記得導入 re
 from bs4 import BeautifulSoup
+from config import SUBMISSION_FAST_PARSE
 
+_NAME_LABEL = re.compile(r"姓名\s*[：:]")
+_ID_LABEL = re.compile(r"學號\s*[：:]")
+_ANSWER_LABEL = re.compile(r"作答區\s*[：:]")
 
-def extract_html_title(file_path):
+# 快速路徑（StatsAnswerFormatter 匯出的固定版面）使用的正規表達式
+_IGNORED_BLOCKS = re.compile(r"<!--.*?-->|<(script|style)\b[^>]*>.*?</\1\s*>", re.DOTALL | re.IGNORECASE)
+_TITLE_TAG = re.compile(r"<title\b[^>]*>([^<]*)</title\s*>", re.IGNORECASE)
+_LABEL_TAG = re.compile(r"<label\b[^>]*>([^<]*)</label\s*>", re.IGNORECASE)
+_LABEL_START = re.compile(r"<label\b", re.IGNORECASE)
+_SPAN_TAG = re.compile(r"<span\b[^>]*>([^<]*)</span\s*>", re.IGNORECASE)
+_SPAN_START = re.compile(r"<span\b", re.IGNORECASE)
+_P_TAG = re.compile(r"<p\b[^>]*>(.*?)</p\s*>", re.DOTALL | re.IGNORECASE)
+_P_START = re.compile(r"<p\b", re.IGNORECASE)
+_ANY_TAG = re.compile(r"<[^>]*>")
+_TAG_NAME = re.compile(r"</?([a-zA-Z][a-zA-Z0-9]*)")
+# 作答 <p> 內允許出現的行內標籤；出現其他標籤（例如區塊元素）時交給完整解析
+_INLINE_TAGS = {"br", "b", "i", "u", "em", "strong", "span", "sub", "sup", "code", "a", "mark", "small"}
+
+# 各路徑的使用次數（parser_stats() 回傳）
+_path_counts = {"fast": 0, "full": 0}
+
+
+def parse_submission(raw_html, features="lxml", fast_path=SUBMISSION_FAST_PARSE):
+    """
+    解析學生上傳的 HTML，同時提取標題、姓名、學號與作答內容
+
+    先以 SUBMISSION_EXTRACTORS 中的快速解析器嘗試（不建立 DOM），
+    都不符合時才以 BeautifulSoup 建立一棵樹完整解析
+
+    Args:
+        raw_html (bytes or str): 上傳檔案的原始內容
+        features (str): 完整解析使用的 BeautifulSoup 解析器，預設使用 lxml（比內建的 "html.parser" 快數倍）
+        fast_path (bool): 是否先嘗試快速解析器
+
+    Returns:
+        dict: {"title", "student_name", "student_id", "answer_text"}
+    """
+    if fast_path:
+        for extractor in SUBMISSION_EXTRACTORS:
+            submission = extractor(raw_html)
+            if submission is not None:
+                _path_counts["fast"] += 1
+                return submission
+
+    _path_counts["full"] += 1
+    if isinstance(raw_html, bytes):
+        soup = BeautifulSoup(raw_html, features, from_encoding="utf-8")
+    else:
+        soup = BeautifulSoup(raw_html, features)
+
+    title = _extract_title(soup)
+    student_name, student_id, answer_text = _extract_fields(soup)
+    return {
+        "title": title,
+        "student_name": student_name,
+        "student_id": student_id,
+        "answer_text": answer_text,
+    }
+
+
+def parser_stats():
+    """快速路徑與完整解析各使用了幾次"""
+    total = _path_counts["fast"] + _path_counts["full"]
+    return {
+        "fast": _path_counts["fast"],
+        "full": _path_counts["full"],
+        "fast_ratio": _path_counts["fast"] / total if total else 0.0,
+    }
+
+
+def _text_pieces(fragment):
+    """與 BeautifulSoup 的 get_text("\\n", strip=True) 相同：依標籤切開文字，各段去除空白後略過空白段"""
+    pieces = (html.unescape(piece).strip() for piece in _ANY_TAG.split(fragment))
+    return [piece for piece in pieces if piece]
+
+
+def _find_label(labels, pattern):
+    for match in labels:
+        if pattern.search(html.unescape(match.group(1))):
+            return match
+    return None
+
+
+def _fast_extract(raw_html):
     """
-    解析 HTML 檔案，智慧提取作業標題
+    StatsAnswerFormatter 版面的快速解析：以正規表達式直接取出欄位，不建立 DOM
+
+    只處理結構單純的檔案（純文字的 <title>、姓名/學號/作答區 <label> 後接 <span> 與 <p>），
+    任何不確定的情況都回傳 None，交給 BeautifulSoup 完整解析，確保結果與完整解析相同
     """
-    with open(file_path, encoding="utf-8") as f:
-        soup = BeautifulSoup(f, "html.parser")
+    if isinstance(raw_html, bytes):
+        try:
+            text = raw_html.decode("utf-8-sig")
+        except UnicodeDecodeError:
+            return None
+    else:
+        text = raw_html
+    text = _IGNORED_BLOCKS.sub("", text.replace("\r\n", "\n"))
+
+    title_match = _TITLE_TAG.search(text)
+    title = html.unescape(title_match.group(1)).strip() if title_match else ""
+    if not title or len(_TITLE_TAG.findall(text)) != len(re.findall(r"<title\b", text, re.IGNORECASE)):
+        return None
+
+    # 所有 <label> 都必須是純文字，否則 BeautifulSoup 的比對結果可能不同
+    labels = list(_LABEL_TAG.finditer(text))
+    if len(labels) != len(_LABEL_START.findall(text)):
+        return None
+    name_label = _find_label(labels, _NAME_LABEL)
+    id_label = _find_label(labels, _ID_LABEL)
+    answer_label = _find_label(labels, _ANSWER_LABEL)
+    if not (name_label and id_label and answer_label):
+        return None
+
+    fields = []
+    for label in (name_label, id_label):
+        start = _SPAN_START.search(text, label.end())
+        span = _SPAN_TAG.match(text, start.start()) if start else None
+        if not span:
+            return None
+        fields.append(html.unescape(span.group(1)).strip())
+
+    start = _P_START.search(text, answer_label.end())
+    answer = _P_TAG.match(text, start.start()) if start else None
+    if not answer:
+        return None
+    # 作答內的每個 "<" 都必須是允許的行內標籤（文字中的 "<" 由完整解析處理）
+    content = answer.group(1)
+    tags = _ANY_TAG.findall(content)
+    if content.count("<") != len(tags):
+        return None
+    for tag in tags:
+        name = _TAG_NAME.match(tag)
+        if not name or name.group(1).lower() not in _INLINE_TAGS:
+            return None
+
+    return {
+        "title": title,
+        "student_name": fields[0],
+        "student_id": fields[1],
+        "answer_text": "\n".join(_text_pieces(content)),
+    }
+
+
+# 依序嘗試的快速解析器（回傳 None 代表不符合其版面），都不符合時使用 BeautifulSoup
+SUBMISSION_EXTRACTORS = [_fast_extract]
+
 
+class HtmlSanitizer:
+    """
+    串流清理上傳的 HTML：移除 <script>、<style> 區塊與內嵌的 base64 data URI
+
+    以 feed() 逐段餵入已解碼的文字、close() 取得最後一段；只保留跨段比對所需的少量尾端，
+    不必把整份原始檔案留在記憶體。移除的內容不影響標題、姓名、學號與作答的解析
+    """
+
+    _START = re.compile(
+        r"<(script|style)\b[^>]*>|data:[\w.+-]+/[\w.+-]+(?:;[\w.+-]+=[\w.+-]+)*;base64,",
+        re.IGNORECASE,
+    )
+    _BASE64_END = re.compile(r"[^A-Za-z0-9+/=\r\n]")
+    _HOLD_BACK = 64  # 保留在緩衝區、可能是下一段開頭的字元數
+    _MAX_OPEN_TAG = 4096  # 未閉合的 "<" 最多保留的長度
+
+    def __init__(self):
+        self._buffer = ""
+        self._state = "text"
+        self._end_tag = None
+        self.removed_blocks = 0
+        self.removed_uris = 0
+
+    def feed(self, text):
+        self._buffer += text
+        return self._drain(final=False)
+
+    def close(self):
+        return self._drain(final=True)
+
+    def _drain(self, final):
+        output = []
+        buffer = self._buffer
+        while buffer:
+            if self._state == "skip":
+                # 丟棄 script/style 內容，直到結束標籤
+                end = buffer.lower().find(self._end_tag)
+                close = buffer.find(">", end) if end != -1 else -1
+                if close == -1:
+                    keep = len(buffer) - end if end != -1 else len(self._end_tag)
+                    buffer = "" if final else buffer[-keep:]
+                    break
+                buffer = buffer[close + 1:]
+                self._state = "text"
+            elif self._state == "data":
+                # 丟棄 base64 內容，直到引號、括號等結束字元
+                end = self._BASE64_END.search(buffer)
+                if end is None:
+                    buffer = ""
+                    break
+                buffer = buffer[end.start():]
+                self._state = "text"
+            else:
+                match = self._START.search(buffer)
+                if match is None:
+                    cut = len(buffer) if final else self._safe_cut(buffer)
+                    output.append(buffer[:cut])
+                    buffer = buffer[cut:]
+                    break
+                output.append(buffer[:match.start()])
+                buffer = buffer[match.end():]
+                if match.group(1):
+                    self._state = "skip"
+                    self._end_tag = f"</{match.group(1).lower()}"
+                    self.removed_blocks += 1
+                else:
+                    # 保留空的 data URI，屬性仍然合法
+                    output.append("data:,")
+                    self._state = "data"
+                    self.removed_uris += 1
+        self._buffer = buffer
+        return "".join(output)
+
+    def _safe_cut(self, buffer):
+        """可以輸出的長度：保留尾端可能是 <script / data: 開頭的部分"""
+        cut = max(0, len(buffer) - self._HOLD_BACK)
+        open_tag = buffer.rfind("<")
+        if open_tag != -1 and ">" not in buffer[open_tag:] and len(buffer) - open_tag <= self._MAX_OPEN_TAG:
+            cut = min(cut, open_tag)
+        return cut
+
+
+def _extract_title(soup):
     # 優先從 <title> 標籤提取標題
     title_tag = soup.find("title")
     if title_tag and title_tag.get_text(strip=True):
@@ -22,24 +247,20 @@ def extract_html_title(file_path):
     return "未知題目"
 
 
-def extract_html_content(file_path):
-    """
-    解析 HTML 檔案，提取學生基本資訊和作答內容
-    """
-    with open(file_path, encoding="utf-8") as f:
-        soup = BeautifulSoup(f, "html.parser")
-
+def _extract_fields(soup):
     # ✅ 修正：使用正規表達式尋找標籤，忽略冒號前後的空白
-    name_label = soup.find("label", string=re.compile(r"姓名\s*[：:]"))
-    id_label = soup.find("label", string=re.compile(r"學號\s*[：:]"))
+    name_label = soup.find("label", string=_NAME_LABEL)
+    id_label = soup.find("label", string=_ID_LABEL)
 
     # 獲取 label 後面的 span 標籤內容
-    student_name = name_label.find_next("span").get_text(strip=True) if name_label else "未知姓名"
-    student_id = id_label.find_next("span").get_text(strip=True) if id_label else "未知學號"
+    name_span = name_label.find_next("span") if name_label else None
+    id_span = id_label.find_next("span") if id_label else None
+    student_name = name_span.get_text(strip=True) if name_span else "未知姓名"
+    student_id = id_span.get_text(strip=True) if id_span else "未知學號"
 
     # 提取作答內容 - 尋找作答區域
-    answer_label = soup.find("label", string=re.compile(r"作答區\s*[：:]"))
-    
+    answer_label = soup.find("label", string=_ANSWER_LABEL)
+
     if answer_label:
         answer_tag = answer_label.find_next("p")
         if answer_tag:
@@ -55,10 +276,30 @@ def extract_html_content(file_path):
         if textarea:
             answer_text = textarea.get_text(strip=True)
         else:
-                answer_text = ""
+            answer_text = ""
 
     return student_name, student_id, answer_text
 
+
+def _read_file(file_path):
+    with open(file_path, "rb") as f:
+        return f.read()
+
+
+def extract_html_title(file_path):
+    """
+    解析 HTML 檔案，智慧提取作業標題（需要多個欄位時請改用 parse_submission，避免重複解析）
+    """
+    return parse_submission(_read_file(file_path))["title"]
+
+
+def extract_html_content(file_path):
+    """
+    解析 HTML 檔案，提取學生基本資訊和作答內容（需要標題時請改用 parse_submission，避免重複解析）
+    """
+    submission = parse_submission(_read_file(file_path))
+    return submission["student_name"], submission["student_id"], submission["answer_text"]
+
 import json
 import re
 from bs4 import BeautifulSoup
@@ -0,0 +1,441 @@
+import asyncio
+import itertools
+import math
+import time
+import traceback
+import uuid
+from collections import deque
+from config import (
+    GRADING_WORKERS, GRADING_QUEUE_MAX_DEPTH, GRADING_ETA_DEFAULT_SECONDS,
+    PRIORITY_EARLY_MAX_ATTEMPT, PRIORITY_CLASS_GAP, PRIORITY_DEADLINE_WINDOW_HOURS, PRIORITY_DEADLINE_BOOST,
+    GRADING_JOB_LEASE_SECONDS,
+)
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+
+
+class QueueFullError(Exception):
+    """評分佇列已達上限時拋出"""
+
+
+class GradingJob:
+    """一份等待評分的提交"""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, user, payload, job_id=None):
+        self.job_id = job_id if job_id is not None else next(self._ids)
+        self.persisted = job_id is not None  # 是否已寫入 GradingJobs
+        self.user = user            # Discord 使用者（用於私訊通知）
+        self.payload = payload      # 評分所需的提交資料（dict）
+        self.enqueued_at = time.time()
+        self.started_at = None
+        self.status_msg = None      # 排隊狀態私訊，開始評分後沿用為進度訊息
+        self.last_position = None
+        self.priority_class = None  # first / early / resubmit
+        self.virtual_time = None    # 排序用：到達時間加上優先等級換算的延後秒數
+
+
+class GradingQueue:
+    """
+    全域評分佇列
+
+    - 固定數量的 worker 同時評分，其餘提交依序排隊
+    - 佇列深度有上限，滿了就拒絕新的提交（背壓）
+    - 排隊中的學生會收到包含排隊位置與預估等待時間的私訊，並隨佇列消化而更新
+    - 提供斷路器時，開啟期間暫停取出工作；半開時一次只放行一份作為探測，
+      因斷路器失敗的工作會放回佇列最前面，恢復後自動評分
+    - 依提交次數分為 first / early / resubmit 三個優先等級：每降一級視同晚到
+      PRIORITY_CLASS_GAP 秒（距離期限 PRIORITY_DEADLINE_WINDOW_HOURS 小時內差距放大），
+      因此低優先的工作等待超過差距後仍會排到新進的高優先工作前面，不會餓死
+    - 提供 store（DatabaseManager）時，每份工作寫入 GradingJobs 並持有租約；
+      程序停止後租約過期，新的程序會接手並透過 on_recover 重新排入佇列
+    - 同一學生同一題還在排隊的工作可用 find_pending / replace_pending 以新的上傳取代（合併），
+      沿用原本的提交次數與排隊位置
+    """
+
+    PRIORITY_CLASSES = ("first", "early", "resubmit")
+
+    CIRCUIT_POLL_INTERVAL = 1.0
+
+    def __init__(self, handler, workers=GRADING_WORKERS, max_depth=GRADING_QUEUE_MAX_DEPTH, circuit_breaker=None,
+                 store=None, on_recover=None, lease_seconds=GRADING_JOB_LEASE_SECONDS):
+        self.handler = handler          # async callable(job) -> bool（False 代表評分失敗）
+        self.workers = workers
+        self.max_depth = max_depth
+        self.circuit_breaker = circuit_breaker
+        self.store = store              # 持久化工作的 DatabaseManager
+        self.on_recover = on_recover    # async callable(job_id, user_id, payload, recoveries)
+        self.lease_seconds = lease_seconds
+        self.owner = uuid.uuid4().hex   # 此程序的租約識別碼
+        self._lease_task = None
+
+        self._pending = []              # 等待中的工作（依序）
+        self._reserved = 0              # 已通過深度檢查、正在送出排隊通知還沒放入 _pending 的工作數
+        self._running = {}              # job_id -> GradingJob
+        self._condition = None
+        self._worker_tasks = []
+        self._background_tasks = set()
+        self._durations = deque(maxlen=50)
+        self._class_waits = {name: deque(maxlen=200) for name in self.PRIORITY_CLASSES}
+
+        self.completed = 0
+        self.rejected = 0
+        self.deferred = 0
+        self.merged = 0
+
+    # ---------- 生命週期 ----------
+    def start(self):
+        """啟動 worker（可重複呼叫）"""
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        self._worker_tasks = [t for t in self._worker_tasks if not t.done()]
+        for index in range(len(self._worker_tasks), self.workers):
+            self._worker_tasks.append(asyncio.create_task(self._worker(index + 1)))
+        if self.store is not None and (self._lease_task is None or self._lease_task.done()):
+            self._lease_task = asyncio.create_task(self._lease_loop())
+        print(f"🧵 評分佇列已啟動：{self.workers} 個 worker，佇列上限 {self.max_depth}")
+
+    async def stop(self):
+        tasks = list(self._worker_tasks)
+        if self._lease_task is not None:
+            tasks.append(self._lease_task)
+            self._lease_task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._worker_tasks = []
+
+        if self.store is not None:
+            try:
+                released = self.store.release_grading_job_leases(self.owner)
+                if released:
+                    print(f"📌 已保留 {released} 份未完成的評分工作，下次啟動時繼續")
+            except Exception as e:
+                print(f"⚠️ 釋放評分工作租約失敗: {e}")
+
+    # ---------- 持久化與租約 ----------
+    def _persist_state(self, job, state, error=None):
+        if self.store is None or not job.persisted:
+            return
+        try:
+            self.store.update_grading_job_state(job.job_id, state, error)
+        except Exception as e:
+            print(f"⚠️ 無法更新工作 #{job.job_id} 狀態為 {state}: {e}")
+
+    async def _lease_loop(self):
+        """定期延長自己的租約，並接手租約已過期（原程序已停止）的工作"""
+        interval = max(self.lease_seconds / 3, 1.0)
+        while True:
+            try:
+                self.store.renew_grading_job_leases(self.owner, self.lease_seconds)
+                claimed = self.store.claim_expired_grading_jobs(self.owner, self.lease_seconds)
+                for job_id, user_id, payload, recoveries in claimed:
+                    print(f"♻️ 接手未完成的評分工作 #{job_id}（第 {recoveries} 次接手）")
+                    if self.on_recover is None:
+                        continue
+                    try:
+                        await self.on_recover(job_id, user_id, payload, recoveries)
+                    except Exception as e:
+                        print(f"❌ 恢復評分工作 #{job_id} 失敗: {e}")
+                        traceback.print_exc()
+                        self.store.update_grading_job_state(job_id, "failed", f"recover failed: {e}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ 評分工作租約更新失敗: {e}")
+            await asyncio.sleep(interval)
+
+    # ---------- 提交 ----------
+    def is_full(self):
+        # 包含已預留名額的工作：同時上傳的提交在送出通知（await）期間也不會超過上限
+        return len(self._pending) + self._reserved >= self.max_depth
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    async def submit(self, job, force=False):
+        """
+        將工作放入佇列並私訊學生排隊位置
+
+        Args:
+            job (GradingJob): 評分工作
+            force (bool): 略過佇列上限（重新啟動後恢復的工作）
+
+        Raises:
+            QueueFullError: 佇列已滿
+        """
+        if self._condition is None:
+            self.start()
+        if not force and self.is_full():
+            self.rejected += 1
+            raise QueueFullError(f"Grading queue is full ({self.max_depth})")
+
+        # 在第一個 await 之前預留名額，放入 _pending 後才釋放
+        self._reserved += 1
+        try:
+            if self.store is not None and not job.persisted:
+                payload = job.payload
+                job.job_id = self.store.create_grading_job(
+                    payload.get("user_id"), payload.get("html_title"), payload.get("attempt_number"),
+                    payload, self.owner, self.lease_seconds,
+                )
+                job.persisted = True
+
+            # 先送出排隊通知再放入佇列，避免 worker 在通知送出前就開始評分
+            self._prioritize(job)
+            position = self._insertion_index(job) + 1
+            try:
+                job.status_msg = await job.user.send(self._build_position_message(job, position))
+            except Exception as e:
+                print(f"⚠️ 無法發送排隊通知給工作 #{job.job_id}: {e}")
+
+            self._pending.insert(self._insertion_index(job), job)
+        finally:
+            self._reserved -= 1
+        job.last_position = self.position(job)
+        print(f"📥 工作 #{job.job_id} 已加入評分佇列（{job.priority_class}，位置 {job.last_position}，深度 {self.depth}）")
+
+        async with self._condition:
+            self._condition.notify()
+
+    # ---------- 同一學生、同一題目的提交 ----------
+    @staticmethod
+    def _matches(job, user_id, question_title):
+        payload = job.payload
+        return str(payload.get("user_id")) == str(user_id) and payload.get("html_title") == question_title
+
+    def max_attempt(self, user_id, question_title):
+        """佇列中（排隊或評分中）此學生此題已使用的最大提交次數，沒有則為 0"""
+        attempts = [
+            job.payload.get("attempt_number") or 0
+            for job in itertools.chain(self._pending, self._running.values())
+            if self._matches(job, user_id, question_title)
+        ]
+        return max(attempts, default=0)
+
+    def find_pending(self, user_id, question_title):
+        """此學生此題尚未開始評分的工作（不取出，worker 仍可開始評分），沒有則為 None"""
+        for job in self._pending:
+            if self._matches(job, user_id, question_title):
+                return job
+        return None
+
+    async def replace_pending(self, job, payload):
+        """
+        以新的提交內容取代仍在排隊的工作（合併），提交次數與排隊順序不變
+
+        檢查與取代之間沒有 await，worker 不會在兩者之間取出這份工作
+        Returns:
+            bool: 是否已取代（False 代表工作已開始評分或已不在佇列中）
+        """
+        if job not in self._pending:
+            return False
+        job.payload = payload
+        if self.store is not None and job.persisted:
+            try:
+                self.store.update_grading_job_state(job.job_id, "queued", payload=payload)
+            except Exception as e:
+                print(f"⚠️ 無法更新工作 #{job.job_id} 的提交內容: {e}")
+        self.merged += 1
+
+        job.last_position = self.position(job)
+        print(f"🔀 新的上傳已合併到工作 #{job.job_id}（位置 {job.last_position}）")
+        if job.status_msg:
+            try:
+                await job.status_msg.edit(content=self._build_position_message(job, job.last_position))
+            except Exception as e:
+                print(f"⚠️ 無法更新工作 #{job.job_id} 的排隊通知: {e}")
+        return True
+
+    def _prioritize(self, job):
+        """依提交次數與距離期限計算優先等級與排序時間"""
+        attempt = job.payload.get("attempt_number") or 1
+        if attempt <= 1:
+            job.priority_class = "first"
+        elif attempt <= PRIORITY_EARLY_MAX_ATTEMPT:
+            job.priority_class = "early"
+        else:
+            job.priority_class = "resubmit"
+
+        gap = PRIORITY_CLASS_GAP
+        deadline = job.payload.get("deadline")
+        if deadline and 0 <= deadline - job.enqueued_at <= PRIORITY_DEADLINE_WINDOW_HOURS * 3600:
+            gap *= PRIORITY_DEADLINE_BOOST
+        job.virtual_time = job.enqueued_at + self.PRIORITY_CLASSES.index(job.priority_class) * gap
+
+    def _insertion_index(self, job):
+        """_pending 依 virtual_time 排序，同分時先到先處理"""
+        for index, pending in enumerate(self._pending):
+            if pending.virtual_time is not None and job.virtual_time < pending.virtual_time:
+                return index
+        return len(self._pending)
+
+    def position(self, job):
+        """排隊位置（1 代表下一個開始評分）"""
+        try:
+            return self._pending.index(job) + 1
+        except ValueError:
+            return 0
+
+    def estimate_wait(self, position):
+        """以最近完成工作的平均用時估計等待秒數"""
+        average = self.average_duration()
+        rounds = math.ceil(position / max(self.workers, 1))
+        return rounds * average
+
+    def average_duration(self):
+        if not self._durations:
+            return GRADING_ETA_DEFAULT_SECONDS
+        return sum(self._durations) / len(self._durations)
+
+    # ---------- Worker ----------
+    def _circuit_admits(self):
+        """斷路器關閉時放行；半開時只在沒有其他工作評分中時放行一份探測"""
+        if self.circuit_breaker is None:
+            return True
+        state = self.circuit_breaker.state
+        if state == CircuitBreaker.CLOSED:
+            return True
+        if state == CircuitBreaker.HALF_OPEN:
+            return not self._running
+        return False
+
+    async def _wait_for_circuit(self):
+        while not self._circuit_admits():
+            await asyncio.sleep(min(max(self.circuit_breaker.retry_in(), self.CIRCUIT_POLL_INTERVAL), 5.0))
+
+    async def _worker(self, worker_id):
+        while True:
+            await self._wait_for_circuit()
+            async with self._condition:
+                while not self._pending:
+                    await self._condition.wait()
+                if not self._circuit_admits():
+                    continue
+                job = self._next_job()
+                # 在鎖內登記，避免半開時多個 worker 同時取出探測工作
+                self._running[job.job_id] = job
+
+            job.started_at = time.time()
+            wait_time = job.started_at - job.enqueued_at
+            if job.priority_class in self._class_waits:
+                self._class_waits[job.priority_class].append(wait_time)
+            print(f"▶️ Worker {worker_id} 開始處理工作 #{job.job_id}（排隊 {wait_time:.1f} 秒）")
+
+            # 其他排隊中的學生位置往前移，更新通知
+            notify_task = asyncio.create_task(self._notify_positions())
+            self._background_tasks.add(notify_task)
+            notify_task.add_done_callback(self._background_tasks.discard)
+
+            self._persist_state(job, "running")
+            try:
+                result = await self.handler(job)
+                self._persist_state(job, "failed" if result is False else "done")
+            except asyncio.CancelledError:
+                # 程序關閉：保留 running 狀態，租約過期後由下一個程序接手
+                self._running.pop(job.job_id, None)
+                raise
+            except CircuitOpenError as e:
+                await self._defer(job, e)
+                continue
+            except Exception as e:
+                print(f"❌ 評分工作 #{job.job_id} 發生未處理的錯誤: {e}")
+                traceback.print_exc()
+                self._persist_state(job, "failed", str(e))
+
+            self._running.pop(job.job_id, None)
+            self._durations.append(time.time() - job.started_at)
+            self.completed += 1
+
+    def _next_job(self):
+        return self._pending.pop(0)
+
+    async def _defer(self, job, error):
+        """斷路器開啟導致評分失敗：放回佇列最前面，等待恢復後重新評分"""
+        self._running.pop(job.job_id, None)
+        self.deferred += 1
+        job.started_at = None
+        job.last_position = 1
+        self._pending.insert(0, job)
+        self._persist_state(job, "queued")
+        print(f"⏸️ 工作 #{job.job_id} 因 LLM 斷路器開啟延後評分（{error}）")
+
+        if job.status_msg:
+            try:
+                await job.status_msg.edit(content=self._build_deferred_message(job))
+            except Exception as e:
+                print(f"⚠️ 無法更新工作 #{job.job_id} 的延後通知: {e}")
+
+        async with self._condition:
+            self._condition.notify()
+
+    async def _notify_positions(self):
+        """只對位置有變動的工作編輯排隊訊息"""
+        updates = []
+        for job in list(self._pending):
+            position = self.position(job)
+            if position and position != job.last_position and job.status_msg:
+                job.last_position = position
+                updates.append(job.status_msg.edit(content=self._build_position_message(job, position)))
+        if updates:
+            await asyncio.gather(*updates, return_exceptions=True)
+
+    def _build_position_message(self, job, position):
+        eta = self.estimate_wait(position)
+        payload = job.payload
+        return (
+            f"📥 **已加入評分佇列 / Queued for Grading**\n\n"
+            f"📝 題目 / Question：{payload.get('html_title', '')}\n"
+            f"🔢 第 {payload.get('attempt_number', '?')} 次提交 / Submission #{payload.get('attempt_number', '?')}\n"
+            f"🧾 目前排隊位置 / Queue position：{position}\n"
+            f"⏳ 預估等待時間 / Estimated wait：約 {math.ceil(eta / 60)} 分鐘 / ~{math.ceil(eta / 60)} min\n\n"
+            f"輪到您時此訊息會自動更新。\n"
+            f"This message will update automatically when grading starts."
+        )
+
+    def _build_deferred_message(self, job):
+        payload = job.payload
+        return (
+            f"⏸️ **評分暫停 / Grading Paused**\n\n"
+            f"📝 題目 / Question：{payload.get('html_title', '')}\n"
+            f"🔢 第 {payload.get('attempt_number', '?')} 次提交 / Submission #{payload.get('attempt_number', '?')}\n\n"
+            f"AI 評分服務暫時無法使用，您的作業已保留在佇列最前面，服務恢復後會自動評分，不需重新上傳。\n"
+            f"The AI grading service is temporarily unavailable. Your submission is kept at the front of the queue "
+            f"and will be graded automatically once the service recovers. No need to upload again."
+        )
+
+    # ---------- 統計 ----------
+    def class_wait_stats(self):
+        """各優先等級最近的排隊等待時間（筆數、平均、p50、p95）"""
+        result = {}
+        for name, waits in self._class_waits.items():
+            ordered = sorted(waits)
+            if not ordered:
+                result[name] = {"count": 0, "average": 0.0, "p50": 0.0, "p95": 0.0}
+                continue
+            result[name] = {
+                "count": len(ordered),
+                "average": sum(ordered) / len(ordered),
+                "p50": ordered[int(round(0.50 * (len(ordered) - 1)))],
+                "p95": ordered[int(round(0.95 * (len(ordered) - 1)))],
+            }
+        return result
+
+    def stats(self):
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "running": len(self._running),
+            "workers": self.workers,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "deferred": self.deferred,
+            "merged": self.merged,
+            "average_duration": self.average_duration(),
+            "oldest_wait": (time.time() - min(job.enqueued_at for job in self._pending)) if self._pending else 0.0,
+            "pending_by_class": {
+                name: sum(1 for job in self._pending if job.priority_class == name) for name in self.PRIORITY_CLASSES
+            },
+            "wait_by_class": self.class_wait_stats(),
+        }
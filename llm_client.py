@@ -0,0 +1,255 @@
+import asyncio
+import json
+import aiohttp
+import openai
+from config import (
+    OPENAI_API_KEY, OPENAI_API_BASE,
+    LLM_MAX_CONCURRENCY, LLM_POOL_SIZE, LLM_REQUEST_TIMEOUT, LLM_CONNECT_TIMEOUT,
+    LLM_EXPECTED_COMPLETION_TOKENS, LLM_STREAM_STALL_TIMEOUT,
+)
+from rate_limiter import rate_limiter
+from token_counter import estimate_messages_tokens
+
+
+class AsyncChatClient:
+    """
+    以 aiohttp 實作的非同步 Chat Completions 客戶端
+
+    - 共用一個 ClientSession（keep-alive 連線池），不再為每個請求佔用一條執行緒
+    - 每個請求可各自設定超時
+    - 以 Semaphore 限制同時送出的請求數，其餘請求在事件迴圈上等待
+    """
+
+    def __init__(self, api_key=None, api_base=None, max_concurrency=None, pool_size=None, default_timeout=None):
+        self.api_key = api_key or OPENAI_API_KEY
+        self.api_base = (api_base or OPENAI_API_BASE).rstrip("/")
+        self.max_concurrency = max_concurrency or LLM_MAX_CONCURRENCY
+        self.pool_size = pool_size or LLM_POOL_SIZE
+        self.default_timeout = default_timeout or LLM_REQUEST_TIMEOUT
+        self._session = None
+        self._semaphore = None
+        self._loop = None
+        self.in_flight = 0
+        self.waiting = 0
+
+    def _ensure_loop_resources(self):
+        """Session 與 Semaphore 綁定事件迴圈，換了迴圈（例如批次腳本）就重新建立"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._session = None
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    def _get_session(self):
+        self._ensure_loop_resources()
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                keepalive_timeout=60,
+                ttl_dns_cache=300,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers={
+                    "Authorization": f"Bearer {self.api_key}",
+                    "Content-Type": "application/json",
+                },
+            )
+        return self._session
+
+    async def chat_completion(self, messages, model, temperature=1.0, timeout=None, on_progress=None, **extra_params):
+        """
+        送出一次 Chat Completions 請求
+
+        Args:
+            messages (list): OpenAI 格式的訊息列表
+            model (str): 模型名稱
+            temperature (float): 溫度
+            timeout (float, optional): 此請求的總超時秒數（預設 LLM_REQUEST_TIMEOUT）
+            on_progress (callable, optional): 提供時改用串流模式，每收到一段內容就以進度字典呼叫
+            **extra_params: 其他直接放入請求 body 的參數
+
+        Returns:
+            dict: API 回傳的 JSON（串流模式會組回相同格式）
+
+        Raises:
+            openai.error.* : 與舊版 openai 套件相同的例外類型，讓上層錯誤處理保持不變
+        """
+        session = self._get_session()
+        payload = {"model": model, "messages": messages, "temperature": temperature}
+        payload.update(extra_params)
+        stream = on_progress is not None
+        if stream:
+            payload["stream"] = True
+            payload["stream_options"] = {"include_usage": True}
+        request_timeout = aiohttp.ClientTimeout(
+            total=timeout or self.default_timeout,
+            sock_connect=LLM_CONNECT_TIMEOUT,
+        )
+
+        # 依 RPM / TPM 配額放行（預估 prompt + completion token 數）
+        completion_budget = extra_params.get("max_completion_tokens") or extra_params.get("max_tokens")
+        estimated_tokens = estimate_messages_tokens(messages) + (completion_budget or LLM_EXPECTED_COMPLETION_TOKENS)
+        ticket = await rate_limiter.acquire(estimated_tokens)
+        actual_tokens = None
+        rate_limited = False
+        retry_after = None
+
+        # 等待連線名額也放在 try 內：等待中被取消時 finally 仍會歸還限流憑證
+        acquired = False
+        try:
+            self.waiting += 1
+            try:
+                await self._semaphore.acquire()
+            finally:
+                self.waiting -= 1
+            acquired = True
+            self.in_flight += 1
+
+            async with session.post(
+                f"{self.api_base}/chat/completions",
+                json=payload,
+                timeout=request_timeout,
+            ) as resp:
+                if resp.status != 200:
+                    body = await resp.text()
+                    if resp.status == 429:
+                        rate_limited = True
+                        retry_after = self._parse_retry_after(resp.headers)
+                    raise self._error_from_response(resp.status, body, resp.headers)
+                if stream:
+                    result = await self._read_stream(resp, model, on_progress)
+                else:
+                    result = json.loads(await resp.text())
+                actual_tokens = (result.get("usage") or {}).get("total_tokens")
+                return result
+        except asyncio.TimeoutError as e:
+            print(f"❌ OpenAI API 超時: {e}")
+            raise openai.error.Timeout(f"Request timed out after {timeout or self.default_timeout}s") from e
+        except aiohttp.ClientError as e:
+            print(f"❌ OpenAI API 連線失敗: {e}")
+            raise openai.error.APIConnectionError(f"Connection error: {e}") from e
+        finally:
+            if acquired:
+                self.in_flight -= 1
+                self._semaphore.release()
+            rate_limiter.release(ticket, actual_tokens, rate_limited=rate_limited, retry_after=retry_after)
+
+    @staticmethod
+    async def _read_stream(resp, model, on_progress):
+        """
+        讀取 SSE 串流並組回一般回應格式
+
+        進度字典包含 tokens（已收到的內容片段數，約等於 token 數）、chars 與
+        sections（目前為止出現的 Markdown 標題）。超過 LLM_STREAM_STALL_TIMEOUT 秒
+        沒有收到任何資料就視為串流停滯。
+        """
+        content_parts = []
+        current_line = ""
+        progress = {"tokens": 0, "chars": 0, "sections": []}
+        usage = None
+        finish_reason = None
+
+        while True:
+            try:
+                raw = await asyncio.wait_for(resp.content.readline(), timeout=LLM_STREAM_STALL_TIMEOUT)
+            except asyncio.TimeoutError:
+                print(f"❌ OpenAI 串流停滯超過 {LLM_STREAM_STALL_TIMEOUT:.0f} 秒")
+                raise openai.error.Timeout(f"Stream stalled for {LLM_STREAM_STALL_TIMEOUT:.0f}s")
+            if not raw:
+                break
+
+            line = raw.decode("utf-8").strip()
+            if not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+
+            chunk = json.loads(data)
+            if chunk.get("usage"):
+                usage = chunk["usage"]
+
+            received = False
+            for choice in chunk.get("choices") or []:
+                text = (choice.get("delta") or {}).get("content")
+                if choice.get("finish_reason"):
+                    finish_reason = choice["finish_reason"]
+                if not text:
+                    continue
+                received = True
+                content_parts.append(text)
+                progress["tokens"] += 1
+                progress["chars"] += len(text)
+
+                # 逐行偵測 Markdown 標題（標題可能被切在兩個片段之間）
+                lines = (current_line + text).split("\n")
+                current_line = lines.pop()
+                for completed in lines:
+                    if completed.lstrip().startswith("#"):
+                        progress["sections"].append(completed.strip().lstrip("#").strip())
+
+            if received:
+                try:
+                    on_progress(progress)
+                except Exception as e:
+                    print(f"⚠️ 串流進度回呼失敗: {e}")
+
+        return {
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(content_parts)},
+                "finish_reason": finish_reason,
+            }],
+            "usage": usage,
+        }
+
+    @staticmethod
+    def _parse_retry_after(headers):
+        """讀取 429 回應建議的等待秒數"""
+        value = headers.get("Retry-After") or headers.get("retry-after")
+        try:
+            return float(value) if value else None
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _error_from_response(status, body, headers):
+        """將 HTTP 錯誤轉換為對應的 openai.error 例外"""
+        try:
+            json_body = json.loads(body)
+            error = json_body.get("error", {}) or {}
+        except (ValueError, AttributeError):
+            json_body, error = None, {}
+
+        message = error.get("message") or body[:500] or f"HTTP {status}"
+        kwargs = {"http_body": body, "http_status": status, "json_body": json_body, "headers": dict(headers)}
+        print(f"❌ OpenAI API 呼叫失敗 (HTTP {status}): {message}")
+
+        if status == 429:
+            return openai.error.RateLimitError(message, **kwargs)
+        if status in (400, 404, 409, 422):
+            return openai.error.InvalidRequestError(message, error.get("param"), **kwargs)
+        if status in (401, 403):
+            return openai.error.AuthenticationError(message, **kwargs)
+        if status in (502, 503, 504):
+            return openai.error.ServiceUnavailableError(message, **kwargs)
+        return openai.error.APIError(message, **kwargs)
+
+    async def close(self):
+        """關閉連線池"""
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+# 全程式共用的客戶端（共用同一個連線池與並行上限）
+_chat_client = None
+
+
+def get_chat_client():
+    global _chat_client
+    if _chat_client is None:
+        _chat_client = AsyncChatClient()
+    return _chat_client
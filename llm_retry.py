@@ -0,0 +1,183 @@
+import asyncio
+import random
+import time
+from collections import deque
+import openai
+from config import (
+    LLM_RETRY_MAX_ATTEMPTS, LLM_RETRY_BASE_DELAY, LLM_RETRY_MAX_DELAY, LLM_RETRY_DEADLINE,
+    LLM_HEDGE_ENABLED, LLM_HEDGE_MIN_DELAY,
+)
+
+
+class LatencyTracker:
+    """記錄最近成功請求的延遲，用來估計 p95"""
+
+    MIN_SAMPLES = 20
+
+    def __init__(self, window=200):
+        self._samples = deque(maxlen=window)
+
+    def record(self, seconds):
+        self._samples.append(seconds)
+
+    def percentile(self, p):
+        if len(self._samples) < self.MIN_SAMPLES:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+
+def is_retryable(error):
+    """超時、429、5xx 與連線錯誤可重試；請求內容錯誤或驗證失敗不重試"""
+    if isinstance(error, (asyncio.TimeoutError, openai.error.Timeout, openai.error.RateLimitError,
+                          openai.error.ServiceUnavailableError, openai.error.APIConnectionError)):
+        return True
+    if isinstance(error, openai.error.APIError):
+        status = getattr(error, "http_status", None)
+        return status is None or status >= 500
+    return False
+
+
+class RetryPolicy:
+    """
+    LLM 請求的重試與對沖（hedging）策略
+
+    - 可重試的錯誤以 full jitter 指數退避重試，全部嘗試共用一個期限
+    - 啟用對沖時，若第一個請求超過觀察到的 p95 延遲仍未完成，
+      就再送出一個相同請求，採用先完成者並取消另一個
+    """
+
+    def __init__(self, max_attempts=LLM_RETRY_MAX_ATTEMPTS, base_delay=LLM_RETRY_BASE_DELAY,
+                 max_delay=LLM_RETRY_MAX_DELAY, deadline=LLM_RETRY_DEADLINE,
+                 hedge_enabled=LLM_HEDGE_ENABLED, hedge_min_delay=LLM_HEDGE_MIN_DELAY):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.hedge_enabled = hedge_enabled
+        self.hedge_min_delay = hedge_min_delay
+        self.latency = LatencyTracker()
+
+        self.calls = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.giveups = 0
+
+    async def run(self, make_call, deadline=None):
+        """
+        執行請求並依策略重試
+
+        Args:
+            make_call (callable): make_call(timeout) 回傳一個 coroutine
+            deadline (float, optional): 全部嘗試的總秒數上限（預設 LLM_RETRY_DEADLINE）
+        """
+        self.calls += 1
+        total_budget = deadline or self.deadline
+        start = time.monotonic()
+        attempt = 0
+
+        while True:
+            remaining = total_budget - (time.monotonic() - start)
+            if remaining <= 0:
+                self.giveups += 1
+                raise openai.error.Timeout(f"LLM request deadline of {total_budget:.0f}s exceeded")
+
+            attempt += 1
+            try:
+                return await self._attempt(make_call, remaining)
+            except Exception as e:
+                if not is_retryable(e) or attempt >= self.max_attempts:
+                    if is_retryable(e):
+                        self.giveups += 1
+                    raise
+
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+                retry_after = self._retry_after(e)
+                if retry_after:
+                    delay = max(delay, retry_after)
+
+                remaining = total_budget - (time.monotonic() - start)
+                if delay >= remaining:
+                    self.giveups += 1
+                    raise
+
+                self.retries += 1
+                print(f"🔁 LLM 請求失敗 ({type(e).__name__})，{delay:.1f} 秒後重試（第 {attempt + 1}/{self.max_attempts} 次）")
+                await asyncio.sleep(delay)
+
+    async def _attempt(self, make_call, remaining):
+        hedge_delay = self._hedge_delay()
+        attempt_start = time.monotonic()
+
+        if hedge_delay is None or hedge_delay >= remaining:
+            result = await make_call(remaining)
+            self.latency.record(time.monotonic() - attempt_start)
+            return result
+
+        primary = asyncio.ensure_future(make_call(remaining))
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=hedge_delay)
+        except asyncio.CancelledError:
+            primary.cancel()
+            raise
+        if done:
+            result = primary.result()
+            self.latency.record(time.monotonic() - attempt_start)
+            return result
+
+        # 第一個請求超過 p95 仍未完成：送出對沖請求
+        self.hedges += 1
+        print(f"🪁 LLM 請求超過 p95 ({hedge_delay:.1f} 秒)，送出對沖請求")
+        hedge = asyncio.ensure_future(make_call(remaining - hedge_delay))
+        pending = {primary, hedge}
+        last_error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.hedge_wins += 1
+                        self.latency.record(time.monotonic() - attempt_start)
+                        return task.result()
+                    last_error = task.exception()
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    def _hedge_delay(self):
+        if not self.hedge_enabled:
+            return None
+        p95 = self.latency.percentile(95)
+        if p95 is None:
+            return None
+        return max(p95, self.hedge_min_delay)
+
+    @staticmethod
+    def _retry_after(error):
+        headers = getattr(error, "headers", None) or {}
+        value = headers.get("Retry-After") or headers.get("retry-after")
+        try:
+            return float(value) if value else None
+        except ValueError:
+            return None
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "giveups": self.giveups,
+            "p50": self.latency.percentile(50),
+            "p95": self.latency.percentile(95),
+        }
+
+
+# 全程式共用的重試策略（共用延遲統計與指標）
+retry_policy = RetryPolicy()
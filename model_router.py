@@ -0,0 +1,74 @@
+from config import (
+    ENGLISH_MODEL, STATISTICS_MODEL, LLM_FALLBACK_MODEL, LLM_MAX_OUTPUT_TOKENS, LLM_TEMPERATURE, LLM_RETRY_DEADLINE,
+)
+from prompt_registry import prompt_registry
+
+DIMENSIONS = ("english", "statistics")
+SETTING_KEYS = ("model", "fallback_model", "max_output_tokens", "timeout", "temperature")
+
+# 各面向的預設模型（英語使用通用的 Eng_prompt.txt，可改用較快的模型）
+DEFAULT_MODELS = {"english": ENGLISH_MODEL, "statistics": STATISTICS_MODEL}
+
+
+def get_model_settings(question_title, dimension, model_override=None):
+    """
+    決定某題目某面向（english / statistics）的模型設定
+
+    優先順序（後者覆蓋前者）：
+        1. config.py 的預設值（ENGLISH_MODEL / STATISTICS_MODEL、LLM_FALLBACK_MODEL 等）
+        2. manifest 的 model_settings（兩個面向共用）
+        3. manifest 的 model_settings.english / model_settings.statistics
+        4. model_override（評分前檢查改用長上下文模型時），此時不再切換備援模型
+
+    Returns:
+        dict: {"model", "fallback_model", "max_output_tokens", "timeout", "temperature"}
+              fallback_model 與 max_output_tokens 未設定時為 None
+    """
+    settings = {
+        "model": DEFAULT_MODELS.get(dimension, STATISTICS_MODEL),
+        "fallback_model": LLM_FALLBACK_MODEL or None,
+        "max_output_tokens": LLM_MAX_OUTPUT_TOKENS or None,
+        "timeout": LLM_RETRY_DEADLINE,
+        "temperature": LLM_TEMPERATURE,
+    }
+
+    entry = prompt_registry.get_entry(question_title) or {}
+    overrides = entry.get("model_settings") or {}
+    if not isinstance(overrides, dict):
+        print(f"⚠️ 題目 '{question_title}' 的 model_settings 格式錯誤（必須是 JSON 物件）")
+        overrides = {}
+    dimension_overrides = overrides.get(dimension) or {}
+    for source in (overrides, dimension_overrides):
+        for key in SETTING_KEYS:
+            if key in source:
+                settings[key] = source[key]
+
+    if model_override:
+        settings["model"] = model_override
+        settings["fallback_model"] = None
+    if settings["fallback_model"] == settings["model"]:
+        settings["fallback_model"] = None
+
+    settings["timeout"] = float(settings["timeout"])
+    settings["temperature"] = float(settings["temperature"])
+    if settings["max_output_tokens"]:
+        settings["max_output_tokens"] = int(settings["max_output_tokens"])
+    return settings
+
+
+def stage_timeout(settings, margin=10.0):
+    """評分階段的總期限：主要模型的期限，有備援模型時再加上一次備援的期限"""
+    attempts = 2 if settings.get("fallback_model") else 1
+    return settings["timeout"] * attempts + margin
+
+
+def fit_to_budget(settings, available):
+    """
+    依提交剩餘的時間預算縮短模型期限
+
+    有備援模型時，主要模型最多使用一半的剩餘時間，另一半留給備援模型
+    """
+    fitted = dict(settings)
+    share = available / 2 if settings.get("fallback_model") else available
+    fitted["timeout"] = max(1.0, min(settings["timeout"], share))
+    return fitted
@@ -0,0 +1,142 @@
+import asyncio
+import time
+
+# 階段超時時取消 coroutine 所附的訊息；斷路器據此把這種取消記為故障
+STAGE_TIMEOUT_MESSAGE = "grading stage timed out"
+
+
+def is_stage_timeout(error):
+    """是否為階段超時造成的取消（CancelledError 帶有 STAGE_TIMEOUT_MESSAGE）"""
+    return isinstance(error, asyncio.CancelledError) and STAGE_TIMEOUT_MESSAGE in error.args
+
+
+class GradingPipeline:
+    """
+    並行執行多個互相獨立的評分階段（例如英語評分與統計評分）
+
+    - 所有階段同時開始，任一階段失敗時會取消其餘仍在執行的階段
+    - 每個階段完成時記錄用時，並可透過回呼通知（例如更新 Discord 進度訊息）
+    - allow_partial=True 時，超時的階段不會取消其他階段；只要有階段完成就回傳部分結果，
+      超時的階段記錄在 timed_out
+    """
+
+    def __init__(self):
+        self._stages = []
+        self.results = {}
+        self.durations = {}
+        self.timed_out = []
+        self.total_duration = 0.0
+
+    def add_stage(self, name, coro_factory, timeout=None):
+        """
+        新增一個評分階段
+
+        Args:
+            name (str): 階段名稱（同時作為結果字典的 key）
+            coro_factory (callable): 無參數函式，呼叫後回傳要執行的 coroutine
+            timeout (float, optional): 此階段的超時秒數（None 代表不限時；0 或負數代表立即超時）
+        """
+        self._stages.append((name, coro_factory, timeout))
+        return self
+
+    async def _run_stage(self, name, coro_factory, timeout, on_stage_done):
+        stage_start = time.time()
+        if timeout is not None and timeout <= 0:
+            # 時間預算已用完：不送出請求，直接視為超時
+            raise asyncio.TimeoutError(f"stage {name} has no time left")
+        if timeout is not None:
+            result = await self._wait_for(name, coro_factory(), timeout)
+        else:
+            result = await coro_factory()
+
+        duration = time.time() - stage_start
+        self.results[name] = result
+        self.durations[name] = duration
+        print(f"✅ 階段 {name} 完成 (用時: {duration:.2f}秒)")
+
+        if on_stage_done:
+            try:
+                await on_stage_done(name, duration)
+            except Exception as e:
+                # 進度通知失敗不應影響評分結果
+                print(f"⚠️ 階段 {name} 的完成通知失敗: {e}")
+
+        return result
+
+    @staticmethod
+    async def _wait_for(name, coro, timeout):
+        """
+        與 asyncio.wait_for 相同，但超時時以 STAGE_TIMEOUT_MESSAGE 取消階段，
+        讓斷路器能分辨超時與其他取消（關閉、其他階段失敗）
+        """
+        task = asyncio.ensure_future(coro)
+        try:
+            done, _ = await asyncio.wait({task}, timeout=timeout)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        if task in done:
+            return task.result()
+
+        task.cancel(STAGE_TIMEOUT_MESSAGE)
+        await asyncio.wait({task})
+        if not task.cancelled():
+            task.exception()  # 取消前剛好結束或失敗：結果已超過期限，不再使用
+        raise asyncio.TimeoutError(f"stage {name} timed out after {timeout:.1f}s")
+
+    async def run(self, on_stage_done=None, allow_partial=False, timeout_errors=(asyncio.TimeoutError,)):
+        """
+        同時執行所有階段
+
+        Args:
+            on_stage_done (callable, optional): async 回呼 (name, duration)，每個階段完成時呼叫
+            allow_partial (bool): 階段超時（timeout_errors）時保留其他階段的結果
+            timeout_errors (tuple): 視為超時的例外類型
+
+        Returns:
+            dict: {階段名稱: 結果}（部分結果時不包含超時的階段）
+
+        Raises:
+            第一個失敗階段的原始例外（其餘階段會被取消）；部分模式下所有階段都超時時拋出第一個超時例外
+        """
+        start_time = time.time()
+        tasks = {
+            asyncio.ensure_future(self._run_stage(name, factory, timeout, on_stage_done)): name
+            for name, factory, timeout in self._stages
+        }
+
+        pending = set(tasks)
+        first_timeout = None
+        while pending:
+            try:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_EXCEPTION)
+            except asyncio.CancelledError:
+                # 外部取消時，一併取消所有階段
+                await self._cancel_all(tasks)
+                raise
+
+            failed = [t for t in done if not t.cancelled() and t.exception() is not None]
+            timed_out = [t for t in failed if allow_partial and isinstance(t.exception(), timeout_errors)]
+            for task in timed_out:
+                self.timed_out.append(tasks[task])
+                first_timeout = first_timeout or task.exception()
+                print(f"⏱️ 階段 {tasks[task]} 超時，保留其他階段的結果")
+
+            errors = [t for t in failed if t not in timed_out]
+            if errors:
+                await self._cancel_all(pending)
+                self.total_duration = time.time() - start_time
+                error = errors[0].exception()
+                print(f"❌ 階段 {tasks[errors[0]]} 失敗，已取消其餘 {len(pending)} 個階段: {type(error).__name__}")
+                raise error
+
+        self.total_duration = time.time() - start_time
+        if first_timeout is not None and not self.results:
+            raise first_timeout
+        return self.results
+
+    @staticmethod
+    async def _cancel_all(tasks):
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,143 @@
+from config import (
+    ANSWER_MAX_CHARS, ANSWER_MAX_TOKENS, ANSWER_OVERSIZE_POLICY, ANSWER_OVERSIZE_MODEL, UPLOAD_MAX_HTML_BYTES,
+    LLM_EXPECTED_COMPLETION_TOKENS, LLM_PRICE_INPUT_PER_1M, LLM_PRICE_OUTPUT_PER_1M,
+)
+from grading import GradingService
+from llm_retry import retry_policy
+from prompt_registry import prompt_registry
+from token_counter import estimate_tokens, estimate_messages_tokens, truncate_to_tokens
+
+OVERSIZE_POLICIES = ("reject", "trim", "route")
+TRIM_NOTICE = "\n\n[...作答內容過長，以下已截斷 / Answer truncated due to length...]"
+
+
+class AnswerTooLargeError(Exception):
+    """作答超過題目的 token 上限且策略為 reject 時拋出"""
+
+    def __init__(self, answer_tokens, max_tokens):
+        super().__init__(f"Answer has {answer_tokens} tokens, limit is {max_tokens}")
+        self.answer_tokens = answer_tokens
+        self.max_tokens = max_tokens
+
+
+class UploadLimitError(Exception):
+    """上傳檔案或作答超過題目的硬上限（不論 oversize_policy 都拒絕）"""
+
+    def __init__(self, kind, actual, limit):
+        super().__init__(f"Upload has {actual} {kind}, limit is {limit}")
+        self.kind = kind  # "bytes" 或 "chars"
+        self.actual = actual
+        self.limit = limit
+
+
+def get_upload_limits(question_title):
+    """
+    讀取題目的上傳硬上限（manifest 的 max_upload_bytes / max_answer_chars，0 代表不限制）
+
+    Returns:
+        dict: {"max_upload_bytes": int, "max_answer_chars": int}
+    """
+    entry = prompt_registry.get_entry(question_title) or {}
+    return {
+        "max_upload_bytes": int(entry.get("max_upload_bytes", UPLOAD_MAX_HTML_BYTES)),
+        "max_answer_chars": int(entry.get("max_answer_chars", ANSWER_MAX_CHARS)),
+    }
+
+
+def check_upload_limits(question_title, upload_bytes, answer_text):
+    """
+    檢查（清理後的）上傳大小與作答字元數
+
+    Raises:
+        UploadLimitError: 超過題目的 max_upload_bytes 或 max_answer_chars
+    """
+    limits = get_upload_limits(question_title)
+    if limits["max_upload_bytes"] and upload_bytes > limits["max_upload_bytes"]:
+        raise UploadLimitError("bytes", upload_bytes, limits["max_upload_bytes"])
+    if limits["max_answer_chars"] and len(answer_text) > limits["max_answer_chars"]:
+        raise UploadLimitError("chars", len(answer_text), limits["max_answer_chars"])
+
+
+def get_answer_limits(question_title):
+    """
+    讀取題目的作答長度設定（manifest 的 max_answer_tokens / oversize_policy / oversize_model）
+
+    Returns:
+        dict: {"max_answer_tokens": int, "oversize_policy": str, "oversize_model": str}
+    """
+    entry = prompt_registry.get_entry(question_title) or {}
+    policy = entry.get("oversize_policy", ANSWER_OVERSIZE_POLICY)
+    if policy not in OVERSIZE_POLICIES:
+        print(f"⚠️ 題目 '{question_title}' 的 oversize_policy '{policy}' 無效，改用 reject")
+        policy = "reject"
+    return {
+        "max_answer_tokens": int(entry.get("max_answer_tokens", ANSWER_MAX_TOKENS)),
+        "oversize_policy": policy,
+        "oversize_model": entry.get("oversize_model", ANSWER_OVERSIZE_MODEL),
+    }
+
+
+def estimate_cost(prompt_tokens, completion_tokens):
+    """依設定的單價估計一次請求的費用（美元）"""
+    return (prompt_tokens * LLM_PRICE_INPUT_PER_1M + completion_tokens * LLM_PRICE_OUTPUT_PER_1M) / 1_000_000
+
+
+def check_submission(question_title, prompts, student_name, answer_text, model=None):
+    """
+    評分前檢查：計算 system prompt + 作答的 token 數，依題目設定處理過長的作答，
+    並記錄預估費用與延遲
+
+    Args:
+        question_title (str): 題目標題
+        prompts (list): 這份作業會用到的評分 prompt（英語、統計）
+        student_name (str): 學生姓名
+        answer_text (str): 作答內容
+        model (str, optional): 指定使用的模型（未指定時由 model_router 依題目與面向決定）
+
+    Returns:
+        dict: {"answer_text", "answer_tokens", "prompt_tokens", "model", "trimmed",
+               "estimated_cost", "estimated_latency"}
+
+    Raises:
+        AnswerTooLargeError: 作答過長且策略為 reject
+    """
+    limits = get_answer_limits(question_title)
+    max_tokens = limits["max_answer_tokens"]
+    answer_tokens = estimate_tokens(answer_text)
+    trimmed = False
+
+    if answer_tokens > max_tokens:
+        policy = limits["oversize_policy"]
+        print(f"📏 作答 {answer_tokens} tokens 超過上限 {max_tokens}（題目 '{question_title}'，策略 {policy}）")
+        if policy == "reject":
+            raise AnswerTooLargeError(answer_tokens, max_tokens)
+        if policy == "trim":
+            answer_text = truncate_to_tokens(answer_text, max_tokens) + TRIM_NOTICE
+            answer_tokens = estimate_tokens(answer_text)
+            trimmed = True
+        else:
+            model = limits["oversize_model"]
+
+    prompt_tokens = sum(
+        estimate_messages_tokens(GradingService.create_messages(prompt, student_name, answer_text))
+        for prompt in prompts
+    )
+    completion_tokens = LLM_EXPECTED_COMPLETION_TOKENS * len(prompts)
+    estimated_cost = estimate_cost(prompt_tokens, completion_tokens)
+    estimated_latency = retry_policy.latency.percentile(50)
+
+    latency_text = f"{estimated_latency:.1f} 秒" if estimated_latency is not None else "未知"
+    print(
+        f"🧮 評分前檢查 '{question_title}'：模型 {model or '依題目設定'}，prompt 約 {prompt_tokens} tokens"
+        f"（作答 {answer_tokens}），預估費用 ${estimated_cost:.4f}，預估延遲 {latency_text}"
+    )
+
+    return {
+        "answer_text": answer_text,
+        "answer_tokens": answer_tokens,
+        "prompt_tokens": prompt_tokens,
+        "model": model,  # 只有 route 策略或呼叫端指定時才有值
+        "trimmed": trimmed,
+        "estimated_cost": estimated_cost,
+        "estimated_latency": estimated_latency,
+    }
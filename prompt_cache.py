@@ -0,0 +1,97 @@
+import hashlib
+import time
+from config import LLM_PRICE_INPUT_PER_1M, LLM_PRICE_CACHED_INPUT_PER_1M
+
+
+def make_prompt_cache_key(prompt):
+    """
+    依 system prompt 內容產生 prompt_cache_key
+
+    相同 prompt 的請求帶相同 key，供應商會盡量導向同一台已快取前綴的伺服器
+    """
+    return "grading-" + hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+
+
+def cached_tokens_from_usage(usage):
+    """從 API 回傳的 usage 取出命中供應商 prompt 快取的 token 數（沒有提供時為 0）"""
+    details = (usage or {}).get("prompt_tokens_details") or {}
+    return details.get("cached_tokens") or 0
+
+
+class PromptCacheStats:
+    """
+    依評分 prompt 統計供應商端 prompt 快取的命中情況
+
+    - 每個 prompt 累計請求數、prompt token、命中快取的 token
+    - 分別記錄有命中與沒命中時的平均延遲，並依單價估計節省的費用
+    """
+
+    def __init__(self):
+        self._prompts = {}  # prompt_cache_key -> 統計
+
+    def record(self, cache_key, usage, duration, label=None):
+        if not usage:
+            return
+        entry = self._prompts.get(cache_key)
+        if entry is None:
+            entry = self._prompts[cache_key] = {
+                "label": label or cache_key,
+                "requests": 0,
+                "hits": 0,
+                "prompt_tokens": 0,
+                "cached_tokens": 0,
+                "hit_duration": 0.0,
+                "miss_duration": 0.0,
+                "last_used": 0.0,
+            }
+        elif label:
+            entry["label"] = label
+
+        cached_tokens = cached_tokens_from_usage(usage)
+        entry["requests"] += 1
+        entry["prompt_tokens"] += usage.get("prompt_tokens") or 0
+        entry["cached_tokens"] += cached_tokens
+        entry["last_used"] = time.time()
+        if cached_tokens:
+            entry["hits"] += 1
+            entry["hit_duration"] += duration
+        else:
+            entry["miss_duration"] += duration
+
+    @staticmethod
+    def _summarize(entry):
+        misses = entry["requests"] - entry["hits"]
+        return {
+            "label": entry["label"],
+            "requests": entry["requests"],
+            "hit_rate": entry["hits"] / entry["requests"] if entry["requests"] else 0.0,
+            "prompt_tokens": entry["prompt_tokens"],
+            "cached_tokens": entry["cached_tokens"],
+            "cached_ratio": entry["cached_tokens"] / entry["prompt_tokens"] if entry["prompt_tokens"] else 0.0,
+            "average_hit_duration": entry["hit_duration"] / entry["hits"] if entry["hits"] else None,
+            "average_miss_duration": entry["miss_duration"] / misses if misses else None,
+            "saved_cost": entry["cached_tokens"] * (LLM_PRICE_INPUT_PER_1M - LLM_PRICE_CACHED_INPUT_PER_1M) / 1_000_000,
+        }
+
+    def stats(self, limit=None):
+        """各 prompt 的統計（最近使用的在前）"""
+        entries = sorted(self._prompts.values(), key=lambda entry: entry["last_used"], reverse=True)
+        if limit is not None:
+            entries = entries[:limit]
+        return [self._summarize(entry) for entry in entries]
+
+    def totals(self):
+        prompt_tokens = sum(entry["prompt_tokens"] for entry in self._prompts.values())
+        cached_tokens = sum(entry["cached_tokens"] for entry in self._prompts.values())
+        return {
+            "prompts": len(self._prompts),
+            "requests": sum(entry["requests"] for entry in self._prompts.values()),
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": cached_tokens,
+            "cached_ratio": cached_tokens / prompt_tokens if prompt_tokens else 0.0,
+            "saved_cost": cached_tokens * (LLM_PRICE_INPUT_PER_1M - LLM_PRICE_CACHED_INPUT_PER_1M) / 1_000_000,
+        }
+
+
+# 全程式共用的 prompt 快取統計
+prompt_cache_stats = PromptCacheStats()
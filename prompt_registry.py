@@ -0,0 +1,223 @@
+import os
+import json
+from datetime import datetime
+from config import PROMPTS_DIR, PROMPT_MANIFEST_PATH, DEFAULT_ENGLISH_PROMPT, SPECIFIC_PROMPTS, PROMPT_AUTO_DISCOVER
+
+
+class PromptRegistry:
+    """
+    題目 Prompt 的記憶體快取
+
+    - 啟動時把所有 prompt 檔案讀進記憶體，查詢時完全不碰磁碟
+    - refresh() 只比對檔案 mtime，只有被修改過的檔案才會重新讀取
+    - 題目對應來源（後者覆蓋前者）：
+        1. 自動探索（需開啟 PROMPT_AUTO_DISCOVER）：prompts/ 內檔名與題目同名的 .txt（英語評分使用預設 Eng_prompt.txt）
+        2. config.py 的 SPECIFIC_PROMPTS
+        3. prompts/manifest.json（新增題目不需改程式碼）
+    """
+
+    def __init__(self, prompts_dir=PROMPTS_DIR, manifest_path=PROMPT_MANIFEST_PATH,
+                 default_english=DEFAULT_ENGLISH_PROMPT, specific_prompts=None, auto_discover=PROMPT_AUTO_DISCOVER):
+        self.prompts_dir = prompts_dir
+        self.manifest_path = manifest_path
+        self.default_english = default_english
+        self.specific_prompts = SPECIFIC_PROMPTS if specific_prompts is None else specific_prompts
+        self.auto_discover = auto_discover
+
+        self._files = {}         # 檔案路徑 -> (mtime, 內容)
+        self._mapping = {}       # 題目 -> 設定字典（english/statistics 為絕對路徑，其他欄位原樣保留）
+        self._mapping_signature = None
+        self.loaded = False
+
+    # ---------- 載入與更新 ----------
+    def load(self):
+        """啟動時完整載入所有題目對應與 prompt 內容"""
+        self._mapping_signature = None
+        self._files = {}
+        self.refresh()
+        self.loaded = True
+        print(f"📚 Prompt 已預載入：{len(self._mapping)} 個題目，{len(self._files)} 個檔案")
+
+    def refresh(self):
+        """
+        檢查 manifest 與 prompt 目錄是否有變動，只重新讀取 mtime 改變的檔案
+
+        Returns:
+            int: 本次重新讀取的檔案數量
+        """
+        signature = self._directory_signature()
+        if signature != self._mapping_signature:
+            self._mapping = self._build_mapping()
+            self._mapping_signature = signature
+
+        wanted_paths = set()
+        for entry in self._mapping.values():
+            wanted_paths.add(entry["english"])
+            wanted_paths.add(entry["statistics"])
+
+        reloaded = 0
+        for path in wanted_paths:
+            mtime = self._get_mtime(path)
+            if mtime is None:
+                if path in self._files:
+                    print(f"⚠️ Prompt 檔案已被移除: {path}")
+                    del self._files[path]
+                continue
+
+            cached = self._files.get(path)
+            if cached and cached[0] == mtime:
+                continue
+
+            content = self._read_file(path)
+            if content is not None:
+                if cached:
+                    print(f"🔄 Prompt 檔案已更新，重新載入: {os.path.basename(path)}")
+                self._files[path] = (mtime, content)
+                reloaded += 1
+
+        # 移除已不再被任何題目引用的檔案
+        for path in list(self._files):
+            if path not in wanted_paths:
+                del self._files[path]
+
+        return reloaded
+
+    def _directory_signature(self):
+        """目錄內容或 manifest 改變時，簽章就會不同"""
+        try:
+            names = tuple(sorted(os.listdir(self.prompts_dir)))
+        except OSError:
+            names = ()
+        return names, self._get_mtime(self.manifest_path)
+
+    def _build_mapping(self):
+        mapping = {}
+
+        # 1. 自動探索：題目同名的 prompt 檔案（預設關閉，避免 prompts/ 內的任何檔名都變成可評分的題目）
+        filenames = []
+        if self.auto_discover:
+            try:
+                filenames = sorted(os.listdir(self.prompts_dir))
+            except OSError:
+                filenames = []
+        default_name = os.path.basename(self.default_english)
+        manifest_name = os.path.basename(self.manifest_path)
+        for filename in filenames:
+            if not filename.endswith(".txt") or filename in (default_name, manifest_name):
+                continue
+            title = filename[:-len(".txt")]
+            mapping[title] = {
+                "english": self.default_english,
+                "statistics": os.path.join(self.prompts_dir, filename),
+            }
+
+        # 2. config.py 中手動設定的對應
+        for title, prompt_config in self.specific_prompts.items():
+            entry = self._normalize_entry(title, prompt_config)
+            if entry:
+                mapping[title] = entry
+
+        # 3. manifest.json
+        for title, prompt_config in self._read_manifest().items():
+            entry = self._normalize_entry(title, prompt_config)
+            if entry:
+                mapping[title] = entry
+
+        return mapping
+
+    def _read_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {}
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"❌ 讀取 prompt manifest 失敗: {self.manifest_path}, 錯誤: {e}")
+            return {}
+
+        if not isinstance(manifest, dict):
+            print(f"⚠️ 警告：prompt manifest 格式錯誤（必須是 JSON 物件）: {self.manifest_path}")
+            return {}
+        return manifest
+
+    def _normalize_entry(self, title, prompt_config):
+        """將題目設定轉為統一格式，english/statistics 轉為絕對路徑"""
+        if not isinstance(prompt_config, dict):
+            print(f"⚠️ 警告：題目 '{title}' 的 prompt 配置格式錯誤")
+            return None
+
+        stat_file = prompt_config.get("statistics")
+        if not stat_file:
+            print(f"⚠️ 警告：題目 '{title}' 未設定 statistics prompt")
+            return None
+
+        entry = dict(prompt_config)
+        entry["english"] = self._resolve_path(prompt_config.get("english") or self.default_english)
+        entry["statistics"] = self._resolve_path(stat_file)
+        return entry
+
+    def _resolve_path(self, path):
+        if os.path.isabs(path):
+            return path
+        return os.path.join(self.prompts_dir, path)
+
+    @staticmethod
+    def _get_mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    @staticmethod
+    def _read_file(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read()
+        except Exception as e:
+            print(f"❌ 讀取 prompt 檔案失敗: {path}, 錯誤: {e}")
+            return None
+
+    # ---------- 查詢（僅使用記憶體） ----------
+    def get_entry(self, question_title):
+        """取得題目的完整設定字典，找不到時回傳 None"""
+        return self._mapping.get(question_title)
+
+    def get_prompts(self, question_title):
+        """
+        Returns:
+            (eng_prompt, stat_prompt) or (None, None) if not found
+        """
+        entry = self._mapping.get(question_title)
+        if not entry:
+            return None, None
+
+        eng = self._files.get(entry["english"])
+        stat = self._files.get(entry["statistics"])
+        if not eng or not stat:
+            print(f"❌ 無法取得 prompt 內容: eng={entry['english']}, stat={entry['statistics']}")
+            return None, None
+        return eng[1], stat[1]
+
+    def get_deadline(self, question_title):
+        """
+        讀取題目的繳交期限（manifest 的 deadline，ISO 8601 格式；未指定時區視為本地時間）
+
+        Returns:
+            float: Unix timestamp，未設定或格式錯誤時回傳 None
+        """
+        entry = self._mapping.get(question_title) or {}
+        deadline = entry.get("deadline")
+        if not deadline:
+            return None
+        try:
+            return datetime.fromisoformat(str(deadline)).timestamp()
+        except ValueError:
+            print(f"⚠️ 題目 '{question_title}' 的 deadline 格式錯誤: {deadline}")
+            return None
+
+    def titles(self):
+        return sorted(self._mapping)
+
+
+# 全程式共用的 Prompt 快取
+prompt_registry = PromptRegistry()
@@ -0,0 +1,159 @@
+import asyncio
+import time
+from config import (
+    LLM_RPM_LIMIT, LLM_TPM_LIMIT,
+    LLM_MAX_CONCURRENCY, LLM_MIN_CONCURRENCY,
+)
+
+
+class TokenBucket:
+    """每分鐘補滿 capacity 的 token bucket（允許短暫負值代表超支）"""
+
+    def __init__(self, capacity_per_minute):
+        self.capacity = float(capacity_per_minute)
+        self.tokens = float(capacity_per_minute)
+        self.refill_per_second = self.capacity / 60.0
+        self._updated_at = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated_at) * self.refill_per_second)
+        self._updated_at = now
+
+    def time_until(self, amount):
+        """還要等幾秒才有足夠額度（單次需求超過容量時以容量計）"""
+        amount = min(amount, self.capacity)
+        self.refill()
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.refill_per_second
+
+    def consume(self, amount):
+        self.refill()
+        self.tokens -= amount
+
+    def drain(self):
+        self.refill()
+        self.tokens = min(self.tokens, 0.0)
+
+
+class RateLimiter:
+    """
+    全程式共用的 LLM 請求限流器
+
+    - 依 RPM（每分鐘請求數）與 TPM（每分鐘 token 數）兩個 token bucket 放行請求
+    - 請求前以估計的 prompt + completion token 數預扣額度，完成後以實際用量校正
+    - 收到 429 時將允許的並行數減半並暫停放行（AIMD），之後每連續成功數次再逐步調回
+    """
+
+    SUCCESSES_PER_INCREASE = 10
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, rpm=LLM_RPM_LIMIT, tpm=LLM_TPM_LIMIT,
+                 max_concurrency=LLM_MAX_CONCURRENCY, min_concurrency=LLM_MIN_CONCURRENCY):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency_limit = max_concurrency
+        self.in_flight = 0
+        self.waiting = 0
+        self.paused_until = 0.0
+
+        self._lock = None
+        self._success_streak = 0
+        self.rate_limited_count = 0
+        self.admitted_count = 0
+        self.total_wait = 0.0
+
+    def _get_lock(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def acquire(self, estimated_tokens):
+        """
+        等待直到 RPM、TPM 與並行數都允許此請求
+
+        Returns:
+            dict: 放行憑證，完成後交給 release()
+        """
+        start = time.monotonic()
+        self.waiting += 1
+        try:
+            # 以鎖確保先到先放行，避免大請求一直被小請求插隊
+            async with self._get_lock():
+                while True:
+                    now = time.monotonic()
+                    wait = max(
+                        self.paused_until - now,
+                        self.requests.time_until(1),
+                        self.tokens.time_until(estimated_tokens),
+                    )
+                    if wait <= 0 and self.in_flight < self.concurrency_limit:
+                        break
+                    await asyncio.sleep(min(max(wait, self.POLL_INTERVAL), 5.0))
+
+                self.requests.consume(1)
+                self.tokens.consume(estimated_tokens)
+                self.in_flight += 1
+                self.admitted_count += 1
+        finally:
+            self.waiting -= 1
+
+        waited = time.monotonic() - start
+        self.total_wait += waited
+        if waited > 1:
+            print(f"🚦 LLM 請求限流等待 {waited:.1f} 秒（預估 {estimated_tokens} tokens）")
+        return {"estimated_tokens": estimated_tokens}
+
+    def release(self, ticket, actual_tokens=None, rate_limited=False, retry_after=None):
+        """
+        請求結束後歸還並行額度，並依實際用量與是否遇到 429 調整
+
+        Args:
+            ticket (dict): acquire() 回傳的憑證
+            actual_tokens (int, optional): API 回報的 total_tokens
+            rate_limited (bool): 是否收到 429
+            retry_after (float, optional): 429 回應的 Retry-After 秒數
+        """
+        self.in_flight = max(0, self.in_flight - 1)
+
+        if actual_tokens is not None:
+            # 預扣與實際用量的差額：多退少補
+            self.tokens.consume(actual_tokens - ticket["estimated_tokens"])
+
+        if rate_limited:
+            self.rate_limited_count += 1
+            self._success_streak = 0
+            previous = self.concurrency_limit
+            self.concurrency_limit = max(self.min_concurrency, self.concurrency_limit // 2)
+            self.tokens.drain()
+            pause = retry_after if retry_after else 60.0 / max(self.requests.capacity, 1) * 5
+            self.paused_until = max(self.paused_until, time.monotonic() + pause)
+            print(f"⚠️ 收到 429，並行上限 {previous} → {self.concurrency_limit}，暫停 {pause:.1f} 秒")
+        elif actual_tokens is not None:
+            self._success_streak += 1
+            if self._success_streak >= self.SUCCESSES_PER_INCREASE and self.concurrency_limit < self.max_concurrency:
+                self.concurrency_limit += 1
+                self._success_streak = 0
+
+    def stats(self):
+        self.requests.refill()
+        self.tokens.refill()
+        return {
+            "rpm_available": self.requests.tokens,
+            "rpm_capacity": self.requests.capacity,
+            "tpm_available": self.tokens.tokens,
+            "tpm_capacity": self.tokens.capacity,
+            "concurrency_limit": self.concurrency_limit,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "rate_limited": self.rate_limited_count,
+            "admitted": self.admitted_count,
+            "average_wait": self.total_wait / self.admitted_count if self.admitted_count else 0.0,
+        }
+
+
+# 全程式共用的限流器
+rate_limiter = RateLimiter()
@@ -2,8 +2,127 @@ import html
 import markdown
 import os
 import datetime
+import threading
 import docx  # 👈 新增：匯入 docx 模組用來讀取 Word 檔
 
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+QUESTION_DIR = os.path.join(BASE_DIR, "Question")
+ANSWER_DIR = os.path.join(BASE_DIR, "Answer")
+FRAGMENT_EXTENSIONS = (".docx", ".md", ".txt")
+
+PROBLEM_NOT_FOUND = "未提供完整題目 (Problem statement not found)"
+SOLUTION_NOT_FOUND = "未提供完整答案 (Model solution not found)"
+
+
+def read_file_content(directory, title):
+    """輔助函式：優先讀取 .docx，若無則讀取 .md 或 .txt"""
+    # 1. 嘗試讀取 .docx
+    docx_path = os.path.join(directory, f"{title}.docx")
+    if os.path.exists(docx_path):
+        try:
+            doc = docx.Document(docx_path)
+            # 將 Word 檔內的段落文字合併，並用換行符號隔開
+            return "\n\n".join([p.text for p in doc.paragraphs if p.text.strip()])
+        except Exception as e:
+            print(f"讀取 Word 檔案失敗 {docx_path}: {e}")
+
+    # 2. 嘗試讀取 .md 或 .txt
+    for ext in [".md", ".txt"]:
+        file_path = os.path.join(directory, f"{title}{ext}")
+        if os.path.exists(file_path):
+            try:
+                with open(file_path, "r", encoding="utf-8") as f:
+                    return f.read()
+            except Exception as e:
+                print(f"讀取文字檔案失敗 {file_path}: {e}")
+
+    return None
+
+
+class ReportFragmentCache:
+    """
+    快取每題「完整題目」與「完整解答」轉換後的 HTML 片段
+
+    - 以題目標題為 key，並記錄 Question/、Answer/ 下候選檔案（.docx / .md / .txt）的 mtime
+    - 取用時只比對 mtime（os.stat），檔案新增、修改或刪除後才重新讀取 Word 檔並轉換 Markdown
+    - 報告在執行緒池中生成，以 lock 保護快取內容
+    """
+
+    def __init__(self, question_dir=QUESTION_DIR, answer_dir=ANSWER_DIR):
+        self.question_dir = question_dir
+        self.answer_dir = answer_dir
+        self._entries = {}  # title -> (signature, problem_html, solution_html)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.renders = 0
+
+    def _signature(self, title):
+        signature = []
+        for directory in (self.question_dir, self.answer_dir):
+            for ext in FRAGMENT_EXTENSIONS:
+                try:
+                    signature.append(os.stat(os.path.join(directory, f"{title}{ext}")).st_mtime_ns)
+                except OSError:
+                    signature.append(None)
+        return tuple(signature)
+
+    def _render(self, title):
+        problem_statement = read_file_content(self.question_dir, title) or PROBLEM_NOT_FOUND
+        model_solution = read_file_content(self.answer_dir, title) or SOLUTION_NOT_FOUND
+        # 將題目與答案轉換為 HTML (即使是 Word 純文字，經過 Markdown 轉換也能有較好的段落排版)
+        problem_html = markdown.markdown(problem_statement, extensions=["tables", "fenced_code"])
+        solution_html = markdown.markdown(model_solution, extensions=["tables", "fenced_code"])
+        return problem_html, solution_html
+
+    def get(self, title):
+        """
+        Returns:
+            (str, str): 題目與解答的 HTML 片段
+        """
+        signature = self._signature(title)
+        with self._lock:
+            entry = self._entries.get(title)
+            if entry is not None and entry[0] == signature:
+                self.hits += 1
+                return entry[1], entry[2]
+
+        problem_html, solution_html = self._render(title)
+        with self._lock:
+            self._entries[title] = (signature, problem_html, solution_html)
+            self.renders += 1
+        return problem_html, solution_html
+
+    def warm(self, titles):
+        """
+        預先轉換多個題目（啟動時與定期檢查時呼叫），只處理尚未快取或檔案已變動的題目
+
+        Returns:
+            int: 重新轉換的題目數
+        """
+        rendered = 0
+        for title in titles:
+            title = title.strip()
+            signature = self._signature(title)
+            with self._lock:
+                entry = self._entries.get(title)
+            if entry is not None and entry[0] == signature:
+                continue
+            problem_html, solution_html = self._render(title)
+            with self._lock:
+                self._entries[title] = (signature, problem_html, solution_html)
+                self.renders += 1
+            rendered += 1
+        return rendered
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "renders": self.renders}
+
+
+# 全程式共用的題目/解答片段快取
+report_fragment_cache = ReportFragmentCache()
+
+
 def generate_html_report(
     student_name,
     student_id,
@@ -27,53 +146,8 @@ def generate_html_report(
         escaped = html.escape(text)
         return escaped.replace(placeholder, "<br>")
 
-    # ======== 讀取完整題目與完整答案 ========
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    question_dir = os.path.join(base_dir, "Question")
-    answer_dir = os.path.join(base_dir, "Answer")
-    
-    problem_statement = "未提供完整題目 (Problem statement not found)"
-    model_solution = "未提供完整答案 (Model solution not found)"
-    
-    safe_title = question_number.strip()
-    
-    def read_file_content(directory, title):
-        """輔助函式：優先讀取 .docx，若無則讀取 .md 或 .txt"""
-        # 1. 嘗試讀取 .docx
-        docx_path = os.path.join(directory, f"{title}.docx")
-        if os.path.exists(docx_path):
-            try:
-                doc = docx.Document(docx_path)
-                # 將 Word 檔內的段落文字合併，並用換行符號隔開
-                return "\n\n".join([p.text for p in doc.paragraphs if p.text.strip()])
-            except Exception as e:
-                print(f"讀取 Word 檔案失敗 {docx_path}: {e}")
-                
-        # 2. 嘗試讀取 .md 或 .txt
-        for ext in [".md", ".txt"]:
-            file_path = os.path.join(directory, f"{title}{ext}")
-            if os.path.exists(file_path):
-                try:
-                    with open(file_path, "r", encoding="utf-8") as f:
-                        return f.read()
-                except Exception as e:
-                    print(f"讀取文字檔案失敗 {file_path}: {e}")
-        
-        return None
-
-    # 讀取題目
-    q_content = read_file_content(question_dir, safe_title)
-    if q_content:
-        problem_statement = q_content
-        
-    # 讀取答案
-    a_content = read_file_content(answer_dir, safe_title)
-    if a_content:
-        model_solution = a_content
-
-    # 將題目與答案轉換為 HTML (即使是 Word 純文字，經過 Markdown 轉換也能有較好的段落排版)
-    problem_html = markdown.markdown(problem_statement, extensions=["tables", "fenced_code"])
-    solution_html = markdown.markdown(model_solution, extensions=["tables", "fenced_code"])
+    # ======== 完整題目與完整答案（同一題的所有報告共用快取的 HTML 片段） ========
+    problem_html, solution_html = report_fragment_cache.get(question_number.strip())
     # ==========================================
 
     # 處理學生作答內容
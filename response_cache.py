@@ -0,0 +1,256 @@
+import asyncio
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from config import (
+    LLM_CACHE_ENABLED, LLM_CACHE_DB_PATH, LLM_CACHE_TTL,
+    LLM_CACHE_MEMORY_BYTES, LLM_CACHE_MAX_BYTES,
+)
+
+
+class ResponseCache:
+    """
+    LLM 評分結果的內容定址快取
+
+    - key：模型、messages 與所有請求參數的 SHA-256；messages 中的學生姓名以 NAME_PLACEHOLDER 代替、
+      作答先正規化，因此不同學生交出相同作答（例如未修改的範本）時共用同一筆快取
+    - 寫入前把回饋中的學生姓名換成 NAME_PLACEHOLDER（anonymize），命中時換回目前學生的姓名（personalize）
+    - 第一層：記憶體 LRU（依總位元組數淘汰）
+    - 第二層：SQLite（依總位元組數淘汰最久未使用的項目）
+    - 兩層都套用 TTL，並記錄命中 / 未命中次數
+    - 在 event loop 中請使用 aget / aput（SQLite 讀寫在執行緒中進行，以 lock 保護）
+    """
+
+    def __init__(self, db_path=LLM_CACHE_DB_PATH, ttl=LLM_CACHE_TTL,
+                 memory_bytes=LLM_CACHE_MEMORY_BYTES, max_disk_bytes=LLM_CACHE_MAX_BYTES):
+        self.ttl = ttl
+        self.memory_bytes = memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+
+        self._memory = OrderedDict()  # key -> (created_at, feedback, size)
+        self._memory_size = 0
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.cur = self.conn.cursor()
+        self._create_tables()
+
+    def _create_tables(self):
+        self.cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS LLMResponseCache (
+                cache_key CHAR(64) PRIMARY KEY,
+                model VARCHAR(100),
+                feedback TEXT NOT NULL,
+                size_bytes INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """
+        )
+        self.cur.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_last_access ON LLMResponseCache(last_access)")
+        self.conn.commit()
+
+    # 快取中代替學生姓名的標記
+    NAME_PLACEHOLDER = "{{student_name}}"
+
+    # ---------- Key ----------
+    @staticmethod
+    def normalize_answer(text):
+        """正規化作答內容：統一 Unicode 與換行、去除每行前後空白與空行"""
+        text = unicodedata.normalize("NFKC", text or "")
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+        lines = [" ".join(line.split()) for line in text.split("\n")]
+        return "\n".join(line for line in lines if line)
+
+    @staticmethod
+    def make_key(model, messages, params=None):
+        """
+        依請求產生 key：模型、messages 與所有請求參數
+        （temperature、max_completion_tokens 等；params 中值為 None 的項目不影響 key）
+
+        messages 應以 NAME_PLACEHOLDER 代替學生姓名、作答經 normalize_answer 正規化
+        """
+        request = {
+            "model": model,
+            "messages": messages,
+            "params": {k: v for k, v in (params or {}).items() if v is not None},
+        }
+        data = json.dumps(request, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    # ---------- 學生姓名 ----------
+    @staticmethod
+    def anonymize(feedback, student_name):
+        """寫入快取前把回饋中的學生姓名換成 NAME_PLACEHOLDER（前後緊鄰英文字母時不算，例如 Li 與 Linear）"""
+        name = (student_name or "").strip()
+        if not name or not feedback:
+            return feedback
+        pattern = re.compile(rf"(?<![A-Za-z]){re.escape(name)}(?![A-Za-z])")
+        return pattern.sub(lambda _: ResponseCache.NAME_PLACEHOLDER, feedback)
+
+    @staticmethod
+    def personalize(feedback, student_name):
+        """把快取回饋中的 NAME_PLACEHOLDER 換回目前學生的姓名"""
+        return feedback.replace(ResponseCache.NAME_PLACEHOLDER, (student_name or "").strip())
+
+    # ---------- 查詢 / 寫入 ----------
+    async def aget(self, key):
+        """get 的非同步版本：在執行緒中查詢，不阻塞 event loop"""
+        return await asyncio.to_thread(self.get, key)
+
+    async def aput(self, key, model, feedback):
+        """put 的非同步版本：在執行緒中寫入，不阻塞 event loop"""
+        await asyncio.to_thread(self.put, key, model, feedback)
+
+    def get(self, key):
+        """取得快取的評分內容，找不到或已過期時回傳 None"""
+        with self._lock:
+            return self._get(key)
+
+    def _get(self, key):
+        now = time.time()
+
+        item = self._memory.get(key)
+        if item:
+            created_at, feedback, _ = item
+            if now - created_at <= self.ttl:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return feedback
+            self._remove_memory(key)
+
+        try:
+            self.cur.execute(
+                "SELECT feedback, created_at FROM LLMResponseCache WHERE cache_key = ?", (key,)
+            )
+            row = self.cur.fetchone()
+            if row:
+                feedback, created_at = row
+                if now - created_at <= self.ttl:
+                    self.cur.execute(
+                        "UPDATE LLMResponseCache SET last_access = ? WHERE cache_key = ?", (now, key)
+                    )
+                    self.conn.commit()
+                    self._put_memory(key, created_at, feedback)
+                    self.disk_hits += 1
+                    return feedback
+                self.cur.execute("DELETE FROM LLMResponseCache WHERE cache_key = ?", (key,))
+                self.conn.commit()
+        except sqlite3.Error as e:
+            print(f"⚠️ 讀取 LLM 快取失敗: {e}")
+
+        self.misses += 1
+        return None
+
+    def put(self, key, model, feedback):
+        """寫入快取（記憶體與 SQLite）"""
+        if not feedback:
+            return
+        with self._lock:
+            self._put(key, model, feedback)
+
+    def _put(self, key, model, feedback):
+        now = time.time()
+        self._put_memory(key, now, feedback)
+
+        try:
+            self.cur.execute(
+                """
+                INSERT OR REPLACE INTO LLMResponseCache
+                (cache_key, model, feedback, size_bytes, created_at, last_access)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """,
+                (key, model, feedback, len(feedback.encode("utf-8")), now, now),
+            )
+            self.conn.commit()
+            self._evict_disk()
+        except sqlite3.Error as e:
+            print(f"⚠️ 寫入 LLM 快取失敗: {e}")
+            self.conn.rollback()
+
+    # ---------- 淘汰 ----------
+    def _put_memory(self, key, created_at, feedback):
+        self._remove_memory(key)
+        size = len(feedback.encode("utf-8"))
+        self._memory[key] = (created_at, feedback, size)
+        self._memory_size += size
+        while self._memory_size > self.memory_bytes and len(self._memory) > 1:
+            oldest_key = next(iter(self._memory))
+            self._remove_memory(oldest_key)
+
+    def _remove_memory(self, key):
+        item = self._memory.pop(key, None)
+        if item:
+            self._memory_size -= item[2]
+
+    def _evict_disk(self):
+        """刪除過期項目，並在超過容量上限時刪除最久未使用的項目"""
+        self.cur.execute("DELETE FROM LLMResponseCache WHERE created_at < ?", (time.time() - self.ttl,))
+        self.cur.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM LLMResponseCache")
+        total = self.cur.fetchone()[0]
+        if total > self.max_disk_bytes:
+            excess = total - self.max_disk_bytes
+            self.cur.execute("SELECT cache_key, size_bytes FROM LLMResponseCache ORDER BY last_access ASC")
+            to_delete = []
+            for cache_key, size_bytes in self.cur.fetchall():
+                if excess <= 0:
+                    break
+                to_delete.append((cache_key,))
+                excess -= size_bytes
+            self.cur.executemany("DELETE FROM LLMResponseCache WHERE cache_key = ?", to_delete)
+            print(f"🧹 LLM 快取超過容量上限，已淘汰 {len(to_delete)} 筆")
+        self.conn.commit()
+
+    # ---------- 統計 ----------
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        hits = self.memory_hits + self.disk_hits
+        try:
+            with self._lock:
+                self.cur.execute("SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM LLMResponseCache")
+                disk_entries, disk_bytes = self.cur.fetchone()
+        except sqlite3.Error:
+            disk_entries, disk_bytes = 0, 0
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_size,
+            "disk_entries": disk_entries,
+            "disk_bytes": disk_bytes,
+        }
+
+    def close(self):
+        self.conn.close()
+
+
+# 全程式共用的快取：第一次使用時才建立（匯入模組不會建立資料庫檔案）
+_response_cache = None
+
+
+def get_response_cache():
+    """取得共用的回應快取，停用（LLM_CACHE_ENABLED=0）時回傳 None"""
+    global _response_cache
+    if _response_cache is None and LLM_CACHE_ENABLED:
+        _response_cache = ResponseCache()
+    return _response_cache
+
+
+def close_response_cache():
+    """關閉已建立的共用快取（尚未建立時不做任何事）"""
+    global _response_cache
+    if _response_cache is not None:
+        _response_cache.close()
+        _response_cache = None
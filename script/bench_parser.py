@@ -0,0 +1,137 @@
+import argparse
+import os
+import statistics
+import sys
+import time
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from config import UPLOADS_DIR
+from html_parser import parse_submission, parser_stats
+
+
+def build_sample_submission(index, answer_lines=40):
+    """
+    產生與 StatsAnswerFormatter 匯出格式相同的提交（沒有真實檔案時使用）
+
+    依 index 混入不同變化：CRLF 換行、HTML 實體與行內標籤、<script> 區塊（仍走快速路徑），
+    以及改用 <textarea>、沒有 <title>、作答內含區塊元素（需要完整解析）
+    """
+    variant = index % 10
+    lines = [
+        f"({i + 1}) The sample mean is {index + i}.{i % 10}, so we reject H0 at the 5% level "
+        f"because the p-value {0.001 * (i + 1):.3f} is smaller than alpha."
+        for i in range(answer_lines)
+    ]
+    if variant == 2:
+        lines[0] = "<b>Step 1</b> H0: &mu; = 50 &amp; H1: &mu; &ne; 50, p &lt; 0.05&nbsp;"
+    if variant == 9:
+        lines[1] = "<div>Table 1</div>"
+    answer = "<br>\n".join(lines)
+    title = "" if variant == 8 else f"HW{index % 5 + 1} 假設檢定"
+    script = "<script>document.querySelector('label').innerHTML = '<span>x</span>';</script>\n" if variant == 3 else ""
+    if variant == 7:
+        answer_field = f"<div class=\"field\"><textarea>{chr(10).join(lines)}</textarea></div>"
+    else:
+        answer_field = f"<div class=\"field\"><label>作答區：</label><p>{answer}</p></div>"
+    document = f"""<!DOCTYPE html>
+<html lang="zh-Hant">
+<head>
+<meta charset="UTF-8">
+<meta name="viewport" content="width=device-width, initial-scale=1.0">
+<title>{title}</title>
+<style>
+body {{ font-family: "Microsoft JhengHei", sans-serif; margin: 2em; }}
+.field {{ margin-bottom: 0.5em; }}
+label {{ font-weight: bold; }}
+</style>
+{script}</head>
+<body>
+<div class="container">
+<h1>HW{index % 5 + 1} 假設檢定</h1>
+<div class="field"><label>姓名：</label><span>學生{index:03d}</span></div>
+<div class="field"><label>學號：</label><span>1120{index:05d}</span></div>
+<div class="question"><h2>題目</h2><p>Test whether the population mean differs from 50.</p></div>
+{answer_field}
+</div>
+</body>
+</html>
+"""
+    if variant == 1:
+        document = document.replace("\n", "\r\n")
+    return document.encode("utf-8")
+
+
+def load_corpus(paths, synthetic):
+    corpus = []
+    for path in paths:
+        if os.path.isdir(path):
+            names = sorted(n for n in os.listdir(path) if n.lower().endswith(".html"))
+            files = [os.path.join(path, n) for n in names]
+        else:
+            files = [path]
+        for file_path in files:
+            with open(file_path, "rb") as f:
+                corpus.append((file_path, f.read()))
+    if not corpus:
+        corpus = [(f"synthetic-{i}", build_sample_submission(i)) for i in range(synthetic)]
+    return corpus
+
+
+def legacy_parse(raw_html):
+    """舊流程：標題與內容各自以 html.parser 建立一棵樹"""
+    title = parse_submission(raw_html, features="html.parser", fast_path=False)["title"]
+    fields = parse_submission(raw_html, features="html.parser", fast_path=False)
+    fields["title"] = title
+    return fields
+
+
+def full_parse(raw_html):
+    return parse_submission(raw_html, fast_path=False)
+
+
+def bench(label, parse, corpus, repeat):
+    rounds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _, raw_html in corpus:
+            parse(raw_html)
+        rounds.append(time.perf_counter() - start)
+    median = statistics.median(rounds)
+    per_file = median / len(corpus) * 1000
+    print(f"{label:<28} {per_file:8.3f} ms/份  {len(corpus) / median:8.1f} 份/秒")
+    return median
+
+
+def main():
+    parser = argparse.ArgumentParser(description="比較提交解析的速度：舊的兩次 html.parser、單次 lxml 與快速路徑")
+    parser.add_argument("paths", nargs="*", default=[UPLOADS_DIR], help="HTML 檔案或資料夾（預設為 uploads/）")
+    parser.add_argument("--repeat", type=int, default=5, help="重複次數（取中位數）")
+    parser.add_argument("--synthetic", type=int, default=200, help="找不到檔案時產生的範例份數")
+    args = parser.parse_args()
+
+    corpus = load_corpus([p for p in args.paths if os.path.exists(p)], args.synthetic)
+    total_bytes = sum(len(raw_html) for _, raw_html in corpus)
+    print(f"📂 {len(corpus)} 份提交，共 {total_bytes / 1024:.1f} KB")
+
+    # 快速路徑必須與完整解析相同；lxml 與 html.parser 對不合法巢狀（例如 <p> 內的 <div>）的處理本來就不同，只列出供參考
+    mismatches = [name for name, raw_html in corpus if parse_submission(raw_html) != full_parse(raw_html)]
+    parser_diffs = [name for name, raw_html in corpus if full_parse(raw_html) != legacy_parse(raw_html)]
+    for name in mismatches[:10]:
+        print(f"❌ 快速路徑與完整解析結果不同: {name}")
+    for name in parser_diffs[:10]:
+        print(f"ℹ️ lxml 與 html.parser 結果不同: {name}")
+
+    legacy = bench("legacy (2× html.parser)", legacy_parse, corpus, args.repeat)
+    full = bench("full (lxml)", full_parse, corpus, args.repeat)
+    before = parser_stats()
+    fast = bench("parse_submission (fast path)", parse_submission, corpus, args.repeat)
+    after = parser_stats()
+
+    fast_count = (after["fast"] - before["fast"]) // args.repeat
+    full_count = (after["full"] - before["full"]) // args.repeat
+    print(f"🛤️ 快速路徑 {fast_count} 份，完整解析 {full_count} 份（快速路徑 {fast_count / len(corpus):.0%}）")
+    print(f"🚀 lxml 比舊流程快 {legacy / full:.2f}×，快速路徑比舊流程快 {legacy / fast:.2f}×")
+    print(f"快速路徑結果不同 {len(mismatches)} 份，lxml 與 html.parser 結果不同 {len(parser_diffs)} 份")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import sys
+import time
+from aiohttp import web
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from token_counter import estimate_messages_tokens, estimate_tokens
+
+
+class MockOpenAIServer:
+    """
+    離線的 Chat Completions 模擬伺服器（用於壓力測試，不需要 API 金鑰）
+
+    - 延遲為對數常態分佈（以中位數與 sigma 設定），可用 scale 等比例縮短
+    - 可設定 5xx 錯誤與 429 的注入比例
+    - 回傳與評分 prompt 形狀相同的 Markdown 表格，報告生成後 extract_scores_from_html_string 可解析
+    - 支援 stream=True（SSE），並可注入串流停滯
+    - 模擬 prompt 快取：重複出現的 system prompt 在 usage.prompt_tokens_details.cached_tokens 回報命中
+    """
+
+    def __init__(self, latency_median=60.0, latency_sigma=0.4, latency_scale=1.0,
+                 error_rate=0.0, rate_limit_rate=0.0, stall_rate=0.0, seed=None):
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.latency_scale = latency_scale
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.stall_rate = stall_rate
+        self.random = random.Random(seed)
+
+        self.in_flight = 0
+        self.counts = {"requests": 0, "ok": 0, "errors": 0, "rate_limited": 0, "stalled": 0, "streamed": 0,
+                       "prompt_cache_hits": 0}
+        self.seen_prefixes = set()  # 已出現過的 system prompt（模擬 prompt 快取）
+
+    # ---------- 模擬行為 ----------
+    def sample_latency(self):
+        latency = self.random.lognormvariate(math.log(self.latency_median), self.latency_sigma)
+        return latency * self.latency_scale
+
+    @staticmethod
+    def build_score_block(system_prompt, rng):
+        """system prompt 要求 JSON 成績（score_schema）時，依 schema 產生符合範圍的成績區塊"""
+        marker = "## Machine-readable scores"
+        if marker not in system_prompt:
+            return ""
+        try:
+            schema = json.loads(system_prompt.split(marker, 1)[1].strip().splitlines()[-1])
+        except (ValueError, IndexError):
+            return ""
+        scores = {}
+        for key, rule in (schema.get("properties") or {}).items():
+            if "enum" in rule:
+                scores[key] = rng.choice(rule["enum"])
+            elif rule.get("type") == "string":
+                scores[key] = "N/A"
+            else:
+                scores[key] = rng.randint(int(rule.get("minimum", 0)), int(rule.get("maximum", 5)))
+        return f"\n```json\n{json.dumps(scores, ensure_ascii=False)}\n```\n"
+
+    @staticmethod
+    def build_feedback(messages):
+        """依 system prompt 判斷英語或統計評分，產生固定格式的 Markdown（同一份作答分數固定）"""
+        system_prompt = next((m.get("content") or "" for m in messages if m.get("role") == "system"), "")
+        digest = hashlib.sha256(json.dumps(messages, ensure_ascii=False).encode("utf-8")).hexdigest()
+        rng = random.Random(digest)
+        score_block = MockOpenAIServer.build_score_block(system_prompt, random.Random(digest))
+
+        if "band level" in system_prompt.lower():
+            dimensions = ["Task Response", "Coherence and Cohesion", "Lexical Resource", "Grammatical Range and Accuracy"]
+            scores = [rng.randint(2, 5) for _ in dimensions]
+            total = sum(scores)
+            band = "C1" if total >= 18 else "B2" if total >= 14 else "B1"
+            rows = "\n".join(f"| {name} | {score}/5 | Simulated comment. |" for name, score in zip(dimensions, scores))
+            return (
+                "### Grading Table\n\n"
+                "| Grading Dimension | Score | Comment |\n"
+                "|---|---|---|\n"
+                f"{rows}\n"
+                f"| Total | {total}/20 | |\n\n"
+                "### Revised Sample\n\n"
+                "This is a simulated revision of the student's answer.\n\n"
+                "### Overall\n\n"
+                f"- Total Score: {total} / 20\n"
+                f"- Band Level: {band}\n"
+                + score_block
+            )
+
+        steps = ["Step 1: State", "Step 2: Plan", "Step 3: Do", "Step 4: Conclude"]
+        sections = []
+        summary_rows = []
+        total = 0
+        for step in steps:
+            first, second = rng.randint(0, 2), rng.randint(0, 2)
+            subtotal = first + second
+            total += subtotal
+            sections.append(
+                f"### {step}\n\n"
+                "| Subitem | Score | Comment |\n"
+                "|---|---|---|\n"
+                f"| {step.split(':')[1].strip()} - Setup | {first}/2 | Simulated comment. |\n"
+                f"| {step.split(':')[1].strip()} - Reasoning | {second}/2 | Simulated comment. |\n"
+                f"| Subtotal | {subtotal}/4 | |\n"
+            )
+            summary_rows.append(f"| {step} | {subtotal} |")
+        return (
+            "\n".join(sections)
+            + "\n### Summary\n\n"
+            "| Section | Score |\n"
+            "|---|---|\n"
+            + "\n".join(summary_rows)
+            + f"\n| Total | {total} / 16 |\n\n"
+            "### Overall\n\n"
+            f"- Total Score: {total} / 16\n"
+            + score_block
+        )
+
+    def cached_prefix_tokens(self, messages):
+        """
+        模擬供應商的 prompt 快取：同一個 system prompt 第二次出現起，
+        前綴以 128 token 為單位命中快取（前綴不足 1024 token 時不快取）
+        """
+        system_prompt = (messages[0].get("content") or "") if messages[0].get("role") == "system" else ""
+        prefix_tokens = estimate_tokens(system_prompt)
+        if prefix_tokens < 1024:
+            return 0
+        digest = hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()
+        if digest not in self.seen_prefixes:
+            self.seen_prefixes.add(digest)
+            return 0
+        self.counts["prompt_cache_hits"] += 1
+        return prefix_tokens // 128 * 128
+
+    def build_usage(self, messages, content):
+        prompt_tokens = estimate_messages_tokens(messages)
+        completion_tokens = estimate_tokens(content)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": min(self.cached_prefix_tokens(messages), prompt_tokens)},
+        }
+
+    @staticmethod
+    def error_response(status, message, error_type, headers=None):
+        body = {"error": {"message": message, "type": error_type, "param": None, "code": None}}
+        return web.json_response(body, status=status, headers=headers)
+
+    # ---------- HTTP ----------
+    async def handle_chat_completions(self, request):
+        self.counts["requests"] += 1
+        try:
+            body = await request.json()
+        except ValueError:
+            return self.error_response(400, "Invalid JSON body", "invalid_request_error")
+
+        messages = body.get("messages") or []
+        model = body.get("model", "mock-model")
+        if not messages:
+            return self.error_response(400, "'messages' is required", "invalid_request_error")
+
+        roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            self.counts["rate_limited"] += 1
+            return self.error_response(429, "Simulated rate limit", "rate_limit_exceeded", headers={"Retry-After": "1"})
+
+        self.in_flight += 1
+        try:
+            latency = self.sample_latency()
+            if roll < self.rate_limit_rate + self.error_rate:
+                await asyncio.sleep(latency * self.random.random())
+                self.counts["errors"] += 1
+                return self.error_response(503, "Simulated upstream failure", "server_error")
+
+            content = self.build_feedback(messages)
+            usage = self.build_usage(messages, content)
+            completion_id = f"chatcmpl-mock-{self.counts['requests']}"
+
+            if body.get("stream"):
+                self.counts["streamed"] += 1
+                stall = self.random.random() < self.stall_rate
+                return await self.stream_response(request, completion_id, model, content, usage, latency, stall)
+
+            await asyncio.sleep(latency)
+            self.counts["ok"] += 1
+            return web.json_response({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            })
+        finally:
+            self.in_flight -= 1
+
+    async def stream_response(self, request, completion_id, model, content, usage, latency, stall):
+        """前半段延遲模擬首個 token 的等待，其餘時間平均分配給各個片段"""
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+
+        def event(delta, finish_reason=None, **extra):
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}] if delta is not None else [],
+            }
+            chunk.update(extra)
+            return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8")
+
+        await asyncio.sleep(latency / 2)
+        await response.write(event({"role": "assistant", "content": ""}))
+
+        pieces = [content[i:i + 16] for i in range(0, len(content), 16)]
+        interval = (latency / 2) / max(len(pieces), 1)
+        for index, piece in enumerate(pieces):
+            if stall and index == len(pieces) // 2:
+                # 模擬串流停滯：保持連線但不再送資料，直到客戶端放棄
+                self.counts["stalled"] += 1
+                while True:
+                    await asyncio.sleep(3600)
+            await response.write(event({"content": piece}))
+            await asyncio.sleep(interval)
+
+        await response.write(event({}, finish_reason="stop"))
+        await response.write(event(None, usage=usage))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        self.counts["ok"] += 1
+        return response
+
+    async def handle_stats(self, request):
+        return web.json_response(dict(self.counts, in_flight=self.in_flight))
+
+    def build_app(self):
+        app = web.Application(client_max_size=32 * 1024 * 1024)
+        app.router.add_post("/v1/chat/completions", self.handle_chat_completions)
+        app.router.add_get("/stats", self.handle_stats)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="離線的 OpenAI Chat Completions 模擬伺服器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency-median", type=float, default=60.0, help="延遲中位數（秒）")
+    parser.add_argument("--latency-sigma", type=float, default=0.4, help="對數常態分佈的 sigma")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="延遲縮放比例，例如 0.01 讓測試快 100 倍")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="回傳 503 的比例")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="回傳 429 的比例")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="串流中途停滯的比例")
+    parser.add_argument("--seed", type=int, default=None, help="亂數種子（重現相同的延遲與錯誤序列）")
+    args = parser.parse_args()
+
+    server = MockOpenAIServer(
+        latency_median=args.latency_median,
+        latency_sigma=args.latency_sigma,
+        latency_scale=args.latency_scale,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        stall_rate=args.stall_rate,
+        seed=args.seed,
+    )
+    print(f"🧪 模擬伺服器啟動於 http://{args.host}:{args.port}/v1")
+    print(f"   將 OPENAI_API_BASE 設為 http://{args.host}:{args.port}/v1 即可讓機器人或 regrade.py 改用模擬伺服器")
+    print(f"   延遲中位數 {args.latency_median * args.latency_scale:.2f} 秒，錯誤率 {args.error_rate:.0%}，429 比例 {args.rate_limit_rate:.0%}")
+    web.run_app(server.build_app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import traceback
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from config import REPORTS_DIR, GRADING_WORKERS
+from database import DatabaseManager
+from file_handler import FileHandler
+from grading import GradingService
+from html_parser import extract_html_content, extract_scores_from_html_string
+from llm_client import get_chat_client
+from llm_retry import retry_policy
+from model_router import get_model_settings
+from preflight import AnswerTooLargeError, check_submission
+from prompt_cache import prompt_cache_stats
+from prompt_registry import prompt_registry
+from rate_limiter import rate_limiter
+from response_cache import close_response_cache
+from structured_scores import (
+    ScoreValidationError, get_score_schemas, parse_structured_scores, split_score_block, to_parsed_scores,
+    with_score_instruction,
+)
+
+
+class BulkRegrader:
+    """
+    批次重新評分某班級、特定題目已保存的所有提交
+
+    - 以 Semaphore 限制同時評分的份數，LLM 請求仍經過共用的限流器與重試策略
+    - 每完成 batch_size 份就批次寫入 parsed_scores 並保存檢查點，中斷後可從檢查點續跑；
+      全部成功時封存檢查點，下次 rubric 變更後再執行會重新評分所有提交（restart=True 則忽略現有檢查點）
+    - 新報告的檔名加上本次重新評分的後綴（記錄在檢查點中），不覆蓋原本的報告
+    - 不使用回應快取，rubric 未變更時也會重新呼叫 API
+    """
+
+    def __init__(self, question_title, class_name, concurrency=GRADING_WORKERS, batch_size=25,
+                 checkpoint_path=None, latest_only=False, upload=False, restart=False):
+        self.question_title = question_title
+        self.class_name = class_name
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.latest_only = latest_only
+        self.upload = upload
+        self.restart = restart
+        self.checkpoint_path = checkpoint_path or os.path.join(
+            REPORTS_DIR,
+            f"regrade_{FileHandler.get_safe_filename(question_title)}_{FileHandler.get_safe_filename(class_name)}.json",
+        )
+        self.db = DatabaseManager()
+        self.archived_checkpoint = None
+        self.checkpoint = self._load_checkpoint()
+        self.report_suffix = self.checkpoint["report_suffix"]
+        self._pending_updates = []
+        self._flush_lock = None
+
+    # ---------- 檢查點 ----------
+    def _load_checkpoint(self):
+        if self.restart and os.path.exists(self.checkpoint_path):
+            print(f"🔁 --restart：忽略現有檢查點，重新評分所有提交 ({self.checkpoint_path})")
+        elif os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+                checkpoint = json.load(f)
+            if checkpoint.get("question_title") == self.question_title and checkpoint.get("class_name") == self.class_name:
+                checkpoint.setdefault("report_suffix", "_regrade")
+                print(f"📌 從檢查點續跑：已完成 {len(checkpoint['done'])} 份 ({self.checkpoint_path})")
+                return checkpoint
+            print(f"⚠️ 檢查點屬於其他題目或班級，重新開始: {self.checkpoint_path}")
+        return {
+            "question_title": self.question_title,
+            "class_name": self.class_name,
+            "report_suffix": f"_regrade_{time.strftime('%Y%m%d-%H%M%S')}",
+            "done": {},
+            "failed": {},
+        }
+
+    def _save_checkpoint(self):
+        temp_path = f"{self.checkpoint_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self.checkpoint, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, self.checkpoint_path)
+
+    def _archive_checkpoint(self):
+        """全部成功後把檢查點改名封存（保留紀錄），同一指令下次執行會從頭重新評分"""
+        root, ext = os.path.splitext(self.checkpoint_path)
+        archived_path = f"{root}{self.report_suffix}.done{ext}"
+        os.replace(self.checkpoint_path, archived_path)
+        return archived_path
+
+    async def _flush(self, force=False):
+        """批次寫入成績後再記錄檢查點（確保檢查點中的提交都已寫入資料庫）"""
+        async with self._flush_lock:
+            if not self._pending_updates or (not force and len(self._pending_updates) < self.batch_size):
+                return
+            batch, self._pending_updates = self._pending_updates, []
+            try:
+                self.db.update_parsed_scores_bulk(
+                    [(file_id, result["parsed_scores"], result["score_keys"]) for file_id, result in batch]
+                )
+            except Exception as e:
+                # 放回待寫入清單，下一次批次寫入時再試；檢查點先記為失敗，中斷後重新執行會再評分
+                self._pending_updates = batch + self._pending_updates
+                for file_id, _ in batch:
+                    self.checkpoint["failed"][str(file_id)] = f"寫入成績失敗: {e}"
+                self._save_checkpoint()
+                print(f"❌ 批次寫入 {len(batch)} 份成績失敗，稍後重試: {e}")
+                return
+            for file_id, result in batch:
+                self.checkpoint["done"][str(file_id)] = {"report_path": result["report_path"]}
+                self.checkpoint["failed"].pop(str(file_id), None)
+            self._save_checkpoint()
+            print(f"💾 已批次寫入 {len(batch)} 份成績（累計 {len(self.checkpoint['done'])} 份）")
+
+    # ---------- 評分 ----------
+    async def regrade_one(self, row, eng_prompt, stat_prompt):
+        file_id, user_id, student_number, student_name, file_path, attempt_number = row
+
+        if not file_path or not os.path.exists(file_path):
+            raise FileNotFoundError(f"找不到提交檔案: {file_path}")
+
+        html_student_name, student_id_from_html, answer_text = extract_html_content(file_path)
+        if not answer_text or not answer_text.strip():
+            raise ValueError("提交檔案中沒有作答內容")
+
+        preflight = check_submission(self.question_title, [eng_prompt, stat_prompt], student_name, answer_text)
+        answer_text = preflight["answer_text"]
+
+        score_schemas = get_score_schemas(self.question_title)
+        if score_schemas:
+            eng_prompt = with_score_instruction(eng_prompt, score_schemas["english"])
+            stat_prompt = with_score_instruction(stat_prompt, score_schemas["statistics"])
+
+        results = []
+        for dimension, prompt in (("english", eng_prompt), ("statistics", stat_prompt)):
+            settings = get_model_settings(self.question_title, dimension, preflight["model"])
+            results.append(GradingService.grade(
+                prompt, student_name, answer_text,
+                model=settings["model"],
+                temperature=settings["temperature"],
+                timeout=settings["timeout"],
+                max_output_tokens=settings["max_output_tokens"],
+                fallback_model=settings["fallback_model"],
+                prompt_label=f"{self.question_title} / {dimension}",
+                use_cache=False,
+            ))
+        eng_result, stat_result = await asyncio.gather(*results)
+
+        eng_feedback = eng_result["feedback"]
+        stats_feedback = stat_result["feedback"]
+        structured_scores = None
+        if score_schemas:
+            try:
+                eng_feedback, eng_scores = parse_structured_scores("english", eng_feedback, score_schemas["english"])
+                stats_feedback, stat_scores = parse_structured_scores("statistics", stats_feedback, score_schemas["statistics"])
+                structured_scores = {"english": eng_scores, "statistics": stat_scores}
+            except ScoreValidationError as e:
+                print(f"⚠️ 提交 #{file_id} 結構化成績無效，改從報告解析: {e}")
+                eng_feedback = split_score_block(eng_feedback)[0]
+                stats_feedback = split_score_block(stats_feedback)[0]
+
+        rendered = {}
+        report_path, _, _ = await FileHandler.generate_and_save_report(
+            db_student_name=student_name,
+            student_number=student_number,
+            student_id_from_html=student_id_from_html,
+            question_title=self.question_title,
+            attempt_number=attempt_number,
+            answer_text=answer_text,
+            eng_feedback_clean=eng_feedback,
+            stats_feedback_clean=stats_feedback,
+            reports_student_dir=None,
+            class_name=self.class_name,
+            student_id=student_number or student_id_from_html,
+            upload=self.upload,
+            rendered=rendered,
+            report_suffix=self.report_suffix,
+        )
+        if not report_path:
+            raise RuntimeError("報告生成失敗")
+
+        if structured_scores is not None:
+            parsed_scores, score_keys = to_parsed_scores(structured_scores)
+        else:
+            parsed_scores, score_keys = extract_scores_from_html_string(rendered["html"])
+
+        return {"report_path": report_path, "parsed_scores": parsed_scores, "score_keys": score_keys}
+
+    async def run(self):
+        """
+        執行批次重新評分
+
+        Returns:
+            dict: {"total", "skipped", "succeeded", "failed", "duration"}
+        """
+        start = time.time()
+        self._flush_lock = asyncio.Lock()
+
+        prompt_registry.load()
+        eng_prompt, stat_prompt = GradingService.get_grading_prompts(self.question_title)
+        if eng_prompt is None or stat_prompt is None:
+            raise ValueError(f"題目 '{self.question_title}' 沒有設定 Prompt")
+
+        rows = self.db.get_submissions_for_question(self.question_title, self.class_name, self.latest_only)
+        todo = [row for row in rows if str(row[0]) not in self.checkpoint["done"]]
+        print(f"📋 {self.class_name} / {self.question_title}：共 {len(rows)} 份提交，待重新評分 {len(todo)} 份")
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        succeeded = 0
+        failed = 0
+
+        async def worker(row):
+            nonlocal succeeded, failed
+            file_id = row[0]
+            async with semaphore:
+                try:
+                    result = await self.regrade_one(row, eng_prompt, stat_prompt)
+                except AnswerTooLargeError as e:
+                    failed += 1
+                    self.checkpoint["failed"][str(file_id)] = str(e)
+                    print(f"📏 提交 #{file_id} 作答過長，略過: {e}")
+                    return
+                except Exception as e:
+                    failed += 1
+                    self.checkpoint["failed"][str(file_id)] = str(e)
+                    print(f"❌ 提交 #{file_id} 重新評分失敗: {e}")
+                    traceback.print_exc()
+                    return
+
+            succeeded += 1
+            self._pending_updates.append((file_id, result))
+            print(f"✅ 提交 #{file_id}（{row[2]} 第 {row[5]} 次）完成 [{succeeded + failed}/{len(todo)}]")
+            await self._flush()
+
+        try:
+            await asyncio.gather(*(worker(row) for row in todo))
+        finally:
+            await self._flush(force=True)
+            self._save_checkpoint()
+
+        # 最後仍無法寫入資料庫的提交算作失敗（檢查點中已記錄）
+        unsaved = len(self._pending_updates)
+        if not unsaved and not self.checkpoint["failed"]:
+            self.archived_checkpoint = self._archive_checkpoint()
+        return {
+            "total": len(rows),
+            "skipped": len(rows) - len(todo),
+            "succeeded": succeeded - unsaved,
+            "failed": failed + unsaved,
+            "duration": time.time() - start,
+        }
+
+    async def close(self):
+        await get_chat_client().close()
+        close_response_cache()
+        self.db.close()
+
+
+async def async_main(args):
+    regrader = BulkRegrader(
+        args.question,
+        args.class_name,
+        concurrency=args.concurrency,
+        batch_size=args.batch_size,
+        checkpoint_path=args.checkpoint,
+        latest_only=args.latest_only,
+        upload=args.upload_drive,
+        restart=args.restart,
+    )
+    try:
+        summary = await regrader.run()
+    finally:
+        await regrader.close()
+
+    print("\n" + "=" * 50)
+    print("🎯 重新評分完成:")
+    print(f"   提交總數: {summary['total']}")
+    print(f"   先前已完成: {summary['skipped']}")
+    print(f"   本次成功: {summary['succeeded']}")
+    print(f"   本次失敗: {summary['failed']}")
+    print(f"   用時: {summary['duration']:.1f} 秒")
+
+    limiter = rate_limiter.stats()
+    retry = retry_policy.stats()
+    print(f"   限流：429 次數 {limiter['rate_limited']}，平均等待 {limiter['average_wait']:.2f} 秒")
+    print(f"   重試：{retry['retries']} 次，放棄 {retry['giveups']} 次")
+    cache = prompt_cache_stats.totals()
+    print(f"   Prompt 快取：{cache['cached_tokens']} / {cache['prompt_tokens']} prompt tokens 命中"
+          f"（{cache['cached_ratio']:.0%}），約節省 ${cache['saved_cost']:.4f}")
+    if summary["failed"]:
+        print(f"\n💡 再執行一次相同指令即可只重試失敗的提交（檢查點: {regrader.checkpoint_path}），"
+              f"加上 --restart 則忽略檢查點、重新評分所有提交；全部成功後檢查點會自動封存")
+    elif regrader.archived_checkpoint:
+        print(f"\n💡 全部成功，檢查點已封存到 {regrader.archived_checkpoint}，"
+              f"下次執行相同指令會重新評分所有提交（--restart 可隨時忽略未完成的檢查點）")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批次重新評分某班級、特定題目已保存的提交")
+    parser.add_argument("--question", required=True, help="題目標題（與 HTML 標題相同）")
+    parser.add_argument("--class", dest="class_name", required=True, help="班級名稱，例如 NCUFN")
+    parser.add_argument("--concurrency", type=int, default=GRADING_WORKERS, help="同時評分的份數")
+    parser.add_argument("--batch-size", type=int, default=25, help="每幾份批次寫入資料庫並保存檢查點")
+    parser.add_argument("--checkpoint", help="檢查點檔案路徑（預設放在 reports/）")
+    parser.add_argument("--latest-only", action="store_true", help="只重新評分每位學生最後一次提交")
+    parser.add_argument("--upload-drive", action="store_true", help="同時將新報告上傳到 Google Drive")
+    parser.add_argument("--restart", action="store_true", help="忽略現有的檢查點，重新評分所有提交")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(async_main(args))
+    except KeyboardInterrupt:
+        print("\n⚠️ 已中斷，已完成的提交都記錄在檢查點中，重新執行即可續跑")
+
+
+if __name__ == "__main__":
+    main()
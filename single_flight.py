@@ -0,0 +1,40 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+
+class KeyedLock:
+    """
+    依 key 區分的互斥鎖（例如同一位學生、同一題目）
+
+    - 相同 key 的區塊依序執行，不同 key 互不影響
+    - 沒有人持有或等待的 key 會自動清除，不會隨提交數量累積
+    """
+
+    def __init__(self):
+        self._locks = {}    # key -> asyncio.Lock
+        self._holders = {}  # key -> 持有或等待中的數量
+        self.contended = 0  # 需要等待前一個同 key 區塊的次數
+
+    @asynccontextmanager
+    async def hold(self, key):
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        if lock.locked():
+            self.contended += 1
+        self._holders[key] = self._holders.get(key, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._holders[key] -= 1
+            if self._holders[key] == 0:
+                del self._holders[key]
+                del self._locks[key]
+
+    def locked(self, key):
+        lock = self._locks.get(key)
+        return lock is not None and lock.locked()
+
+    def stats(self):
+        return {"active_keys": len(self._locks), "contended": self.contended}
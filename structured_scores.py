@@ -0,0 +1,168 @@
+import json
+import re
+from config import STRUCTURED_SCORES_ENABLED
+from prompt_registry import prompt_registry
+
+DIMENSIONS = ("english", "statistics")
+
+_SCORE_BLOCK_PATTERN = re.compile(r"```json[ \t]*\n(.*?)\n[ \t]*```", re.DOTALL | re.IGNORECASE)
+
+
+class ScoreValidationError(Exception):
+    """模型回傳的成績物件不存在、無法解析或不符合題目的 schema"""
+
+    def __init__(self, dimension, errors):
+        super().__init__(f"{dimension} scores invalid: {'; '.join(errors)}")
+        self.dimension = dimension
+        self.errors = errors
+
+
+def get_score_schemas(question_title):
+    """
+    讀取題目 manifest 的 score_schema（英語與統計各一份 JSON Schema 子集）
+
+    兩個面向的 properties 不可同名：成績存成同一個 parsed_scores 字典，同名欄位會互相覆蓋
+
+    Returns:
+        dict: {"english": schema, "statistics": schema}；未設定、設定不完整、欄位重複或已停用時回傳 None
+    """
+    if not STRUCTURED_SCORES_ENABLED:
+        return None
+    entry = prompt_registry.get_entry(question_title) or {}
+    schemas = entry.get("score_schema")
+    if not schemas:
+        return None
+    if not isinstance(schemas, dict) or any(not isinstance(schemas.get(d), dict) for d in DIMENSIONS):
+        print(f"⚠️ 題目 '{question_title}' 的 score_schema 必須同時設定 english 與 statistics")
+        return None
+    shared = set(schemas["english"].get("properties") or {}) & set(schemas["statistics"].get("properties") or {})
+    if shared:
+        print(f"⚠️ 題目 '{question_title}' 的 score_schema 中 english 與 statistics 有相同的欄位 {sorted(shared)}，"
+              f"改從報告解析成績")
+        return None
+    return schemas
+
+
+def build_schema_instruction(schema):
+    """
+    附加在 system prompt 之後的輸出格式說明
+
+    內容只由 schema 決定，同一題的 system prompt 仍保持固定（不影響 prompt 快取）
+    """
+    return (
+        "\n\n## Machine-readable scores\n"
+        "After all of the feedback above, end your response with exactly one fenced code block "
+        "that starts with ```json and contains a single JSON object with the scores you awarded. "
+        "The object must follow this JSON Schema; use numbers for scores, not strings like \"4/5\". "
+        "Do not mention the JSON block in the feedback itself.\n"
+        f"{json.dumps(schema, ensure_ascii=False, sort_keys=True)}\n"
+    )
+
+
+def with_score_instruction(prompt, schema):
+    return prompt + build_schema_instruction(schema) if schema else prompt
+
+
+def split_score_block(feedback):
+    """
+    從模型回應中取出最後一個 ```json 區塊
+
+    Returns:
+        (str, str or None): 移除區塊後給學生看的 Markdown、區塊內的 JSON 原文
+    """
+    matches = list(_SCORE_BLOCK_PATTERN.finditer(feedback or ""))
+    if not matches:
+        return feedback, None
+    block = matches[-1]
+    clean = (feedback[:block.start()] + feedback[block.end():]).rstrip() + "\n"
+    return clean, block.group(1)
+
+
+def validate_scores(scores, schema):
+    """
+    以 JSON Schema 的子集驗證成績物件：type（object / number / integer / string）、
+    properties、required、minimum、maximum、enum、additionalProperties=false
+
+    Returns:
+        list: 錯誤訊息（空列表代表通過）
+    """
+    if not isinstance(scores, dict):
+        return ["score block must be a JSON object"]
+
+    errors = []
+    properties = schema.get("properties") or {}
+    for key in schema.get("required", list(properties)):
+        if key not in scores:
+            errors.append(f"missing '{key}'")
+    if schema.get("additionalProperties") is False:
+        errors.extend(f"unexpected '{key}'" for key in scores if key not in properties)
+
+    for key, rule in properties.items():
+        if key not in scores:
+            continue
+        value = scores[key]
+        expected = rule.get("type", "number")
+        if expected in ("number", "integer"):
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                errors.append(f"'{key}' must be {'an integer' if expected == 'integer' else 'a number'}")
+                continue
+            if expected == "integer" and not float(value).is_integer():
+                errors.append(f"'{key}' must be an integer")
+            if "minimum" in rule and value < rule["minimum"]:
+                errors.append(f"'{key}' below minimum {rule['minimum']}")
+            if "maximum" in rule and value > rule["maximum"]:
+                errors.append(f"'{key}' above maximum {rule['maximum']}")
+        elif expected == "string" and not isinstance(value, str):
+            errors.append(f"'{key}' must be a string")
+        if "enum" in rule and value not in rule["enum"]:
+            errors.append(f"'{key}' must be one of {rule['enum']}")
+    return errors
+
+
+def parse_structured_scores(dimension, feedback, schema):
+    """
+    取出並驗證一個面向的成績物件
+
+    Returns:
+        (str, dict): 移除 JSON 區塊後的 Markdown、驗證過的成績（依 schema properties 順序）
+
+    Raises:
+        ScoreValidationError: 沒有 JSON 區塊、JSON 格式錯誤或不符合 schema
+    """
+    clean, raw = split_score_block(feedback)
+    if raw is None:
+        raise ScoreValidationError(dimension, ["no ```json score block in response"])
+    try:
+        scores = json.loads(raw)
+    except ValueError as e:
+        raise ScoreValidationError(dimension, [f"invalid JSON: {e}"])
+
+    errors = validate_scores(scores, schema)
+    if errors:
+        raise ScoreValidationError(dimension, errors)
+
+    ordered = list(schema.get("properties") or {}) + [key for key in scores if key not in (schema.get("properties") or {})]
+    return clean, {key: scores[key] for key in ordered if key in scores}
+
+
+def to_parsed_scores(scores_by_dimension):
+    """
+    轉為與 extract_scores_from_html_string 相同的 (parsed_scores, score_keys) 格式
+    （數值轉成字串，與從報告解析出的成績型別一致）
+
+    schema 之外、兩個面向都出現的欄位（例如模型自行加上的 total）加上面向前綴，
+    例如 English_total 與 Statistics_total，不會互相覆蓋
+    """
+    shared = set(scores_by_dimension.get("english") or {}) & set(scores_by_dimension.get("statistics") or {})
+    data = {}
+    ordered_keys = []
+    for dimension in DIMENSIONS:
+        for key, value in (scores_by_dimension.get(dimension) or {}).items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                value = format(value, "g")
+            if key in shared:
+                key = f"{dimension.capitalize()}_{key}"
+            data[key] = value
+            if key not in ordered_keys:
+                ordered_keys.append(key)
+    return data, ordered_keys
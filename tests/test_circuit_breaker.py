@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+from circuit_breaker import CircuitBreaker
+from pipeline import GradingPipeline
+
+
+def make_half_open_breaker():
+    breaker = CircuitBreaker(failure_threshold=1, cooldown=0.0, half_open_max_calls=1)
+    breaker._transition(CircuitBreaker.OPEN, "test")
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    return breaker
+
+
+def test_stage_timeout_counts_as_probe_failure():
+    breaker = make_half_open_breaker()
+    breaker.cooldown = 60.0
+
+    async def slow_request():
+        await asyncio.sleep(10)
+
+    async def run():
+        pipeline = GradingPipeline()
+        pipeline.add_stage("english", lambda: breaker.call(slow_request), timeout=0.05)
+        with pytest.raises(asyncio.TimeoutError):
+            await pipeline.run()
+
+    asyncio.run(run())
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker._half_open_in_flight == 0
+    assert "TimeoutError" in breaker.last_error
+
+
+def test_other_cancellation_is_not_recorded():
+    breaker = CircuitBreaker(failure_threshold=1)
+
+    async def run():
+        task = asyncio.create_task(breaker.call(lambda: asyncio.sleep(10)))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.last_error is None
+
+
+def test_asyncio_timeout_is_an_outage():
+    breaker = CircuitBreaker(failure_threshold=1)
+
+    async def request():
+        raise asyncio.TimeoutError()
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(breaker.call(request))
+    assert breaker.state == CircuitBreaker.OPEN
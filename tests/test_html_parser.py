@@ -0,0 +1,114 @@
+import random
+
+import pytest
+
+from html_parser import HtmlSanitizer, parse_submission, parser_stats
+
+
+def build_submission(answer="(1) The sample mean is 52.3, so we reject H0.<br>\n(2) p-value 0.012 &lt; 0.05.",
+                     title="HW1 假設檢定", name="<span>王小明</span>", head_extra="", answer_field=None):
+    """StatsAnswerFormatter 匯出的版面"""
+    if answer_field is None:
+        answer_field = f'<div class="field"><label>作答區：</label><p>{answer}</p></div>'
+    return f"""<!DOCTYPE html>
+<html lang="zh-Hant">
+<head>
+<meta charset="UTF-8">
+<title>{title}</title>
+<style>label {{ font-weight: bold; }}</style>
+{head_extra}</head>
+<body>
+<div class="container">
+<h1>HW1</h1>
+<div class="field"><label>姓名：</label>{name}</div>
+<div class="field"><label>學號：</label><span>112000123</span></div>
+<div class="question"><h2>題目</h2><p>Test whether the mean differs from 50.</p></div>
+{answer_field}
+</div>
+</body>
+</html>
+"""
+
+
+# 快速路徑應該接手的檔案
+FAST_CASES = {
+    "plain": build_submission(),
+    "crlf": build_submission().replace("\n", "\r\n"),
+    "entities_and_inline_tags": build_submission(
+        answer="<b>Step 1</b> H0: &mu; = 50 &amp; H1: &mu; &ne; 50<br>\n<em>p</em> &lt; 0.05&nbsp;"
+    ),
+    "script_with_markup": build_submission(
+        head_extra="<script>document.querySelector('label').innerHTML = '<span>姓名：x</span>';</script>\n"
+    ),
+    "comment": build_submission(head_extra="<!-- <label>作答區：</label><p>old</p> -->\n"),
+    "half_width_colon": build_submission().replace("姓名：", "姓名:"),
+}
+
+# 快速路徑必須放棄、交給完整解析的檔案
+FULL_CASES = {
+    "block_in_answer": build_submission(answer="Line 1<br>\n<div>Table 1</div>\nLine 2"),
+    "literal_less_than": build_submission(answer="p < 0.05 so we reject"),
+    "textarea_answer": build_submission(
+        answer_field='<div class="field"><label>作答區：</label><textarea>free text</textarea></div>'
+    ),
+    "no_title": build_submission(title=""),
+    "nested_name": build_submission(name="<span><b>王小明</b></span>"),
+}
+
+
+@pytest.mark.parametrize("name", sorted(FAST_CASES) + sorted(FULL_CASES))
+@pytest.mark.parametrize("as_bytes", [True, False])
+def test_fast_path_matches_full_parse(name, as_bytes):
+    raw_html = {**FAST_CASES, **FULL_CASES}[name]
+    if as_bytes:
+        raw_html = raw_html.encode("utf-8")
+    assert parse_submission(raw_html) == parse_submission(raw_html, fast_path=False)
+
+
+@pytest.mark.parametrize("name", sorted(FAST_CASES))
+def test_fast_path_handles_simple_layouts(name):
+    before = parser_stats()["fast"]
+    submission = parse_submission(FAST_CASES[name].encode("utf-8"), fast_path=True)
+    assert parser_stats()["fast"] == before + 1
+    assert submission["student_id"] == "112000123"
+    assert submission["answer_text"]
+
+
+@pytest.mark.parametrize("name", sorted(FULL_CASES))
+def test_fast_path_falls_back_when_unsure(name):
+    before = parser_stats()["full"]
+    parse_submission(FULL_CASES[name].encode("utf-8"), fast_path=True)
+    assert parser_stats()["full"] == before + 1
+
+
+def sanitize(text, chunk_sizes):
+    sanitizer = HtmlSanitizer()
+    parts, position = [], 0
+    for size in chunk_sizes:
+        parts.append(sanitizer.feed(text[position:position + size]))
+        position += size
+    parts.append(sanitizer.feed(text[position:]))
+    parts.append(sanitizer.close())
+    return "".join(parts), sanitizer
+
+
+def test_sanitizer_result_does_not_depend_on_chunking():
+    image = '<img src="data:image/png;base64,' + "QUJD" * 5000 + '">'
+    raw_html = build_submission(
+        answer="See figure<br>\n" + image,
+        head_extra="<SCRIPT type='text/javascript'>var s = '</div>';</SCRIPT>\n",
+    )
+    expected, sanitizer = sanitize(raw_html, [])
+    assert "QUJD" not in expected and "var s" not in expected
+    assert (sanitizer.removed_blocks, sanitizer.removed_uris) == (2, 1)
+
+    rng = random.Random(0)
+    for _ in range(20):
+        chunks = [rng.randint(1, 300) for _ in range(len(raw_html) // 50)]
+        assert sanitize(raw_html, chunks)[0] == expected
+
+
+def test_sanitized_copy_parses_like_original():
+    raw_html = build_submission(head_extra="<script>var label = '<label>作答區：</label><p>x</p>';</script>\n")
+    cleaned, _ = sanitize(raw_html, [7] * 200)
+    assert parse_submission(cleaned, fast_path=False) == parse_submission(raw_html, fast_path=False)
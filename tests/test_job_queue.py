@@ -0,0 +1,62 @@
+import asyncio
+
+from job_queue import GradingJob, GradingQueue, QueueFullError
+
+
+class FakeUser:
+    async def send(self, content):
+        return None
+
+
+def make_job(attempt_number):
+    return GradingJob(FakeUser(), {"user_id": 1, "html_title": "HW1", "attempt_number": attempt_number})
+
+
+def test_replace_pending_swaps_payload_in_place():
+    async def run():
+        queue = GradingQueue(handler=None, workers=0)
+        first, second = make_job(1), make_job(2)
+        await queue.submit(first)
+        await queue.submit(second)
+
+        assert queue.find_pending(1, "HW1") is first
+        payload = dict(first.payload, answer_text="new upload")
+        assert await queue.replace_pending(first, payload)
+        return queue, first
+
+    queue, job = asyncio.run(run())
+    assert job.payload["answer_text"] == "new upload"
+    assert queue.position(job) == 1
+    assert queue.merged == 1
+
+
+def test_replace_pending_fails_once_job_started():
+    async def run():
+        queue = GradingQueue(handler=None, workers=0)
+        job = make_job(1)
+        await queue.submit(job)
+        # worker 取出工作後就不能再合併
+        queue._pending.remove(job)
+        queue._running[job.job_id] = job
+        return await queue.replace_pending(job, {"answer_text": "late"}), job
+
+    replaced, job = asyncio.run(run())
+    assert not replaced
+    assert "answer_text" not in job.payload
+
+
+def test_concurrent_submits_respect_max_depth():
+    class SlowUser:
+        async def send(self, content):
+            await asyncio.sleep(0.01)
+
+    async def run():
+        queue = GradingQueue(handler=None, workers=0, max_depth=2)
+        jobs = [GradingJob(SlowUser(), {"user_id": i, "html_title": "HW1", "attempt_number": 1}) for i in range(5)]
+        results = await asyncio.gather(*(queue.submit(job) for job in jobs), return_exceptions=True)
+        return queue, results
+
+    queue, results = asyncio.run(run())
+    assert queue.depth == 2
+    assert sum(isinstance(result, QueueFullError) for result in results) == 3
+    assert queue._reserved == 0
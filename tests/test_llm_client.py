@@ -0,0 +1,31 @@
+import asyncio
+
+from llm_client import AsyncChatClient
+from rate_limiter import rate_limiter
+
+
+def test_cancel_while_waiting_for_slot_releases_ticket():
+    async def run():
+        client = AsyncChatClient(api_key="test", api_base="http://127.0.0.1:9", max_concurrency=1)
+        client._ensure_loop_resources()
+        await client._semaphore.acquire()  # 佔用唯一的連線名額
+        before = rate_limiter.in_flight
+
+        task = asyncio.create_task(client.chat_completion([{"role": "user", "content": "hi"}], model="m"))
+        await asyncio.sleep(0.05)
+        assert client.waiting == 1
+        assert rate_limiter.in_flight == before + 1
+
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        client._semaphore.release()
+        await client.close()
+        return before, client
+
+    before, client = asyncio.run(run())
+    assert rate_limiter.in_flight == before
+    assert client.waiting == 0
+    assert client.in_flight == 0
@@ -0,0 +1,73 @@
+import asyncio
+
+import grading
+from grading import GradingService
+from response_cache import ResponseCache
+
+
+def make_messages(student_name, answer="same answer"):
+    return GradingService.create_messages("system prompt", student_name, answer)
+
+
+def test_normalized_answer_ignores_whitespace_and_line_endings():
+    assert ResponseCache.normalize_answer("  line 1 \r\n\r\nline   2\n") == "line 1\nline 2"
+
+
+def test_anonymize_replaces_whole_name_only():
+    feedback = "Li did well. Linear models were used correctly, Li."
+    anonymized = ResponseCache.anonymize(feedback, "Li")
+    assert anonymized == "{{student_name}} did well. Linear models were used correctly, {{student_name}}."
+    assert ResponseCache.personalize(anonymized, "王小明") == "王小明 did well. Linear models were used correctly, 王小明."
+
+
+def test_key_covers_every_request_parameter():
+    messages = make_messages("Alice")
+    base = ResponseCache.make_key("m", messages, {"temperature": 1.0})
+    assert base != ResponseCache.make_key("m", messages, {"temperature": 0.5})
+    assert base != ResponseCache.make_key("m", messages, {"temperature": 1.0, "max_completion_tokens": 500})
+    assert base != ResponseCache.make_key("other", messages, {"temperature": 1.0})
+
+
+def test_key_is_stable_and_ignores_param_order_and_none():
+    messages = make_messages("Alice")
+    a = ResponseCache.make_key("m", messages, {"temperature": 1.0, "max_completion_tokens": 500})
+    b = ResponseCache.make_key("m", messages, {"max_completion_tokens": 500, "temperature": 1.0, "seed": None})
+    assert a == b
+
+
+def test_async_get_put_roundtrip(tmp_path):
+    cache = ResponseCache(db_path=str(tmp_path / "cache.db"))
+    key = ResponseCache.make_key("m", make_messages("Alice"), {"temperature": 1.0})
+
+    async def run():
+        assert await cache.aget(key) is None
+        await cache.aput(key, "m", "feedback")
+        return await cache.aget(key)
+
+    assert asyncio.run(run()) == "feedback"
+    cache.close()
+
+
+def test_students_with_same_answer_share_cache_entry(tmp_path, monkeypatch):
+    cache = ResponseCache(db_path=str(tmp_path / "cache.db"))
+    monkeypatch.setattr(grading, "get_response_cache", lambda: cache)
+    requests = []
+
+    async def fake_request_completion(messages, model, temperature, timeout, on_progress, **extra_params):
+        requests.append(messages)
+        name = messages[-1]["content"].split("Student Name: ")[1].split("\n")[0]
+        return {"choices": [{"message": {"content": f"Dear {name}, good work."}}], "usage": None}
+
+    monkeypatch.setattr(GradingService, "request_completion", staticmethod(fake_request_completion))
+
+    async def run():
+        first = await GradingService.grade("system prompt", "Alice", "H0: mu = 50\nreject H0", model="m")
+        second = await GradingService.grade("system prompt", "Bob", "  H0: mu = 50\r\n\r\nreject   H0 ", model="m")
+        return first, second
+
+    first, second = asyncio.run(run())
+    cache.close()
+    assert len(requests) == 1
+    assert not first["cached"] and second["cached"]
+    assert first["feedback"] == "Dear Alice, good work."
+    assert second["feedback"] == "Dear Bob, good work."
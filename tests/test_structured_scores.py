@@ -0,0 +1,24 @@
+import structured_scores
+from structured_scores import get_score_schemas, to_parsed_scores
+
+
+def test_colliding_extra_keys_are_namespaced():
+    data, keys = to_parsed_scores({
+        "english": {"Task Response": 4, "total": 16},
+        "statistics": {"Stats_Summary_Total": 12.5, "total": 12.5},
+    })
+    assert data == {"Task Response": "4", "English_total": "16", "Stats_Summary_Total": "12.5", "Statistics_total": "12.5"}
+    assert keys == ["Task Response", "English_total", "Stats_Summary_Total", "Statistics_total"]
+
+
+def test_schema_with_shared_property_is_rejected(monkeypatch):
+    entry = {"score_schema": {
+        "english": {"properties": {"total": {"type": "number"}}},
+        "statistics": {"properties": {"total": {"type": "number"}}},
+    }}
+    monkeypatch.setattr(structured_scores, "STRUCTURED_SCORES_ENABLED", True)
+    monkeypatch.setattr(structured_scores.prompt_registry, "get_entry", lambda title: entry)
+    assert get_score_schemas("HW1") is None
+
+    entry["score_schema"]["statistics"] = {"properties": {"Stats_Total": {"type": "number"}}}
+    assert get_score_schemas("HW1") is entry["score_schema"]
@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+
+from model_router import fit_to_budget
+from pipeline import GradingPipeline
+from time_budget import TimeBudget
+
+
+def test_resume_keeps_exhausted_budget():
+    assert TimeBudget.resume(0.0, 480).remaining() == 0.0
+    assert TimeBudget.resume(-3.0, 480).expired()
+
+
+def test_resume_uses_default_when_missing():
+    assert TimeBudget.resume(None, 480).remaining() > 470
+
+
+def test_timeout_respects_cap_and_reserve():
+    budget = TimeBudget(100)
+    assert budget.timeout(cap=10) == 10
+    assert 69 < budget.timeout(reserve=30) <= 70
+    assert budget.timeout(reserve=500) == 0.0
+
+
+def test_fit_to_budget_splits_time_with_fallback_model():
+    settings = {"timeout": 120.0, "fallback_model": "backup"}
+    assert fit_to_budget(settings, 60)["timeout"] == 30
+    assert fit_to_budget(dict(settings, fallback_model=None), 60)["timeout"] == 60
+    assert fit_to_budget(settings, 0)["timeout"] == 1.0
+
+
+def test_stage_with_exhausted_budget_times_out_without_running():
+    started = []
+
+    async def stage():
+        started.append(True)
+        return "done"
+
+    async def run():
+        pipeline = GradingPipeline().add_stage("english", stage, timeout=0)
+        await pipeline.run()
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(run())
+    assert started == []
+
+
+def test_partial_run_keeps_finished_stage():
+    async def fast():
+        return "ok"
+
+    async def slow():
+        await asyncio.sleep(5)
+
+    async def run():
+        pipeline = GradingPipeline().add_stage("english", fast, timeout=1).add_stage("statistics", slow, timeout=0.05)
+        return await pipeline.run(allow_partial=True), pipeline.timed_out
+
+    results, timed_out = asyncio.run(run())
+    assert results == {"english": "ok"}
+    assert timed_out == ["statistics"]
@@ -0,0 +1,48 @@
+import time
+
+
+class TimeBudget:
+    """
+    一份提交從收到到送出報告的總時間預算
+
+    - 每個階段以 remaining() / timeout() 取得剩餘時間，不再各自使用固定的超時秒數
+    - 排隊等待不計入：放入佇列時以 remaining() 記錄剩餘秒數，worker 開始評分時再以該秒數建立新的預算
+    """
+
+    def __init__(self, seconds):
+        self.total = seconds
+        self.started_at = time.monotonic()
+        self.deadline = self.started_at + seconds
+
+    @classmethod
+    def resume(cls, remaining, default):
+        """
+        依放入佇列時記錄的剩餘秒數建立新的預算
+
+        remaining 為 None（舊工作沒有記錄）時使用 default；0 代表預算已用完，不會重設為 default
+        """
+        return cls(default if remaining is None else max(0.0, remaining))
+
+    def elapsed(self):
+        return time.monotonic() - self.started_at
+
+    def remaining(self):
+        return max(0.0, self.deadline - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def has(self, seconds):
+        """剩餘時間是否至少還有 seconds 秒"""
+        return self.remaining() >= seconds
+
+    def timeout(self, cap=None, reserve=0.0):
+        """
+        下一個階段可以使用的秒數
+
+        Args:
+            cap (float, optional): 此階段本身的上限（例如題目設定的模型期限）
+            reserve (float): 保留給後續階段的秒數
+        """
+        available = max(0.0, self.remaining() - reserve)
+        return min(cap, available) if cap is not None else available
@@ -0,0 +1,71 @@
+import re
+
+try:
+    import tiktoken  # 選用套件：有安裝時使用精確的 tokenizer
+except ImportError:
+    tiktoken = None
+
+# 每則訊息的格式額外開銷（role、分隔符號等）
+MESSAGE_OVERHEAD_TOKENS = 4
+REPLY_PRIMING_TOKENS = 3
+
+_CJK_PATTERN = re.compile(r"[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]")
+_encoding = None
+
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None and tiktoken is not None:
+        try:
+            _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            _encoding = None
+    return _encoding
+
+
+def estimate_tokens(text):
+    """
+    估計文字的 token 數
+
+    有安裝 tiktoken 時使用 o200k_base 編碼精確計算；
+    否則以經驗法則估計：中日韓字元約 1 token/字，其餘約 4 字元/token
+    """
+    if not text:
+        return 0
+
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+
+    cjk_count = len(_CJK_PATTERN.findall(text))
+    other_count = len(text) - cjk_count
+    return cjk_count + (other_count + 3) // 4
+
+
+def estimate_messages_tokens(messages):
+    """估計整組 Chat Completions 訊息的 prompt token 數"""
+    total = REPLY_PRIMING_TOKENS
+    for message in messages:
+        total += MESSAGE_OVERHEAD_TOKENS + estimate_tokens(message.get("content") or "")
+    return total
+
+
+def truncate_to_tokens(text, max_tokens):
+    """將文字截斷至約 max_tokens 個 token（沒有 tiktoken 時以字元比例估計）"""
+    if max_tokens <= 0 or not text:
+        return ""
+
+    encoding = _get_encoding()
+    if encoding is not None:
+        tokens = encoding.encode(text)
+        if len(tokens) <= max_tokens:
+            return text
+        return encoding.decode(tokens[:max_tokens])
+
+    total = estimate_tokens(text)
+    if total <= max_tokens:
+        return text
+    keep = int(len(text) * max_tokens / total)
+    while keep > 0 and estimate_tokens(text[:keep]) > max_tokens:
+        keep = int(keep * 0.95)
+    return text[:keep]